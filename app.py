@@ -169,19 +169,68 @@ if menu == "Buscar Novos (API)":
     st.info("Conecte-se à API ou use Mock para encontrar empresas e adicionar à sua carteira.")
     
     col_mode, col_key = st.columns([1, 2])
-    modo = col_mode.selectbox("Fonte de Dados", ["Mock / Teste", "API CNPJá (Real)"])
+    modo = col_mode.selectbox("Fonte de Dados", ["Mock / Teste", "Base Local (Receita)", "API CNPJá (Real)",
+                                                 "Lista de CNPJs (arquivo)"])
     api_key = ""
-    if modo == "API CNPJá (Real)":
+    arquivo_cnpjs = None
+    if modo == "Lista de CNPJs (arquivo)":
+        arquivo_cnpjs = st.file_uploader("TXT, CSV ou XLSX com CNPJs (qualquer coluna, com ou sem pontuação)",
+                                         type=["txt", "csv", "xlsx"])
+    if modo in ("API CNPJá (Real)", "Lista de CNPJs (arquivo)"):
         api_key = col_key.text_input("API Key", type="password", value="e32611ea-918b-4ed0-8b0e-e4432f9de77b-1df5f4c3-cd44-4821-ac4d-ce5b9c34271a")
+        # Guardada para a estimativa de créditos e o enriquecimento na hora de salvar (outro rerun)
+        st.session_state['api_key_cnpja'] = api_key
 
     if st.button("Executar Varredura", type="primary"):
         with st.spinner("Buscando dados..."):
             raw_leads = []
+            search_engine.iniciar_execucao()
             if modo == "Mock / Teste":
                 raw_leads = search_engine.buscar_empresas(mock_mode=True)
+            elif modo == "Base Local (Receita)":
+                raw_leads, erro = search_engine.buscar_base_local()
+                if erro: st.warning(erro)
+                raw_leads = raw_leads or []
+            elif modo == "Lista de CNPJs (arquivo)":
+                if not arquivo_cnpjs:
+                    st.warning("Envie um arquivo com a lista de CNPJs.")
+                else:
+                    # Lê o arquivo em lotes: cada lote já vai para a consulta enquanto o resto é lido
+                    progresso = st.empty()
+                    extracao = {}
+                    for lote in search_engine.extrair_cnpjs_arquivo(arquivo_cnpjs, estatisticas=extracao):
+                        for cnpj, detalhes in search_engine.enriquecer_lote(api_key or None, lote, multi_provedor=True):
+                            if detalhes:
+                                raw_leads.append(detalhes)
+                        progresso.caption(f"{extracao['encontrados'] - extracao['invalidos'] - extracao['duplicados']} "
+                                          f"CNPJs lidos, {len(raw_leads)} encontrados nas APIs...")
+                    progresso.empty()
+                    st.caption(f"Arquivo: {extracao.get('encontrados', 0)} CNPJs, {extracao.get('invalidos', 0)} com "
+                               f"dígito verificador inválido, {extracao.get('duplicados', 0)} repetidos.")
             else:
-                raw_leads, erro = search_engine.buscar_cnpja_comercial(api_key=api_key)
-                if erro: st.error(erro)
+                # Páginas chegam aos poucos (um DataFrame cada): mostra o que já veio enquanto o resto carrega,
+                # juntando só as colunas exibidas em vez de remontar a tabela inteira a partir de dicts
+                parcial = st.empty()
+                erro = None
+                paginas = []
+                visiveis = []
+                varredura = {}
+                try:
+                    for pagina in search_engine.varrer_cnpja_paginas(api_key, estatisticas=varredura):
+                        paginas.append(pagina)
+                        visiveis.append(pagina[["razao_social", "cnae_fiscal_descricao", "bairro"]])
+                        parcial.dataframe(pd.concat(visiveis, ignore_index=True), use_container_width=True, hide_index=True)
+                except search_engine.ErroCNPJa as e:
+                    erro = str(e)
+                    st.error(erro)
+                parcial.empty()
+                if varredura.get("interrompida"):
+                    st.warning(f"Varredura parou no limite de {search_engine.MAX_PAGINAS_VARREDURA} páginas "
+                               f"({varredura['registros']} empresas): pode haver mais empresas na cidade.")
+                if paginas:
+                    raw_leads = pd.concat(paginas, ignore_index=True).to_dict("records")
+                elif not erro:
+                    st.warning("API retornou sucesso mas lista vazia (Verifique se há empresas novas).")
 
             if raw_leads:
                 # Processar Leads (Enriquecer)
@@ -189,17 +238,30 @@ if menu == "Buscar Novos (API)":
                 
                 # Gerar Link de Rota na Memória
                 for p in processed_leads:
-                     if p.get('logradouro'):
-                         log = str(p.get('logradouro','')).replace(' ','+')
-                         num = str(p.get('numero','')).replace(' ','+')
-                         bai = str(p.get('bairro','')).replace(' ','+')
-                         p['Rota'] = f"https://www.google.com/maps/search/?api=1&query={log}+{num}+{bai}+Iguatu+CE"
-                     else:
-                         p['Rota'] = ""
+                     p['Rota'] = business_logic.gerar_link_rota(p)
 
                 st.session_state['novos_leads'] = processed_leads
                 st.success(f"{len(processed_leads)} empresas encontradas!")
     
+    with st.expander("APIs: latência e cache (desde que o app subiu)"):
+        latencias = search_engine.estatisticas_latencia()
+        if latencias:
+            st.dataframe(pd.DataFrame.from_dict(latencias, orient="index"), use_container_width=True)
+        hedge = search_engine.estatisticas_hedge()
+        if hedge["consultas"]:
+            st.caption(f"Consultas por CNPJ: {hedge['consultas']} ({hedge['hedges']} com hedge, "
+                       f"{hedge['fallbacks']} fallbacks) | vitórias: {hedge['vitorias']} | "
+                       f"primário agora: {search_engine.ranking_provedores(api_key or st.session_state.get('api_key_cnpja') or None)[0]}")
+        cache = search_engine.estatisticas_cache()
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("Cache: acertos", cache["hits"] + cache["stale"])
+        c2.metric("Cache: faltas", cache["misses"])
+        c3.metric("Créditos economizados", cache["creditos_economizados"])
+        c4.metric("Registros no cache", cache["registros"] or 0)
+        saldo = search_engine.saldo_creditos()
+        st.caption(f"Créditos CNPJá: {saldo['execucao']} nesta execução, {saldo['mes']} no mês "
+                   f"(restam {saldo['restante_mes']} do orçamento mensal).")
+
     # Exibir Resultados Recentes da Memória
     if 'novos_leads' in st.session_state:
         # DEBUG INSPECTOR
@@ -221,42 +283,44 @@ if menu == "Buscar Novos (API)":
             hide_index=True
         )
         
+        # Simulação do custo antes de importar (nenhuma chamada paga)
+        if st.session_state.get('api_key_cnpja'):
+            a_enriquecer = [st.session_state['novos_leads'][idx]['cnpj'] for idx in edited_df[edited_df['Importar'] == True].index
+                            if not st.session_state['novos_leads'][idx].get('cnaes_secundarios')]
+            if a_enriquecer:
+                estimativa = search_engine.estimar_creditos_enriquecimento(a_enriquecer)
+                msg_estimativa = (f"Enriquecimento estimado: {estimativa['creditos']} créditos "
+                                  f"({estimativa['consultas']} CNPJs, {estimativa['em_cache']} já em cache).")
+                if estimativa['cabe_no_orcamento']:
+                    st.caption(msg_estimativa)
+                else:
+                    st.warning(msg_estimativa + " Acima do orçamento: parte dos CNPJs ficará sem detalhes.")
+
         if st.button("Salvar Marcados na Carteira", type="primary"):
-            stats = {"inserted": 0, "updated": 0, "skipped": 0, "error": 0}
             indices_selecionados = edited_df[edited_df['Importar'] == True].index
             
             prog_bar = st.progress(0)
-            total = len(indices_selecionados)
-            
-            for i, idx in enumerate(indices_selecionados):
-                lead_obj = st.session_state['novos_leads'][idx]
-                cnpj = lead_obj['cnpj']
-                
-                # ENRIQUECIMENTO DE DADOS
-                if not lead_obj.get('cnaes_secundarios'):
-                    st.toast(f"Enriquecendo dados para {cnpj}...")
-                    api_key = st.session_state.get('api_key_cnpja')
-                    if api_key:
-                        detalhes = search_engine.consultar_detalhes_cnpj(api_key, cnpj)
-                        if detalhes:
-                            count_sec = len(detalhes.get('cnaes_secundarios', []))
-                            if count_sec > 0:
-                                st.toast(f"Enriquecido: +{count_sec} ativ. secundárias.")
-                            else:
-                                st.toast(f"Detalhes obtidos, mas sem secundárias.")
-                                
-                            lead_obj.update(detalhes)
-                            re_analysis = business_logic.analisar_leads([lead_obj])
-                            if re_analysis:
-                                lead_obj = re_analysis[0]
-                                
-                # Debug Temporário
-                p_debug = lead_obj.get('porte_receita', 'KEY_MISSING')
-                # st.toast(f"P. Rec: {p_debug}", icon="🐞")
-                
-                result = database.upsert_empresa(lead_obj)
-                stats[result] = stats.get(result, 0) + 1
-                prog_bar.progress((i + 1) / total)
+            selecionados = [st.session_state['novos_leads'][idx] for idx in indices_selecionados]
+
+            # ENRIQUECIMENTO DE DADOS (consultas em paralelo, uma reanálise e uma escrita para o lote)
+            api_key = st.session_state.get('api_key_cnpja')
+            pendentes = {lead['cnpj']: lead for lead in selecionados if not lead.get('cnaes_secundarios')}
+            if api_key and pendentes:
+                search_engine.iniciar_execucao()
+                st.toast(f"Enriquecendo dados de {len(pendentes)} empresas...")
+                enriquecidos = []
+                for i, (cnpj, detalhes) in enumerate(search_engine.enriquecer_lote(api_key, list(pendentes))):
+                    if detalhes:
+                        pendentes[cnpj].update(detalhes)
+                        enriquecidos.append(cnpj)
+                    prog_bar.progress((i + 1) / len(pendentes), text=f"Enriquecendo {i + 1}/{len(pendentes)}")
+                if enriquecidos:
+                    reanalisados = {p['cnpj']: p for p in business_logic.analisar_leads([pendentes[c] for c in enriquecidos])}
+                    selecionados = [reanalisados.get(lead['cnpj'], lead) for lead in selecionados]
+                    st.toast(f"Enriquecidos: {len(enriquecidos)} de {len(pendentes)}.")
+
+            prog_bar.progress(1.0, text="Gravando na carteira...")
+            stats = database.upsert_empresas_lote(selecionados)
             
             prog_bar.empty()
             
@@ -270,6 +334,19 @@ if menu == "Buscar Novos (API)":
 elif menu == "Minha Carteira":
     st.header("Minha Carteira")
     
+    with st.expander(f"Regras de porte e taxa (versão {business_logic.REGRAS_PORTE.versao})"):
+        st.caption("Limites do Anexo II e isenção do Art. 16 ficam em regras_porte.json. "
+                   "Depois de editar o arquivo, recarregue e recalcule a carteira.")
+        if st.button("Recarregar regras e recalcular carteira"):
+            try:
+                regras = business_logic.recarregar_regras()
+                with st.spinner("Recalculando..."):
+                    resultado = business_logic.recalcular_carteira(regras)
+                st.success(f"Regras {resultado['versao']}: {resultado['alteradas']} de {resultado['total']} "
+                           f"empresas reclassificadas.")
+            except ValueError as e:
+                st.error(str(e))
+    
     # Filtros
     col_f1, col_f2 = st.columns(2)
     bairro_filter = col_f1.text_input("Filtrar por Bairro:", placeholder="Ex: Centro")
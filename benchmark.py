@@ -0,0 +1,171 @@
+"""
+Benchmarks do pipeline da Receita.
+Uso:
+    python benchmark.py filtro [linhas]
+    python benchmark.py parser [registros]
+    python benchmark.py analise [empresas]
+"""
+import io
+import random
+import sys
+import time
+import zipfile
+
+from datetime import datetime
+
+import pandas as pd
+
+import business_logic
+import gerar_dados_sinteticos
+import receita_worker
+import search_engine
+
+CODIGO_ALVO = "1387"  # TOM de Iguatu
+
+def gerar_estabelecimentos_sinteticos(n_linhas, taxa_match=0.001, seed=42):
+    """
+    Gera um CSV no layout de EstabelecimentosN (30 campos entre aspas, separados por ';', latin-1).
+    Aproximadamente `taxa_match` das linhas pertencem ao município alvo.
+    """
+    rnd = random.Random(seed)
+    linhas = []
+    for i in range(n_linhas):
+        cod = CODIGO_ALVO if rnd.random() < taxa_match else str(rnd.randint(1, 9999)).zfill(4)
+        campos = [
+            f"{i:08d}", "0001", f"{i % 100:02d}", "1", f"ESTABELECIMENTO {i} AÇÃO", "02", "20200101", "00",
+            "", "", "20180315", "4781400", "4782201,4789099", "RUA", "DOS EXEMPLOS", str(rnd.randint(1, 999)),
+            "", "CENTRO", "63500000", "CE", cod, "88", "35810000", "", "", "", "", "contato@exemplo.com", "", ""
+        ]
+        linhas.append(";".join(f'"{c}"' for c in campos))
+    return ("\n".join(linhas) + "\n").encode('latin-1')
+
+def _filtro_legado(f_in, codigo_municipio):
+    # Caminho antigo: decode + split + strip de todas as linhas
+    for line_bytes in f_in:
+        try:
+            line = line_bytes.decode('latin-1')
+            parts = line.split(';')
+            parts = [p.strip('"') for p in parts]
+            if len(parts) > 20 and parts[20] == codigo_municipio:
+                yield parts
+        except Exception:
+            continue
+
+def _medir(nome, funcao, alvo, dados_zip, n_linhas):
+    with zipfile.ZipFile(io.BytesIO(dados_zip)) as z:
+        with z.open(z.namelist()[0]) as f_in:
+            inicio = time.perf_counter()
+            encontrados = sum(1 for _ in funcao(f_in, alvo))
+            duracao = time.perf_counter() - inicio
+    print(f"{nome:<28} {duracao:8.2f}s {n_linhas / duracao:14,.0f} linhas/s  ({encontrados} encontrados)")
+    return duracao, encontrados
+
+def bench_filtro(n_linhas=2_000_000):
+    print(f"Gerando {n_linhas:,} linhas sintéticas de Estabelecimentos...")
+    csv_bytes = gerar_estabelecimentos_sinteticos(n_linhas)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr("K3241.K03200Y0.D00000.ESTABELE", csv_bytes)
+    dados_zip = buffer.getvalue()
+    print(f"CSV: {len(csv_bytes) / (1024*1024):.1f} MB | zip: {len(dados_zip) / (1024*1024):.1f} MB\n")
+
+    t_antes, n_antes = _medir("antes (decode por linha)", _filtro_legado, CODIGO_ALVO, dados_zip, n_linhas)
+    t_depois, n_depois = _medir("depois (pré-filtro bytes)", receita_worker.filtrar_linhas,
+                                {CODIGO_ALVO: ("IGUATU", "CE")}, dados_zip, n_linhas)
+
+    if n_antes != n_depois:
+        print(f"❌ Divergência: {n_antes} x {n_depois} linhas encontradas")
+    print(f"\nGanho: {t_antes / t_depois:.1f}x")
+
+def gerar_office_dtos(n, seed=42):
+    """Lista de OfficeDto sintéticos no formato da API do CNPJá (com 0 a 5 atividades secundárias)."""
+    rnd = random.Random(seed)
+    registros = []
+    for i in range(n):
+        registros.append({
+            "taxId": f"{i:014d}",
+            "alias": f"FANTASIA {i}" if rnd.random() < 0.7 else None,
+            "founded": f"20{rnd.randint(0, 25):02d}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}",
+            "company": {
+                "name": f"RAZAO {i} LTDA",
+                "equity": rnd.randint(1000, 5_000_000),
+                "size": {"id": 1, "text": rnd.choice(["Microempresa", "Empresa de Pequeno Porte", "Demais"])},
+                "nature": {"id": 2062, "text": "Sociedade Empresária Limitada"},
+                "members": [{"person": {"name": f"SOCIO {i} {j}"}} for j in range(rnd.randint(0, 3))],
+            },
+            "address": {"street": "Rua Exemplo", "number": str(rnd.randint(1, 999)), "district": "Centro",
+                        "city": "Iguatu", "state": "CE", "zip": "63500000"},
+            "phones": [{"area": "88", "number": f"9{rnd.randint(10000000, 99999999)}"}] if rnd.random() < 0.6 else [],
+            "mainActivity": {"id": rnd.randint(1000000, 9999999), "text": "Atividade principal"},
+            "sideActivities": [{"id": rnd.randint(1000000, 9999999), "text": f"Secundária {k}"} for k in range(rnd.randint(0, 5))],
+        })
+    return registros
+
+def _parser_por_registro(registros):
+    # Caminho atual: um dict por registro e o DataFrame montado no final (como no app.py)
+    return pd.DataFrame([search_engine.parse_cnpja_record(r) for r in registros])
+
+def bench_parser(n_registros=10_000, repeticoes=5):
+    registros = gerar_office_dtos(n_registros)
+    print(f"{n_registros:,} OfficeDto sintéticos, melhor de {repeticoes} execuções\n")
+
+    def melhor(funcao):
+        tempos = []
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            resultado = funcao(registros)
+            tempos.append(time.perf_counter() - inicio)
+        return min(tempos), resultado
+
+    t_antes, df_antes = melhor(_parser_por_registro)
+    t_depois, (df_depois, atividades) = melhor(search_engine.parse_cnpja_lote)
+    print(f"{'antes (parse_cnpja_record)':<28} {t_antes * 1000:8.1f}ms {n_registros / t_antes:14,.0f} registros/s")
+    print(f"{'depois (parse_cnpja_lote)':<28} {t_depois * 1000:8.1f}ms {n_registros / t_depois:14,.0f} registros/s")
+
+    colunas = search_engine.COLUNAS_LOTE_CNPJA
+    # parse_cnpja_lote guarda os valores Python como vieram (colunas object)
+    if not df_antes[colunas].astype(object).equals(df_depois[colunas]):
+        print("❌ Divergência entre os dois caminhos")
+    n_secundarias = int(df_antes["cnaes_secundarios"].map(len).sum())
+    if n_secundarias != len(atividades):
+        print(f"❌ Secundárias: {n_secundarias} x {len(atividades)} linhas na tabela filha")
+    print(f"\nGanho: {t_antes / t_depois:.1f}x ({len(atividades):,} atividades secundárias na tabela filha)")
+
+COLUNAS_ANALISE = ["grupo_id", "grupo_descricao", "status_radar", "acao_recomendada", "tag_risco",
+                   "porte_calculado", "porte_receita", "status_taxa"]
+
+def bench_analise(n_empresas=30_000, repeticoes=3):
+    referencia = datetime(2025, 1, 15, 12, 0)
+    empresas = list(gerar_dados_sinteticos.gerar_empresas(n_empresas, seed=42, data_referencia=referencia))
+    df = pd.DataFrame(empresas)
+    print(f"{n_empresas:,} empresas sintéticas (uma cidade), melhor de {repeticoes} execuções\n")
+
+    def melhor(funcao):
+        tempos = []
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            resultado = funcao()
+            tempos.append(time.perf_counter() - inicio)
+        return min(tempos), resultado
+
+    t_antes, lista = melhor(lambda: business_logic.analisar_leads(empresas, data_referencia=referencia))
+    t_depois, df_depois = melhor(lambda: business_logic.analisar_leads_df(df, data_referencia=referencia))
+    print(f"{'antes (analisar_leads)':<28} {t_antes * 1000:8.1f}ms {n_empresas / t_antes:14,.0f} empresas/s")
+    print(f"{'depois (analisar_leads_df)':<28} {t_depois * 1000:8.1f}ms {n_empresas / t_depois:14,.0f} empresas/s")
+
+    df_antes = pd.DataFrame(lista)[COLUNAS_ANALISE].astype(str)
+    divergentes = (df_antes != df_depois[COLUNAS_ANALISE].astype(str)).any(axis=1).sum()
+    if divergentes:
+        print(f"❌ {divergentes} linhas com resultado diferente entre os dois caminhos")
+    print(f"\nGanho: {t_antes / t_depois:.1f}x")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("filtro", "parser", "analise"):
+        print(__doc__)
+        sys.exit(1)
+    if sys.argv[1] == "filtro":
+        bench_filtro(int(sys.argv[2]) if len(sys.argv) > 2 else 2_000_000)
+    elif sys.argv[1] == "parser":
+        bench_parser(int(sys.argv[2]) if len(sys.argv) > 2 else 10_000)
+    elif sys.argv[1] == "analise":
+        bench_analise(int(sys.argv[2]) if len(sys.argv) > 2 else 30_000)
@@ -1,43 +1,214 @@
+import bisect
+import json
+import os
+import re
 from datetime import datetime
 
 import cnae_mapping
 
-def analisar_leads(empresas, mapa_cnaes_completo=None):
+def _codigo_int(cnae):
+    # "4781-4/00", "4781400" ou "4781-4/00 - Texto" -> 4781400 (None se não for um código)
+    codigo = str(cnae).split(" - ")[0].replace("-", "").replace("/", "").strip()
+    return int(codigo) if codigo.isdigit() else None
+
+class ClassificadorCNAE:
+    """
+    Índices do mapa Lei -> CNAE montados uma vez:
+    - código CNAE (int) -> grupo; CNAE repetido em dois grupos fica com o último do mapa;
+    - uma única regex com todas as palavras-chave (lookahead, então acha inclusive as que se
+      sobrepõem), em ordem de grupo: vale o primeiro grupo do mapa com alguma palavra na descrição.
+    """
+
+    def __init__(self, mapa_cnaes):
+        self.descricoes = {grp_id: info['descricao'] for grp_id, info in mapa_cnaes.items()}
+        self.por_codigo = {}
+        for grp_id, info in mapa_cnaes.items():
+            grupo = {"id": grp_id, "desc": info['descricao']}
+            for cnae in info['cnaes']:
+                codigo = _codigo_int(cnae)
+                if codigo is not None:
+                    self.por_codigo[codigo] = grupo
+
+        self.grupos_keyword = []
+        posicao_keyword = {}
+        for grp_id, info in mapa_cnaes.items():
+            for keyword in info.get("keywords", []):
+                posicao_keyword.setdefault(keyword.lower(), len(self.grupos_keyword))
+            if info.get("keywords"):
+                self.grupos_keyword.append({"id": grp_id, "desc": info['descricao']})
+        ordem = sorted(posicao_keyword, key=posicao_keyword.get)
+        self.rank_keyword = posicao_keyword
+        self.regex_keywords = re.compile("(?=(" + "|".join(map(re.escape, ordem)) + "))") if ordem else None
+
+    def grupo_por_codigos(self, cnaes):
+        """Grupo do primeiro CNAE da lista que pertence à Lei (None se nenhum)."""
+        for cnae in cnaes:
+            codigo = _codigo_int(cnae)
+            if codigo is not None and codigo in self.por_codigo:
+                return self.por_codigo[codigo]
+        return None
+
+    def grupo_por_descricao(self, descricao):
+        """Grupo pelas palavras-chave na descrição do CNAE (None se nenhuma aparecer)."""
+        if self.regex_keywords is None or not descricao:
+            return None
+        ranks = [self.rank_keyword[m] for m in self.regex_keywords.findall(str(descricao).lower())]
+        return self.grupos_keyword[min(ranks)] if ranks else None
+
+    def classificar(self, emp):
+        """Grupo da Lei de uma empresa: código (principal, depois secundários) e, sem código, palavra-chave."""
+        cnaes = [str(emp.get('cnae_fiscal_principal', ''))]
+        sec = emp.get('cnaes_secundarios', [])
+        if isinstance(sec, list):
+            cnaes.extend(str(s) for s in sec if s)
+        return self.grupo_por_codigos(c for c in cnaes if c) or self.grupo_por_descricao(emp.get('cnae_fiscal_descricao', ''))
+
+CLASSIFICADOR_CNAE = ClassificadorCNAE(cnae_mapping.LEI_TO_CNAE)
+
+def classificador_cnae(mapa_cnaes=None):
+    """Classificador do mapa da Lei (o montado na importação) ou de um mapa alternativo."""
+    if mapa_cnaes is None or mapa_cnaes is cnae_mapping.LEI_TO_CNAE:
+        return CLASSIFICADOR_CNAE
+    return ClassificadorCNAE(mapa_cnaes)
+
+def gerar_link_rota(emp, municipio=None, uf=None):
+    """
+    Link do Google Maps para o endereço do lead (vazio se não houver logradouro).
+    Cidade/UF: os informados ou, na falta deles, os do próprio lead.
+    """
+    if not emp.get('logradouro'):
+        return ""
+    municipio = municipio or emp.get('municipio') or ""
+    uf = uf or emp.get('uf') or ""
+    partes = [emp.get('logradouro', ''), emp.get('numero', ''), emp.get('bairro', ''), municipio, uf]
+    return "https://www.google.com/maps/search/?api=1&query=" + "+".join(
+        str(p).strip().replace(' ', '+') for p in partes if p and str(p).strip())
+
+# --- REGRAS DE PORTE (ANEXO II) E TAXA (ART. 16) ---
+# Tabela declarativa em regras_porte.json (versionada): mudou a lei, muda o arquivo.
+# Cada critério é uma lista ordenada de limites; o nível é quantos limites ficam abaixo do
+# valor (bisect_left = "valor <= limite" cai naquela faixa) e o porte é o maior nível.
+REGRAS_PORTE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regras_porte.json")
+CRITERIOS_PORTE = ("faturamento", "funcionarios", "area_m2", "area_ha")
+
+class RegrasPorte:
+    """Regras de porte/taxa validadas e prontas para avaliar (uma linha ou colunas inteiras)."""
+
+    def __init__(self, config):
+        try:
+            self.versao = str(config["versao"])
+            self.portes = list(config["portes"])
+            if not self.portes:
+                raise ValueError("Regras de porte inválidas: 'portes' está vazio.")
+            self.criterios = [self._criterio(c) for c in config["criterios"]]
+            lote = config.get("loteamento") or {}
+            self.cnaes_loteamento = {str(c).replace("-", "").replace("/", "") for c in lote.get("cnaes", [])}
+            self.criterio_loteamento = self._criterio(lote) if self.cnaes_loteamento else None
+            isencao = config.get("isencao_taxa") or {}
+            self.portes_isentos = set(isencao.get("portes", []))
+            self.natureza_isenta = [t.upper() for t in isencao.get("natureza_contem", [])]
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Regras de porte inválidas: campo ausente ou mal formado ({e}).")
+        if not self.criterios:
+            raise ValueError("Regras de porte inválidas: 'criterios' está vazio (todas as empresas cairiam no menor porte).")
+        desconhecidos = self.portes_isentos - set(self.portes)
+        if desconhecidos:
+            raise ValueError(f"Regras de porte inválidas: isenção cita portes inexistentes {sorted(desconhecidos)}.")
+
+    def _criterio(self, c):
+        nome, limites = c["criterio"], [float(v) for v in c["limites"]]
+        if nome not in CRITERIOS_PORTE:
+            raise ValueError(f"Regras de porte inválidas: critério desconhecido '{nome}'.")
+        if len(limites) != len(self.portes) - 1 or any(a >= b for a, b in zip(limites, limites[1:])):
+            raise ValueError(f"Regras de porte inválidas: '{nome}' precisa de {len(self.portes) - 1} limites crescentes.")
+        return nome, limites, bool(c.get("somente_positivo", False))
+
+    @staticmethod
+    def _nivel(limites, valor):
+        return len(limites) if valor != valor else bisect.bisect_left(limites, valor)  # NaN: último
+
+    def porte(self, valores, cnae_principal=""):
+        """Porte de uma empresa. `valores`: {"faturamento", "funcionarios", "area_m2", "area_ha"}."""
+        if self.criterio_loteamento and str(cnae_principal).replace("-", "").replace("/", "") in self.cnaes_loteamento:
+            nome, limites, _ = self.criterio_loteamento
+            return self.portes[self._nivel(limites, valores[nome])]
+        nivel = 0
+        for nome, limites, somente_positivo in self.criterios:
+            if somente_positivo and not valores[nome] > 0:
+                continue
+            nivel = max(nivel, self._nivel(limites, valores[nome]))
+        return self.portes[nivel]
+
+    def niveis(self, valores, loteamento):
+        """Versão em colunas de `porte`: arrays de valores por critério + máscara de loteamento -> níveis."""
+        import numpy as np
+
+        nivel = np.zeros(len(loteamento), dtype=np.int64)
+        for nome, limites, somente_positivo in self.criterios:
+            n = np.searchsorted(limites, valores[nome], side="left")
+            nivel = np.maximum(nivel, np.where(valores[nome] > 0, n, 0) if somente_positivo else n)
+        if self.criterio_loteamento:
+            nome, limites, _ = self.criterio_loteamento
+            nivel = np.where(loteamento, np.searchsorted(limites, valores[nome], side="left"), nivel)
+        return nivel
+
+    def isento(self, porte, natureza):
+        """Art. 16: isento pelo porte ou pela natureza jurídica (MEI)."""
+        natureza = str(natureza).upper()
+        return porte in self.portes_isentos or any(t in natureza for t in self.natureza_isenta)
+
+def carregar_regras(caminho=None):
+    """Lê e valida a tabela de regras (padrão: regras_porte.json ao lado deste arquivo)."""
+    caminho = caminho or REGRAS_PORTE_PATH
+    try:
+        with open(caminho, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Regras de porte inválidas em {caminho}: {e}")
+    return RegrasPorte(config)
+
+REGRAS_PORTE = carregar_regras()
+
+def recarregar_regras(caminho=None):
+    """Troca as regras em uso (depois de editar o arquivo); regras inválidas não substituem as atuais."""
+    global REGRAS_PORTE
+    REGRAS_PORTE = carregar_regras(caminho)
+    return REGRAS_PORTE
+
+def _funcionarios(func_raw):
+    # "10-50" -> 50 (faixa: usa o limite de cima); número ou texto numérico -> int; resto -> 0
+    try:
+        if isinstance(func_raw, str) and '-' in func_raw:
+            return int(func_raw.split('-')[1])
+        return int(func_raw)
+    except:
+        return 0
+
+def _numero(valor):
+    # Mesma leitura de analisar_leads_df (pd.to_numeric + fillna(0)): None, NaN e texto não numérico -> 0
+    try:
+        numero = float(valor)
+    except (TypeError, ValueError):
+        return 0
+    return 0 if numero != numero else numero
+
+def analisar_leads(empresas, mapa_cnaes_completo=None, data_referencia=None, regras=None):
     """
     Aplica as regras de negócio:
     - Identifica automaticamente a qual Grupo da Lei a empresa pertence.
     - Filtro 1: Licenciamento Inicial (< 120 dias)
     - Filtro 2: RAMA (> 1 ano)
     - Risco: Grupos 03.00 e 23.00
+    Os dias desde a abertura contam até `data_referencia` (padrão: agora).
+    Porte e isenção seguem `regras` (padrão: REGRAS_PORTE, de regras_porte.json).
+    Para lotes grandes (cidade inteira), ver analisar_leads_df.
     """
-    if mapa_cnaes_completo is None:
-        mapa_cnaes_completo = cnae_mapping.LEI_TO_CNAE
-        
+    classificador = classificador_cnae(mapa_cnaes_completo)
+    regras = regras or REGRAS_PORTE
+    hoje = data_referencia or datetime.now()
     leads_processados = []
-    
-    # Preparar índice reverso para busca rápida: CNAE -> Grupo
-    cnae_to_group = {}
-    for grp_id, info in mapa_cnaes_completo.items():
-        for cnae in info['cnaes']:
-            # Normalizar para comparar (sem pontuacao)
-            cnae_clean = cnae.replace("-", "").replace("/", "")
-            cnae_to_group[cnae_clean] = {"id": grp_id, "desc": info['descricao']}
-            cnae_to_group[cnae] = {"id": grp_id, "desc": info['descricao']} # Manter com pontuacao tbm
-            
+
     for emp in empresas:
-        # --- 1. CONSOLIDAR LISTA DE CNAES (PRINCIPAL + SECUNDÁRIOS) ---
-        lista_cnaes_empresa = []
-        
-        # Principal
-        p = str(emp.get('cnae_fiscal_principal', ''))
-        if p: lista_cnaes_empresa.append(p)
-        
-        # Secundários
-        sec = emp.get('cnaes_secundarios', [])
-        if isinstance(sec, list):
-            for s in sec:
-                if s: lista_cnaes_empresa.append(str(s))
-        
         # Variáveis de Estado
         status = "Sem Licenciamento Obrigatório"
         acao = "Ignorar"
@@ -45,36 +216,11 @@ def analisar_leads(empresas, mapa_cnaes_completo=None):
         grupo_id = "N/A"
         grupo_desc = "Outros"
         porte_calculado = "Não Classificado"
+        porte_receita = emp.get('porte_receita', 'Não Informado') # ME, EPP, DEMAIS (Apenas informativo)
         status_taxa = "Em Análise" # Novo campo
         
-        # --- 2. BUSCA INTELIGENTE DE GRUPO (Match por Código OU Palavra-Chave) ---
-        grupo_encontrado = None
-        
-        # Estratégia A: Match Exato de Código (Mais Rápido e Seguro)
-        # Estratégia A: Match Exato de Código (Mais Rápido e Seguro)
-        for cnae_teste in lista_cnaes_empresa:
-            # Se vier no formato "CODIGO - TEXTO", pega só o código
-            cnae_only = cnae_teste.split(" - ")[0]
-            cnae_clean = cnae_only.replace("-", "").replace("/", "").strip()
-            
-            match = cnae_to_group.get(cnae_only) or cnae_to_group.get(cnae_clean)
-            if match:
-                grupo_encontrado = match
-                break
-        
-        # Estratégia B: Match por Palavra-Chave (Se falhar a A)
-        # Varre a descrição do CNAE (se houver) em busca das keywords definidas no mapa
-        if not grupo_encontrado:
-            descricao_cnae_completa = str(emp.get('cnae_fiscal_descricao', '')).lower()
-            
-            # Percorre todos os grupos para checar keywords
-            for grp_id, info in mapa_cnaes_completo.items():
-                if "keywords" in info:
-                    for keyword in info["keywords"]:
-                        if keyword.lower() in descricao_cnae_completa:
-                            grupo_encontrado = {"id": grp_id, "desc": info["descricao"]}
-                            break # Encontrou palavra-chave, define grupo
-                if grupo_encontrado: break
+        # --- GRUPO DA LEI (código CNAE; sem código da Lei, palavra-chave na descrição) ---
+        grupo_encontrado = classificador.classificar(emp)
         
         if grupo_encontrado:
             grupo_id = grupo_encontrado["id"]
@@ -84,84 +230,20 @@ def analisar_leads(empresas, mapa_cnaes_completo=None):
             if grupo_id == "06.00" and "veículos" in str(emp.get('cnae_fiscal_descricao','')).lower():
                 tag_risco = "Atenção: Verificar Oficina/Lavagem Anexa"
             
-            # --- CÁLCULO DE PORTE (ANEXO II) ---
             # --- CÁLCULO DE PORTE (ANEXO II - AMBIENTAL) ---
             # Este é o porte para fins de LICENCIAMENTO (COEMA/Municipal), não o da Receita.
-            # Baseado em Potencial Poluidor x Porte (M, P, M, G, E)
-            
-            porte_receita = emp.get('porte_receita', 'Não Informado') # ME, EPP, DEMAIS (Apenas informativo)
-            
-            # Cálculo Técnico (Estimativa para Licenciamento)
-            # 1. Obter parâmetros (com valores default 0)
-            area_m2 = emp.get('area_construida', 0) 
-            faturamento = emp.get('faturamento_estimado') or emp.get('capital_social') or 0
-            
-            # Tentar processar funcionários
-            funcionarios = 0
-            try:
-                func_raw = emp.get('qtde_funcionarios', 0)
-                if isinstance(func_raw, str) and '-' in func_raw:
-                    funcionarios = int(func_raw.split('-')[1])
-                else:
-                    funcionarios = int(func_raw)
-            except:
-                funcionarios = 0
-
-            # Lógica de Loteamentos
-            p_cnae_safe = str(emp.get('cnae_fiscal_principal', ''))
-            cnae_check_lote = p_cnae_safe.replace("-", "").replace("/", "")
-            is_loteamento = cnae_check_lote in ["4213800", "4110700", "6810203"]
-
-            # Lógica de Loteamentos (Mantida)
-            if is_loteamento:
-                area_ha = area_m2 / 10000.0 
-                if area_ha <= 10: porte_calculado = "Micro"
-                elif area_ha <= 30: porte_calculado = "Pequeno"
-                elif area_ha <= 50: porte_calculado = "Médio"
-                elif area_ha <= 100: porte_calculado = "Grande"
-                else: porte_calculado = "Excepcional"
-            else:
-                # Tabela 1 - Regra Geral
-                # Definição dos Limites (Estimativa baseada em Faturamento/Funcionários como proxy de magnitude)
-                L_MIC_FAT = 575000
-                L_PEQ_FAT = 1150000
-                L_MED_FAT = 11500000
-                L_GRA_FAT = 85500000
-                
-                portes = []
-                
-                if faturamento <= L_MIC_FAT: portes.append(1)
-                elif faturamento <= L_PEQ_FAT: portes.append(2)
-                elif faturamento <= L_MED_FAT: portes.append(3)
-                elif faturamento <= L_GRA_FAT: portes.append(4)
-                else: portes.append(5)
-                
-                if funcionarios <= 7: portes.append(1)
-                elif funcionarios <= 50: portes.append(2)
-                elif funcionarios <= 100: portes.append(3)
-                elif funcionarios <= 500: portes.append(4)
-                else: portes.append(5)
-                
-                if area_m2 > 0:
-                    if area_m2 <= 250: portes.append(1)
-                    elif area_m2 <= 1000: portes.append(2)
-                    elif area_m2 <= 5000: portes.append(3)
-                    elif area_m2 <= 10000: portes.append(4)
-                    else: portes.append(5)
-                
-                max_porte = max(portes)
-                mapa_nomes = {1:"Micro", 2:"Pequeno", 3:"Médio", 4:"Grande", 5:"Excepcional"}
-                porte_calculado = mapa_nomes[max_porte]
+            # Faturamento/funcionários/área como proxy de magnitude; loteamentos pela área em hectares.
+            area_m2 = _numero(emp.get('area_construida', 0))
+            faturamento = _numero(emp.get('faturamento_estimado')) or _numero(emp.get('capital_social'))
+            funcionarios = _funcionarios(emp.get('qtde_funcionarios', 0))
+            porte_calculado = regras.porte(
+                {"faturamento": faturamento, "funcionarios": funcionarios,
+                 "area_m2": area_m2, "area_ha": area_m2 / 10000.0},
+                emp.get('cnae_fiscal_principal', ''))
             
             # --- CÁLCULO DA TAXA (ART. 16 - LEI 2.917) ---
-            natureza = str(emp.get('natureza_juridica', '')).upper()
-            
-            # Se for Microempresa (Porte Lido ou Calculado como Micro) OU MEI
-            # Nota: O porte_calculado é nossa melhor estimativa técnica
-            is_mei = "MEI" in natureza or "MICROEMPREENDEDOR" in natureza
-            is_micro = porte_calculado == "Micro"
-            
-            if is_mei or is_micro:
+            # Microempresa (porte calculado, nossa melhor estimativa técnica) ou MEI
+            if regras.isento(porte_calculado, emp.get('natureza_juridica', '')):
                 status_taxa = "ISENTO (Art. 16)"
             else:
                 status_taxa = "Sujeito a Taxa (Anexo II)"
@@ -173,7 +255,6 @@ def analisar_leads(empresas, mapa_cnaes_completo=None):
                 data_inicio = emp.get('data_inicio_atividade')
                 if data_inicio:
                     data_abertura = datetime.strptime(data_inicio, "%Y-%m-%d")
-                    hoje = datetime.now()
                     dias_abertura = (hoje - data_abertura).days
                     
                     if dias_abertura <= 120:
@@ -210,6 +291,7 @@ def analisar_leads(empresas, mapa_cnaes_completo=None):
         emp_enriquecida['porte_calculado'] = porte_calculado # Ambiental
         emp_enriquecida['porte_receita'] = porte_receita     # CNPJ
         emp_enriquecida['status_taxa'] = status_taxa
+        emp_enriquecida['versao_regras'] = regras.versao
         
         # Garantir campos de UI para evitar KeyError
         for campo in ['bairro', 'logradouro', 'numero', 'cep', 'telefone', 'qsa', 'cnaes_secundarios']:
@@ -219,3 +301,233 @@ def analisar_leads(empresas, mapa_cnaes_completo=None):
         leads_processados.append(emp_enriquecida)
         
     return leads_processados
+
+# --- ANÁLISE EM LOTE (DataFrame) ---
+# Mesmas regras de analisar_leads, coluna a coluna (limites de porte via RegrasPorte.niveis).
+_CAMPOS_UI = ['bairro', 'logradouro', 'numero', 'cep', 'telefone', 'qsa', 'cnaes_secundarios']
+
+def _ausente(serie):
+    # Chave que faltava no dict de origem: o DataFrame preenche com NaN (em colunas object,
+    # None explícito continua sendo None)
+    faltando = serie.isna()
+    if serie.dtype == object and faltando.any():
+        faltando[faltando] = [isinstance(v, float) for v in serie[faltando]]
+    return faltando
+
+def _coluna(df, nome, padrao):
+    # Equivalente a emp.get(nome, padrao) para todas as linhas
+    import pandas as pd
+
+    if nome not in df:
+        return pd.Series([padrao] * len(df), index=df.index, dtype=object)
+    serie = df[nome]
+    faltando = _ausente(serie)
+    return serie.astype(object).where(~faltando, padrao) if faltando.any() else serie
+
+def _por_valor(serie, funcao):
+    # funcao(valor) avaliada uma vez por valor distinto da coluna (CNAEs, naturezas e descrições
+    # se repetem muito) e espalhada de volta para as linhas
+    import numpy as np
+    import pandas as pd
+
+    posicoes, unicos = pd.factorize(serie)
+    resultados = np.empty(len(unicos) + 1, dtype=object)
+    resultados[:-1] = [funcao(v) for v in unicos]
+    resultados[-1] = funcao(None)  # posição -1: vazio
+    return resultados[posicoes]
+
+def _str_cnae(valor):
+    # str(valor) do laço; inteiro que o DataFrame virou float (coluna com vazios) volta a inteiro
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return str(valor)
+
+def _grupos_df(df, classificador):
+    # Id do grupo da Lei por linha (None sem grupo), na mesma ordem de ClassificadorCNAE.classificar
+    import numpy as np
+    import pandas as pd
+
+    def grupo_do_codigo(cnae):
+        g = classificador.grupo_por_codigos([_str_cnae(cnae)]) if cnae is not None else None
+        return g["id"] if g else None
+
+    grupo = _por_valor(_coluna(df, 'cnae_fiscal_principal', ''), grupo_do_codigo)
+    if 'cnaes_secundarios' in df:
+        # Secundárias "explodidas" (uma linha por CNAE, na ordem); vale a primeira da Lei
+        posicoes, codigos = [], []
+        listas = df['cnaes_secundarios'].to_numpy(dtype=object)
+        for posicao in np.flatnonzero(pd.isna(grupo)):
+            if isinstance(listas[posicao], list):
+                for cnae in listas[posicao]:
+                    if cnae:
+                        posicoes.append(posicao)
+                        codigos.append(str(cnae))
+        if codigos:
+            por_codigo = _por_valor(pd.Series(codigos, dtype=object), grupo_do_codigo)
+            for posicao, g in zip(reversed(posicoes), reversed(por_codigo)):
+                if g is not None:
+                    grupo[posicao] = g  # de trás para frente: a primeira da lista é a que fica
+    sem_grupo = pd.isna(grupo)
+    if sem_grupo.any():
+        # Palavra-chave na descrição
+        def grupo_da_descricao(d):
+            g = classificador.grupo_por_descricao(d)
+            return g["id"] if g else None
+        grupo[sem_grupo] = _por_valor(_coluna(df, 'cnae_fiscal_descricao', '')[sem_grupo], grupo_da_descricao)
+    return grupo
+
+def _dias_abertura(datas, referencia):
+    # Dias desde a abertura (float, NaN se a data for inválida) e máscara das vazias
+    import numpy as np
+    import pandas as pd
+
+    if datas.dtype == object:
+        vazia = np.array([not v for v in datas], dtype=bool)
+        texto = datas.where(np.array([isinstance(v, str) for v in datas], dtype=bool))
+    else:
+        vazia = (datas.isna() | (datas == "")).to_numpy(dtype=bool)
+        texto = datas.astype(object).where(datas.notna())
+    convertidas = pd.to_datetime(texto, format="%Y-%m-%d", errors="coerce").to_numpy("datetime64[us]")
+    validas = ~np.isnat(convertidas)
+    dias = np.full(len(datas), np.nan)
+    dias[validas] = (np.datetime64(referencia, "us") - convertidas[validas]) // np.timedelta64(1, "D")
+
+    # O que o pandas recusou passa pelo strptime do laço (só confirma a recusa; sai barato)
+    resto = ~vazia & ~validas & texto.notna().to_numpy()
+    for posicao in np.flatnonzero(resto):
+        try:
+            dias[posicao] = (referencia - datetime.strptime(texto.iat[posicao], "%Y-%m-%d")).days
+        except ValueError:
+            pass
+    return dias, vazia
+
+def analisar_leads_df(df, mapa_cnaes_completo=None, data_referencia=None, regras=None):
+    """
+    Versão em lote de analisar_leads para DataFrames (ex.: a extração inteira de uma cidade):
+    grupo, porte, taxa, status e risco calculados como operações de coluna, com uma única
+    data de referência (padrão: agora). Dá o mesmo resultado de analisar_leads linha a linha
+    para as mesmas empresas (células NaN contam como chave ausente no dict).
+    Retorna uma cópia de `df` com as colunas do analisar_leads.
+    """
+    import numpy as np
+    import pandas as pd
+
+    classificador = classificador_cnae(mapa_cnaes_completo)
+    referencia = data_referencia or datetime.now()
+    regras = regras or REGRAS_PORTE
+    n = len(df)
+
+    grupo = _grupos_df(df, classificador)
+    tem_grupo = ~pd.isna(grupo)
+    grupo_id = np.where(tem_grupo, grupo, "N/A")
+    grupo_desc = np.array([classificador.descricoes[g] if g else "Outros" for g in grupo], dtype=object)
+
+    # Porte (Anexo II); faturamento = estimado or capital or 0 (0 e vazio passam para o próximo)
+    area_m2 = pd.to_numeric(_coluna(df, 'area_construida', 0), errors="coerce").fillna(0).to_numpy(dtype=float)
+    estimado = pd.to_numeric(_coluna(df, 'faturamento_estimado', 0), errors="coerce").fillna(0).to_numpy(dtype=float)
+    capital = pd.to_numeric(_coluna(df, 'capital_social', 0), errors="coerce").fillna(0).to_numpy(dtype=float)
+    faturamento = np.where(estimado != 0, estimado, capital)
+    funcionarios = _por_valor(_coluna(df, 'qtde_funcionarios', 0), _funcionarios).astype(float)
+    loteamento = _por_valor(_coluna(df, 'cnae_fiscal_principal', ''),
+                            lambda c: _str_cnae(c).replace("-", "").replace("/", "") in regras.cnaes_loteamento).astype(bool)
+    nivel = regras.niveis({"faturamento": faturamento, "funcionarios": funcionarios,
+                           "area_m2": area_m2, "area_ha": area_m2 / 10000.0}, loteamento)
+    porte = np.where(tem_grupo, np.array(regras.portes, dtype=object)[nivel], "Não Classificado")
+    micro = tem_grupo & (porte == "Micro")
+
+    # Taxa (Art. 16)
+    isento = np.isin(porte, list(regras.portes_isentos)) | _por_valor(
+        _coluna(df, 'natureza_juridica', ''), lambda v: regras.isento(None, v)).astype(bool)
+    status_taxa = np.select([~tem_grupo, isento], ["Em Análise", "ISENTO (Art. 16)"], "Sujeito a Taxa (Anexo II)")
+
+    # Status pela data de abertura; data inválida interrompe antes do risco (como o try do laço)
+    dias, vazia = _dias_abertura(_coluna(df, 'data_inicio_atividade', None), referencia)
+    invalida = ~vazia & np.isnan(dias)
+    status = np.select(
+        [~tem_grupo, vazia, invalida, dias <= 120, dias > 365],
+        ["Sem Licenciamento Obrigatório", "Data Indisponível", "Data Inválida",
+         "Oportunidade de Licenciamento Inicial (LP/LI)", "Venda Recorrente (RAMA)"],
+        "Monitoramento Padrão")
+    acao = np.select(
+        [~tem_grupo | vazia | invalida, dias <= 120, dias > 365],
+        ["Ignorar", "Contatar para Licenciamento", "Oferecer Renovação/Monitoramento"],
+        "Verificar Regularidade")
+
+    # Risco
+    veiculos = (grupo_id == "06.00") & _por_valor(_coluna(df, 'cnae_fiscal_descricao', ''),
+                                                  lambda v: "veículos" in str(v).lower()).astype(bool)
+    alto = tem_grupo & ~invalida & np.isin(grupo_id, ["03.00", "23.00"])
+    tag = np.select([alto, veiculos, micro & ~invalida],
+                    ["ALTO POTENCIAL", "Atenção: Verificar Oficina/Lavagem Anexa", "BAIXO IMPACTO"], "")
+
+    saida = df.copy(deep=False)
+    saida['grupo_id'] = grupo_id
+    saida['grupo_descricao'] = grupo_desc
+    saida['status_radar'] = status
+    saida['acao_recomendada'] = acao
+    saida['tag_risco'] = tag
+    saida['porte_calculado'] = porte
+    saida['porte_receita'] = _coluna(df, 'porte_receita', 'Não Informado').to_numpy()
+    saida['status_taxa'] = status_taxa
+    saida['versao_regras'] = regras.versao
+    # Campos de UI que faltarem: "" (ou lista vazia nas secundárias), como no laço
+    for campo in _CAMPOS_UI:
+        if campo not in saida:
+            saida[campo] = [[] if campo == 'cnaes_secundarios' else "" for _ in range(n)]
+        elif _ausente(saida[campo]).any():
+            faltando = _ausente(saida[campo])
+            saida[campo] = [([] if campo == 'cnaes_secundarios' else "") if f else v
+                            for v, f in zip(saida[campo].astype(object), faltando)]
+    return saida
+
+# --- RECÁLCULO DA CARTEIRA (mudança de regras) ---
+COLUNAS_RECALCULO = {
+    # coluna da tabela empresas -> campo calculado
+    "grupo_atividade": "grupo_descricao",
+    "risco": "tag_risco",
+    "porte": "porte_calculado",
+    "status_taxa": "status_taxa",
+}
+CAMPOS_RECALCULADOS = ['grupo_id', 'grupo_descricao', 'status_radar', 'acao_recomendada', 'tag_risco',
+                       'porte_calculado', 'porte_receita', 'status_taxa', 'versao_regras']
+
+def recalcular_carteira(regras=None, data_referencia=None):
+    """
+    Reclassifica a carteira inteira com `regras` (padrão: REGRAS_PORTE) a partir do
+    lead guardado em dados_extra, em uma passada de analisar_leads_df.
+    Só grava as empresas cuja classificação ou versão de regras mudou.
+    Retorna {"versao", "total", "alteradas", "sem_dados"}.
+    """
+    import pandas as pd
+    import database
+
+    regras = regras or REGRAS_PORTE
+    carteira = database.get_carteira()
+    leads, atuais = [], []
+    for linha in carteira[["cnpj", "dados_extra", *COLUNAS_RECALCULO]].to_dict("records"):
+        try:
+            lead = json.loads(linha.get("dados_extra") or "")
+        except (TypeError, ValueError):
+            continue
+        if isinstance(lead, dict):
+            lead["cnpj"] = linha["cnpj"]
+            leads.append(lead)
+            atuais.append(linha)
+    resultado = {"versao": regras.versao, "total": len(carteira), "alteradas": 0, "sem_dados": len(carteira) - len(leads)}
+    if not leads:
+        return resultado
+
+    analisados = analisar_leads_df(pd.DataFrame(leads), data_referencia=data_referencia, regras=regras)
+    novos = {campo: analisados[campo].tolist() for campo in CAMPOS_RECALCULADOS}
+    alteradas = []
+    for i, (lead, atual) in enumerate(zip(leads, atuais)):
+        valores = {campo: novos[campo][i] for campo in CAMPOS_RECALCULADOS}
+        mudou = lead.get("versao_regras") != regras.versao or any(
+            str(atual.get(coluna) or "") != str(valores[campo]) for coluna, campo in COLUNAS_RECALCULO.items())
+        if mudou:
+            lead.update(valores)
+            linha = {coluna: valores[campo] for coluna, campo in COLUNAS_RECALCULO.items()}
+            linha.update(cnpj=lead["cnpj"], dados_extra=json.dumps(lead, default=str))
+            alteradas.append(linha)
+    resultado["alteradas"] = database.atualizar_classificacao_lote(alteradas)
+    return resultado
@@ -1,6 +1,8 @@
 
 import sqlite3
 import json
+import io
+import csv
 import logging
 from datetime import datetime
 import pandas as pd
@@ -19,6 +21,31 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DB_PATH = "radar.db"
+LOTE_PARAMETROS_SQLITE = 900  # SQLite antigo aceita no máximo 999 parâmetros por comando
+
+# Tabela de municípios (TOM da Receita <-> IBGE), montada pelo receita_worker.
+# codigo_ibge/uf ficam NULL quando o nome é ambíguo entre estados (ver construir_tabela_municipios).
+SQL_MUNICIPIOS = [
+    """
+    CREATE TABLE IF NOT EXISTS municipios (
+        codigo_tom TEXT PRIMARY KEY,
+        codigo_ibge TEXT,
+        nome TEXT,
+        nome_normalizado TEXT,
+        uf TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_municipios_ibge ON municipios (codigo_ibge)",
+    "CREATE INDEX IF NOT EXISTS idx_municipios_nome ON municipios (nome_normalizado, uf)",
+]
+
+# Créditos do CNPJá consumidos por mês ("AAAA-MM"), para o orçamento mensal do search_engine
+SQL_CREDITOS = """
+    CREATE TABLE IF NOT EXISTS creditos_api (
+        mes TEXT PRIMARY KEY,
+        consumidos INTEGER DEFAULT 0
+    )
+"""
 
 def get_connection():
     """
@@ -185,6 +212,9 @@ def init_db():
                 full_name TEXT
             )
         ''')
+        for sql in SQL_MUNICIPIOS:
+            c.execute(sql)
+        c.execute(SQL_CREDITOS)
         # Admin Default
         try:
             import hashlib
@@ -200,6 +230,27 @@ def init_db():
 
 # --- FUNÇÕES DE NEGÓCIO (Usando run_query Wrapper) ---
 
+# Coluna no banco -> chave no dict do lead (analisar_leads)
+CAMPOS_EMPRESA = [
+    ("razao_social", "razao_social"),
+    ("nome_fantasia", "nome_fantasia"),
+    ("grupo_atividade", "grupo_descricao"),
+    ("descricao_atividade", "cnae_fiscal_descricao"),
+    ("risco", "tag_risco"),
+    ("porte", "porte_calculado"),
+    ("status_taxa", "status_taxa"),
+    ("telefone", "telefone"),
+    ("qsa", "qsa"),
+    ("logradouro", "logradouro"),
+    ("numero", "numero"),
+    ("bairro", "bairro"),
+    ("municipio", "municipio"),
+    ("uf", "uf"),
+    ("cep", "cep"),
+    ("rota_link", "Rota"),
+    ("data_abertura", "data_inicio_atividade")
+]
+
 def upsert_empresa(dados_dict):
     cnpj = dados_dict.get('cnpj')
     if not cnpj: return "error"
@@ -222,25 +273,7 @@ def upsert_empresa(dados_dict):
             
         dados_extra = json.dumps(dados_dict, default=str)
         
-        fields_map = [
-            ("razao_social", "razao_social"),
-            ("nome_fantasia", "nome_fantasia"),
-            ("grupo_atividade", "grupo_descricao"),
-            ("descricao_atividade", "cnae_fiscal_descricao"),
-            ("risco", "tag_risco"),
-            ("porte", "porte_calculado"),
-            ("status_taxa", "status_taxa"),
-            ("telefone", "telefone"),
-            ("qsa", "qsa"),
-            ("logradouro", "logradouro"),
-            ("numero", "numero"),
-            ("bairro", "bairro"),
-            ("municipio", "municipio"),
-            ("uf", "uf"),
-            ("cep", "cep"),
-            ("rota_link", "Rota"),
-            ("data_abertura", "data_inicio_atividade")
-        ]
+        fields_map = CAMPOS_EMPRESA
         
         if existing:
             changes_detected = False
@@ -303,6 +336,195 @@ def upsert_empresa(dados_dict):
     finally:
         conn.close()
 
+def upsert_empresas_lote(lista_dados):
+    """
+    Versão em lote de upsert_empresa: uma única transação para a lista inteira.
+    - SQLite: executemany com INSERT ... ON CONFLICT DO UPDATE.
+    - Postgres: COPY para uma tabela temporária e um único INSERT ... SELECT ... ON CONFLICT.
+    Mesma regra do upsert unitário: valor vazio não apaga o que já existe, status_crm
+    não é tocado, e empresas sem mudança em dados_extra não são reescritas.
+    Retorna {"inserted": n, "updated": n, "skipped": n, "error": n}.
+    """
+    stats = {"inserted": 0, "updated": 0, "skipped": 0, "error": 0}
+
+    # Último registro vence se o mesmo CNPJ aparecer duas vezes no lote
+    por_cnpj = {}
+    for dados_dict in lista_dados:
+        if dados_dict.get('cnpj'):
+            por_cnpj[dados_dict['cnpj']] = dados_dict
+        else:
+            stats["error"] += 1
+    if not por_cnpj:
+        return stats
+
+    cols = [f[0] for f in CAMPOS_EMPRESA] + ["dados_extra", "cnpj"]
+    linhas = [
+        [d.get(f[1]) for f in CAMPOS_EMPRESA] + [json.dumps(d, default=str), cnpj]
+        for cnpj, d in por_cnpj.items()
+    ]
+
+    conn, db_type = get_connection()
+    try:
+        c = conn.cursor()
+
+        # Vazio não sobrescreve valor existente (igual ao upsert_empresa)
+        set_clause = ", ".join(
+            f"{col} = COALESCE(NULLIF(excluded.{col}, ''), empresas.{col})" for col, _ in CAMPOS_EMPRESA
+        ) + ", dados_extra = excluded.dados_extra, data_atualizacao = CURRENT_TIMESTAMP"
+
+        if db_type == "postgres":
+            # Tudo como texto no COPY; colunas da carteira são TEXT
+            c.execute("CREATE TEMP TABLE empresas_carga (LIKE empresas INCLUDING DEFAULTS) ON COMMIT DROP")
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(
+                [["" if v is None else str(v) for v in linha] for linha in linhas]
+            )
+            buffer.seek(0)
+            c.copy_expert(f"COPY empresas_carga ({','.join(cols)}) FROM STDIN WITH (FORMAT csv)", buffer)
+            # Novos = CNPJs do lote que ainda não estão na carteira (join pela PK, só o lote)
+            c.execute("""
+                SELECT COUNT(*) FROM empresas_carga t
+                WHERE NOT EXISTS (SELECT 1 FROM empresas e WHERE e.cnpj = t.cnpj)
+            """)
+            novos = c.fetchone()[0]
+            c.execute(f"""
+                INSERT INTO empresas ({','.join(cols)})
+                SELECT {','.join(cols)} FROM empresas_carga
+                ON CONFLICT (cnpj) DO UPDATE SET {set_clause}
+                WHERE empresas.dados_extra IS DISTINCT FROM excluded.dados_extra
+            """)
+        else:
+            # Novos = CNPJs do lote que ainda não estão na carteira (IN pela PK, em fatias
+            # abaixo do limite de parâmetros do SQLite)
+            cnpjs = list(por_cnpj)
+            existentes = 0
+            for i in range(0, len(cnpjs), LOTE_PARAMETROS_SQLITE):
+                fatia = cnpjs[i:i + LOTE_PARAMETROS_SQLITE]
+                c.execute(f"SELECT COUNT(*) FROM empresas WHERE cnpj IN ({','.join(['?'] * len(fatia))})", fatia)
+                existentes += c.fetchone()[0]
+            novos = len(cnpjs) - existentes
+            placeholders = ",".join(["?"] * len(cols))
+            c.executemany(f"""
+                INSERT INTO empresas ({','.join(cols)}) VALUES ({placeholders})
+                ON CONFLICT (cnpj) DO UPDATE SET {set_clause}
+                WHERE empresas.dados_extra IS NOT excluded.dados_extra
+            """, linhas)
+
+        # rowcount = inserts + updates efetivos
+        alterados = c.rowcount
+        conn.commit()
+
+        stats["inserted"] = novos
+        stats["updated"] = max(alterados - novos, 0)
+        stats["skipped"] = len(por_cnpj) - novos - stats["updated"]
+    except Exception as e:
+        logger.error(f"Erro Upsert Lote ({db_type}): {e}")
+        conn.rollback()
+        stats["error"] += len(por_cnpj)
+    finally:
+        conn.close()
+
+    return stats
+
+def atualizar_classificacao_lote(linhas):
+    """
+    Grava a reclassificação da carteira (mudança de regras) em uma transação.
+    `linhas`: dicts com cnpj, grupo_atividade, risco, porte, status_taxa e dados_extra (JSON).
+    Não mexe em status_crm nem nos dados cadastrais. Retorna quantas empresas foram atualizadas.
+    """
+    if not linhas:
+        return 0
+    conn, db_type = get_connection()
+    ph = "%s" if db_type == "postgres" else "?"
+    try:
+        c = conn.cursor()
+        c.executemany(f"""
+            UPDATE empresas SET grupo_atividade = {ph}, risco = {ph}, porte = {ph}, status_taxa = {ph},
+                   dados_extra = {ph}, data_atualizacao = CURRENT_TIMESTAMP
+            WHERE cnpj = {ph}
+        """, [(l["grupo_atividade"], l["risco"], l["porte"], l["status_taxa"], l["dados_extra"], l["cnpj"])
+              for l in linhas])
+        conn.commit()
+        return len(linhas)
+    except Exception as e:
+        logger.error(f"Erro ao reclassificar carteira ({db_type}): {e}")
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+# --- MUNICÍPIOS (TOM / IBGE) ---
+
+# Índices em memória da tabela municipios, carregados uma vez por processo
+_INDICE_MUNICIPIOS = None
+
+def salvar_municipios(linhas):
+    """
+    Substitui a tabela municipios inteira em uma transação.
+    `linhas`: dicts com codigo_tom, codigo_ibge, nome, nome_normalizado, uf.
+    """
+    global _INDICE_MUNICIPIOS
+    cols = ["codigo_tom", "codigo_ibge", "nome", "nome_normalizado", "uf"]
+    conn, db_type = get_connection()
+    try:
+        c = conn.cursor()
+        for sql in SQL_MUNICIPIOS:
+            c.execute(sql)
+        c.execute("DELETE FROM municipios")
+        placeholder = "%s" if db_type == "postgres" else "?"
+        c.executemany(
+            f"INSERT INTO municipios ({','.join(cols)}) VALUES ({','.join([placeholder] * len(cols))})",
+            [[l.get(col) for col in cols] for l in linhas]
+        )
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Erro ao salvar municípios ({db_type}): {e}")
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    _INDICE_MUNICIPIOS = None
+
+def indice_municipios(recarregar=False):
+    """
+    Tabela municipios como dicionários: {"tom": {codigo: linha}, "ibge": {codigo: linha},
+    "nome": {nome_normalizado: [linhas]}}. Vazio (tabela criada sem linhas) se ainda não foi montada.
+    """
+    global _INDICE_MUNICIPIOS
+    if _INDICE_MUNICIPIOS is None or recarregar:
+        indice = {"tom": {}, "ibge": {}, "nome": {}}
+        for sql in SQL_MUNICIPIOS:
+            run_query(sql, commit=True)
+        linhas = run_query("SELECT codigo_tom, codigo_ibge, nome, nome_normalizado, uf FROM municipios", fetch=True) or []
+        for linha in linhas:
+            m = dict(linha)
+            indice["tom"][m["codigo_tom"]] = m
+            if m["codigo_ibge"]:
+                indice["ibge"][m["codigo_ibge"]] = m
+            indice["nome"].setdefault(m["nome_normalizado"], []).append(m)
+        _INDICE_MUNICIPIOS = indice
+    return _INDICE_MUNICIPIOS
+
+def municipio_por_ibge(codigo_ibge):
+    return indice_municipios()["ibge"].get(str(codigo_ibge))
+
+def municipio_por_tom(codigo_tom):
+    return indice_municipios()["tom"].get(str(codigo_tom))
+
+# --- CRÉDITOS DE API ---
+
+def get_creditos_mes(mes):
+    """Créditos já consumidos no mês ("AAAA-MM")."""
+    run_query(SQL_CREDITOS, commit=True)
+    linhas = run_query("SELECT consumidos FROM creditos_api WHERE mes = ?", (mes,), fetch=True)
+    return linhas[0]["consumidos"] if linhas else 0
+
+def registrar_creditos(mes, quantidade):
+    run_query("""
+        INSERT INTO creditos_api (mes, consumidos) VALUES (?, ?)
+        ON CONFLICT (mes) DO UPDATE SET consumidos = creditos_api.consumidos + excluded.consumidos
+    """, (mes, quantidade), commit=True)
+
 def get_carteira(filtro_bairro=None, filtro_status=None):
     conn, db_type = get_connection()
     # Em pandas read_sql, melhor passar a conexão crua e deixar o driver lidar
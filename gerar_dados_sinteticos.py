@@ -0,0 +1,326 @@
+"""
+Gerador determinístico de dados sintéticos para teste de carga.
+Mesma semente + mesma data de referência = mesmos dados, byte a byte.
+
+Uso:
+    python gerar_dados_sinteticos.py 100000 --seed 42 --csv dados/sinteticos
+    python gerar_dados_sinteticos.py 1000000 --sqlite carga.db
+
+- Empresas no formato de search_engine.parse_cnpja_record (+ situacao_cadastral),
+  com CNAEs da Lei (cnae_mapping.LEI_TO_CNAE) misturados a CNAEs comuns fora dela.
+- Interações, propostas e obrigações para a parte da base que "entrou na carteira".
+- Tudo é gerado em streaming e gravado em lotes: a memória não cresce com N.
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import sqlite3
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+
+import cnae_mapping
+
+LOTE = 5000
+
+# CNAEs frequentes fora da Lei (comércio/serviços sem licenciamento), para o "ruído" da base
+CNAES_COMUNS = [
+    "4712100", "4781400", "5611201", "9602501", "4744099", "4772500", "4771701", "8599699",
+    "4723700", "5611203", "4530703", "4789099", "7319002", "8630504", "9511800", "4541206",
+]
+TAXA_CNAE_LEI = 0.35
+
+# Bairros de Iguatu, do mais ao menos populoso (pesos ~ Zipf)
+BAIRROS = [
+    "Centro", "Prado", "Vila Neuma", "Areias", "Flores", "Brasília", "Alto do Jucá", "Veneza",
+    "Santo Antônio", "João Paulo II", "Cocobó", "Tabuleiro", "Jardim Oásis", "Esplanada",
+    "Chapadinha", "Planalto", "Bugi", "Paraná", "Cidade Nova", "Novo Iguatu",
+]
+PESOS_BAIRROS = [1 / (i + 1) for i in range(len(BAIRROS))]
+
+LOGRADOUROS = ["Rua", "Avenida", "Travessa", "Rua", "Rua"]
+NOMES_RUA = ["Floriano Peixoto", "Dr. João Lima", "Agenor Araújo", "Sete de Setembro", "José de Alencar",
+             "Quinze de Novembro", "Santos Dumont", "Edilson Melo Távora", "Monsenhor Coelho", "Castelo Branco"]
+PRENOMES = ["MARIA", "JOSE", "ANTONIO", "FRANCISCA", "FRANCISCO", "ANA", "JOAO", "RAIMUNDA", "PEDRO",
+            "LUCIANA", "CARLOS", "FRANCISCO DAS CHAGAS", "PAULO", "ANTONIA", "MARCOS", "FERNANDA"]
+SOBRENOMES = ["SILVA", "SOUSA", "OLIVEIRA", "LIMA", "ALVES", "PEREIRA", "FERREIRA", "RODRIGUES",
+              "GOMES", "BEZERRA", "ARAUJO", "CAVALCANTE", "MOURA", "FEITOSA", "TAVARES", "LEITE"]
+PREFIXOS_FANTASIA = ["Mercadinho", "Posto", "Oficina", "Farmácia", "Padaria", "Indústria", "Fábrica",
+                     "Confecção", "Serraria", "Reciclagem", "Distribuidora", "Comercial", "Clínica", "Cerâmica"]
+SUFIXOS_FANTASIA = ["do João", "Iguatu", "Ceará", "Progresso", "Central", "Norte", "Sul", "Esperança",
+                    "São José", "Nossa Senhora", "Bom Jesus", "Real", "Vale do Jaguaribe"]
+
+# (porte_receita, peso, mediana do capital, dispersão log-normal)
+PORTES = [
+    ("Micro Empresa", 0.72, 15000, 1.0),
+    ("Empresa de Pequeno Porte", 0.16, 120000, 0.9),
+    ("Demais", 0.12, 800000, 1.2),
+]
+NATUREZAS = [("Empresário (Individual)", 0.45), ("Sociedade Empresária Limitada", 0.40),
+             ("Sociedade Simples Limitada", 0.08), ("Empresa Individual de Responsabilidade Limitada", 0.05),
+             ("Sociedade Anônima Fechada", 0.02)]
+SITUACOES = [("02", 0.88), ("08", 0.09), ("04", 0.02), ("03", 0.01)]
+
+STATUS_CRM = [("Novo", 0.55), ("Em Negociação", 0.25), ("Cliente", 0.15), ("Descartado", 0.05)]
+TIPOS_INTERACAO = ["Nota", "Ligação", "Visita", "WhatsApp", "Email"]
+SERVICOS = {
+    "Licença Simplificada (LP/LI/LO)": 1500.00,
+    "Renovação de Licença": 800.00,
+    "Regularização (RAMA Anual)": 500.00,
+    "Defesa de Auto de Infração": 2500.00,
+    "Consultoria Mensal (Recorrente)": 600.00,
+}
+STATUS_PROPOSTA = [("Aberto", 0.45), ("Pago", 0.40), ("Atrasado", 0.10), ("Cancelado", 0.05)]
+OBRIGACOES = [("Entrega do RAMA", "Relatório"), ("Visita de Monitoramento", "Visita"),
+              ("Renovação da Licença de Operação", "Licença"), ("Pagamento da Taxa SEMACE", "Taxa")]
+
+HEADER_EMPRESAS = [
+    "cnpj", "razao_social", "nome_fantasia", "data_inicio_atividade", "cnae_fiscal_principal",
+    "cnae_fiscal_descricao", "cnaes_secundarios", "municipio", "uf", "logradouro", "numero", "bairro",
+    "cep", "qsa", "telefone", "natureza_juridica", "porte_receita", "capital_social", "situacao_cadastral",
+]
+HEADER_INTERACOES = ["cnpj_empresa", "data_hora", "tipo", "notas", "proximo_passo"]
+HEADER_PROPOSTAS = ["cnpj_empresa", "cliente_nome", "servico", "valor", "status", "data_criacao", "data_vencimento"]
+HEADER_OBRIGACOES = ["cnpj_empresa", "titulo", "data_prazo", "tipo", "concluido"]
+
+def _escolha_ponderada(rnd, opcoes):
+    # opcoes: [(valor, peso)]
+    return rnd.choices([o for o, _ in opcoes], weights=[p for _, p in opcoes])[0]
+
+def _digitos_cnae(cnae):
+    return "".join(filter(str.isdigit, cnae))
+
+def _cnaes_lei():
+    return [(grp_id, _digitos_cnae(c), info['descricao'])
+            for grp_id, info in sorted(cnae_mapping.LEI_TO_CNAE.items()) for c in info['cnaes']]
+
+def digitos_verificadores(base12):
+    """Os dois dígitos verificadores de um CNPJ a partir dos 12 primeiros."""
+    numeros = [int(d) for d in base12]
+    for pesos in ([5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2], [6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2]):
+        resto = sum(n * p for n, p in zip(numeros, pesos)) % 11
+        numeros.append(0 if resto < 2 else 11 - resto)
+    return f"{numeros[-2]}{numeros[-1]}"
+
+def _data_abertura(rnd, referencia):
+    # 15% abertas há menos de 120 dias, 25% entre 120 dias e 2 anos, o resto com cauda longa até ~40 anos
+    sorteio = rnd.random()
+    if sorteio < 0.15:
+        dias = rnd.randint(0, 119)
+    elif sorteio < 0.40:
+        dias = rnd.randint(120, 730)
+    else:
+        dias = 730 + min(int(rnd.expovariate(1 / 2500)), 14000)
+    return (referencia - timedelta(days=dias)).strftime("%Y-%m-%d")
+
+def _nome_pessoa(rnd):
+    return f"{rnd.choice(PRENOMES)} {rnd.choice(SOBRENOMES)} {rnd.choice(SOBRENOMES)}"
+
+def gerar_empresas(n, seed=42, data_referencia=None):
+    """
+    Gera `n` estabelecimentos de Iguatu/CE no formato de parse_cnpja_record,
+    um a um (gerador). CNPJs válidos e únicos, derivados do índice.
+    """
+    rnd = random.Random(seed)
+    referencia = data_referencia or datetime.now()
+    cnaes_lei = _cnaes_lei()
+    pesos_portes = [p for _, p, _, _ in PORTES]
+
+    for i in range(n):
+        base12 = f"{10_000_000 + i:08d}0001"
+        cnpj = base12 + digitos_verificadores(base12)
+
+        if rnd.random() < TAXA_CNAE_LEI:
+            _, cnae_p, grupo_desc = rnd.choice(cnaes_lei)
+            descricao = grupo_desc.title()
+        else:
+            cnae_p, descricao = rnd.choice(CNAES_COMUNS), ""
+        n_sec = min(int(rnd.expovariate(0.8)), 6)
+        secundarios = []
+        for _ in range(n_sec):
+            sec = rnd.choice(cnaes_lei)[1] if rnd.random() < 0.2 else rnd.choice(CNAES_COMUNS)
+            if sec != cnae_p and sec not in secundarios:
+                secundarios.append(sec)
+
+        porte, _, mediana, dispersao = rnd.choices(PORTES, weights=pesos_portes)[0]
+        natureza = _escolha_ponderada(rnd, NATUREZAS)
+        if natureza == "Empresário (Individual)" and porte == "Micro Empresa" and rnd.random() < 0.6:
+            natureza += " (MEI)"
+            capital = round(rnd.uniform(1000, 10000), 2)
+        else:
+            capital = round(mediana * math.exp(rnd.gauss(0, dispersao)), 2)
+
+        n_socios = 1 if natureza.startswith("Empresário") else rnd.randint(1, 4)
+        socios = [_nome_pessoa(rnd) for _ in range(n_socios)]
+        fantasia = f"{rnd.choice(PREFIXOS_FANTASIA)} {rnd.choice(SUFIXOS_FANTASIA)}"
+
+        yield {
+            "cnpj": cnpj,
+            "razao_social": f"{socios[0]} {i}" if natureza.startswith("Empresário") else f"{fantasia.upper()} {i} LTDA",
+            "nome_fantasia": fantasia,
+            "data_inicio_atividade": _data_abertura(rnd, referencia),
+            "cnae_fiscal_principal": cnae_p,
+            "cnae_fiscal_descricao": descricao,
+            "cnaes_secundarios": secundarios,
+            "municipio": "IGUATU",
+            "uf": "CE",
+            "logradouro": f"{rnd.choice(LOGRADOUROS)} {rnd.choice(NOMES_RUA)}",
+            "numero": str(rnd.randint(1, 2500)),
+            "bairro": rnd.choices(BAIRROS, weights=PESOS_BAIRROS)[0],
+            "cep": "63500" + f"{rnd.randint(0, 999):03d}",
+            "qsa": ", ".join(socios),
+            "telefone": f"(88) 9{rnd.randint(8000, 9999)}{rnd.randint(0, 9999):04d}" if rnd.random() < 0.7 else "",
+            "natureza_juridica": natureza,
+            "porte_receita": porte,
+            "capital_social": capital,
+            "situacao_cadastral": _escolha_ponderada(rnd, SITUACOES),
+        }
+
+def gerar_relacionamentos(cnpjs, seed=42, data_referencia=None, taxa_carteira=0.2):
+    """
+    Para uma fração `taxa_carteira` dos CNPJs: status no CRM, interações, propostas e obrigações.
+    Gera (status_crm, cnpj, interacoes, propostas, obrigacoes) por empresa sorteada.
+    Usa uma semente derivada, então não muda a sequência de gerar_empresas.
+    """
+    rnd = random.Random(f"{seed}-relacionamentos")
+    referencia = data_referencia or datetime.now()
+    for cnpj in cnpjs:
+        if rnd.random() >= taxa_carteira:
+            continue
+        status = _escolha_ponderada(rnd, STATUS_CRM)
+
+        interacoes = []
+        for _ in range(min(int(rnd.expovariate(0.4)), 15)):
+            quando = referencia - timedelta(days=rnd.randint(0, 365), minutes=rnd.randint(0, 600))
+            interacoes.append([cnpj, quando.strftime("%Y-%m-%d %H:%M:%S"), rnd.choice(TIPOS_INTERACAO),
+                               "Contato registrado pelo gerador sintético", rnd.choice(["", "Retornar ligação", "Enviar proposta"])])
+
+        propostas = []
+        if status in ("Em Negociação", "Cliente"):
+            for _ in range(rnd.randint(1, 3)):
+                servico = rnd.choice(list(SERVICOS))
+                criacao = referencia - timedelta(days=rnd.randint(0, 300))
+                propostas.append([cnpj, cnpj, servico, round(SERVICOS[servico] * rnd.uniform(0.8, 1.3), 2),
+                                  _escolha_ponderada(rnd, STATUS_PROPOSTA) if status == "Cliente" else "Aberto",
+                                  criacao.strftime("%Y-%m-%d %H:%M:%S"),
+                                  (criacao + timedelta(days=rnd.choice([15, 30, 45]))).strftime("%Y-%m-%d")])
+
+        obrigacoes = []
+        if status == "Cliente":
+            for titulo, tipo in rnd.sample(OBRIGACOES, rnd.randint(1, len(OBRIGACOES))):
+                prazo = referencia + timedelta(days=rnd.randint(-60, 365))
+                obrigacoes.append([cnpj, titulo, prazo.strftime("%Y-%m-%d"), tipo, int(prazo < referencia and rnd.random() < 0.7)])
+
+        yield status, cnpj, interacoes, propostas, obrigacoes
+
+def _lotes(iteravel, tamanho=LOTE):
+    lote = []
+    for item in iteravel:
+        lote.append(item)
+        if len(lote) >= tamanho:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+def _linha_csv_empresa(emp):
+    return [json.dumps(emp[c], ensure_ascii=False) if c == "cnaes_secundarios" else emp[c] for c in HEADER_EMPRESAS]
+
+@contextmanager
+def _banco_sqlite(caminho):
+    """database.py apontando para um SQLite local (nunca para o Postgres configurado nos secrets)."""
+    import database
+
+    anterior = (database.DB_PATH, database.HAS_POSTGRES)
+    database.DB_PATH, database.HAS_POSTGRES = caminho, False
+    try:
+        database.init_db()
+        yield database
+    finally:
+        database.DB_PATH, database.HAS_POSTGRES = anterior
+
+def gerar(n, seed=42, data_referencia=None, pasta_csv=None, caminho_sqlite=None, taxa_carteira=0.2, analisar=True):
+    """
+    Gera a base inteira em lotes de LOTE empresas, gravando em CSV (pasta_csv) e/ou
+    SQLite (caminho_sqlite, schema do radar.db via database.init_db).
+    Com `analisar`, cada lote passa por business_logic.analisar_leads antes de ir
+    para o banco (grupo, risco, porte e taxa, como na importação real).
+    """
+    import business_logic
+
+    referencia = data_referencia or datetime.now()
+    inicio = time.time()
+    totais = {"empresas": 0, "interacoes": 0, "propostas": 0, "obrigacoes": 0}
+
+    with _banco_sqlite(caminho_sqlite) if caminho_sqlite else nullcontext() as database:
+        arquivos = {}
+        escritores = {}
+        if pasta_csv:
+            os.makedirs(pasta_csv, exist_ok=True)
+            for nome, header in (("empresas", HEADER_EMPRESAS), ("interacoes", HEADER_INTERACOES),
+                                 ("propostas", HEADER_PROPOSTAS), ("obrigacoes", HEADER_OBRIGACOES)):
+                arquivos[nome] = open(os.path.join(pasta_csv, f"{nome}.csv"), 'w', encoding='utf-8', newline='', buffering=4 * 1024 * 1024)
+                escritores[nome] = csv.writer(arquivos[nome], delimiter=';')
+                escritores[nome].writerow(header)
+        conn = sqlite3.connect(caminho_sqlite) if caminho_sqlite else None
+
+        try:
+            for lote in _lotes(gerar_empresas(n, seed, referencia)):
+                if pasta_csv:
+                    escritores["empresas"].writerows(_linha_csv_empresa(e) for e in lote)
+                if database is not None:
+                    registros = business_logic.analisar_leads(lote, data_referencia=referencia) if analisar else lote
+                    for r in registros:
+                        r['Rota'] = business_logic.gerar_link_rota(r)
+                    database.upsert_empresas_lote(registros)
+                totais["empresas"] += len(lote)
+
+                status_crm = []
+                relacionados = {"interacoes": [], "propostas": [], "obrigacoes": []}
+                for status, cnpj, interacoes, propostas, obrigacoes in gerar_relacionamentos(
+                        (e["cnpj"] for e in lote), f"{seed}-{totais['empresas']}", referencia, taxa_carteira):
+                    status_crm.append((status, cnpj))
+                    relacionados["interacoes"] += interacoes
+                    relacionados["propostas"] += propostas
+                    relacionados["obrigacoes"] += obrigacoes
+                for nome, linhas in relacionados.items():
+                    totais[nome] += len(linhas)
+                    if pasta_csv:
+                        escritores[nome].writerows(linhas)
+
+                if conn is not None:
+                    conn.executemany("UPDATE empresas SET status_crm = ? WHERE cnpj = ?", status_crm)
+                    conn.executemany(f"INSERT INTO interacoes ({','.join(HEADER_INTERACOES)}) VALUES (?, ?, ?, ?, ?)", relacionados["interacoes"])
+                    conn.executemany(f"INSERT INTO propostas ({','.join(HEADER_PROPOSTAS)}) VALUES (?, ?, ?, ?, ?, ?, ?)", relacionados["propostas"])
+                    conn.executemany(f"INSERT INTO obrigacoes ({','.join(HEADER_OBRIGACOES)}) VALUES (?, ?, ?, ?, ?)", relacionados["obrigacoes"])
+                    conn.commit()
+
+                print(f"  {totais['empresas']:,}/{n:,} empresas ({totais['empresas'] / max(time.time() - inicio, 1e-6):,.0f}/s)")
+        finally:
+            for f in arquivos.values():
+                f.close()
+            if conn is not None:
+                conn.close()
+
+    print(f"Concluído em {time.time() - inicio:.1f}s: " + ", ".join(f"{v:,} {k}" for k, v in totais.items()))
+    return totais
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gera uma base sintética determinística para teste de carga.")
+    parser.add_argument("n", type=int, help="Quantidade de estabelecimentos (ex.: 10000 a 1000000)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-referencia", default=None,
+                        help="AAAA-MM-DD usada como 'hoje' (fixe para reproduzir a mesma base em outro dia)")
+    parser.add_argument("--csv", dest="pasta_csv", default=None, help="Pasta de saída dos CSVs")
+    parser.add_argument("--sqlite", dest="caminho_sqlite", default=None, help="Banco SQLite de saída (schema do radar.db)")
+    parser.add_argument("--taxa-carteira", type=float, default=0.2, help="Fração das empresas com histórico no CRM")
+    parser.add_argument("--sem-analise", action="store_true", help="Grava no banco sem passar por analisar_leads")
+    args = parser.parse_args()
+
+    if not args.pasta_csv and not args.caminho_sqlite:
+        parser.error("informe --csv e/ou --sqlite")
+    referencia = datetime.strptime(args.data_referencia, "%Y-%m-%d") if args.data_referencia else None
+    gerar(args.n, args.seed, referencia, args.pasta_csv, args.caminho_sqlite, args.taxa_carteira, not args.sem_analise)
@@ -1,157 +1,1538 @@
 import requests
+import urllib3
 import zipfile
 import os
 import csv
 import io
 import shutil
+import time
+import argparse
+import unicodedata
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
 from datetime import datetime
 
 # Configuração
-BASE_URL = "https://dadosabertos.rfb.gov.br/CNPJ/"
+# RFB_BASE_URL permite apontar para um espelho ou servidor local de testes
+BASE_URL = os.environ.get("RFB_BASE_URL", "https://dadosabertos.rfb.gov.br/CNPJ/")
 DIR_DADOS = os.path.join(os.getcwd(), "dados_receita")
 ARQUIVO_SAIDA = os.path.join(os.getcwd(), "dados", "iguatu_oficial.csv")
 CIDADE_ALVO = "IGUATU"
 UF_ALVO = "CE"
+MAX_DOWNLOADS_PARALELOS = 3
+BUFFER_SAIDA = 4 * 1024 * 1024  # 4 MB de buffer no arquivo de saída
+LOTE_ESCRITA = 5000             # Linhas acumuladas antes de cada writerows/flush
+BLOCO_LEITURA = 16 * 1024 * 1024  # Leitura do CSV descompactado em blocos de 16 MB
+DIR_PARCIAIS = os.path.join(DIR_DADOS, "parciais")  # Saída de cada EstabelecimentosN.zip antes da junção
+WORKERS_PADRAO = os.cpu_count() or 1
+ARQUIVO_MANIFESTO = os.path.join(DIR_DADOS, "manifesto.json")  # Estado entre execuções mensais
+DIR_CHECKPOINTS = os.path.join(DIR_DADOS, "checkpoints")  # Posição dentro de cada EstabelecimentosN.zip
+INTERVALO_CHECKPOINT = 60  # segundos entre checkpoints de um mesmo arquivo
+DIR_LOGS = os.path.join(DIR_DADOS, "logs")  # execucao_<id>.jsonl, resumo_<id>.json e historico.jsonl
+INTERVALO_PROGRESSO = 10   # segundos entre eventos de progresso de um mesmo arquivo
+PASSO_PROGRESSO_DOWNLOAD = 10 * 1024 * 1024  # Evento de download a cada 10 MB
+BUFFER_REMOTO = 1024 * 1024       # Leitura do zip remoto (--remoto) em pedaços de 1 MB
+TAMANHO_CAUDA_REMOTA = 256 * 1024  # Fim do zip (diretório central) buscado uma vez só
+SALTO_MAXIMO_REMOTO = 1024 * 1024  # Seek para frente até aqui só consome o stream, sem novo GET
+URL_IBGE_MUNICIPIOS = "https://servicodados.ibge.gov.br/api/v1/localidades/municipios"
+SITUACAO_ATIVA = "02"
+SITUACAO_BAIXADA = "08"
+LOTE_CARGA = 5000  # Registros por transação na carga para a carteira
+CAMPOS_DELTA = ["SITUACAO_CADASTRAL", "CNAE_PRINCIPAL", "CNAE_SECUNDARIA"]
+PORTE_EMPRESA = {"00": "Não Informado", "01": "Micro Empresa", "03": "Empresa de Pequeno Porte", "05": "Demais"}
+HEADER_DELTA = [
+    "TIPO", "CNPJ", "CAMPOS_ALTERADOS", "NOME_FANTASIA", "BAIRRO", "DATA_INICIO_ATIVIDADE",
+    "SITUACAO_ANTERIOR", "SITUACAO_ATUAL", "CNAE_PRINCIPAL_ANTERIOR", "CNAE_PRINCIPAL_ATUAL",
+    "CNAE_SECUNDARIA_ANTERIOR", "CNAE_SECUNDARIA_ATUAL"
+]
 
-# Criar pastas
-if not os.path.exists(DIR_DADOS):
-    os.makedirs(DIR_DADOS)
-if not os.path.exists(os.path.dirname(ARQUIVO_SAIDA)):
-    os.makedirs(os.path.dirname(ARQUIVO_SAIDA))
+HEADER_ESTABELECIMENTOS = [
+    "CNPJ_BASICO", "CNPJ_ORDEM", "CNPJ_DV", "MATRIZ_FILIAL", "NOME_FANTASIA", 
+    "SITUACAO_CADASTRAL", "DATA_SITUACAO", "MOTIVO_SITUACAO", 
+    "NM_CIDADE_EXTERIOR", "PAIS", "DATA_INICIO_ATIVIDADE", "CNAE_PRINCIPAL", 
+    "CNAE_SECUNDARIA", "TIPO_LOGRADOURO", "LOGRADOURO", "NUMERO", 
+    "COMPLEMENTO", "BAIRRO", "CEP", "UF", "MUNICIPIO_COD", 
+    "DDD1", "TELEFONE1", "DDD2", "TELEFONE2", "DDD_FAX", "FAX", 
+    "EMAIL", "SITUACAO_ESPECIAL", "DATA_SITUACAO_ESPECIAL"
+]
 
-def download_file(url, destiny):
-    import time
+def preparar_pastas():
+    # Criar pastas (fora do import: os processos do pool reimportam este módulo)
+    for pasta in (DIR_DADOS, DIR_PARCIAIS, DIR_CHECKPOINTS, DIR_LOGS, os.path.dirname(ARQUIVO_SAIDA)):
+        if not os.path.exists(pasta):
+            os.makedirs(pasta)
+
+# --- MANIFESTO (estado da execução anterior) ---
+# {
+#   "arquivos": {"Estabelecimentos0.zip": {"last_modified", "etag", "tamanho", "mtime", "sha256"}},
+#   "parciais": {"Estabelecimentos0.zip": {"sha256_zip", "chave_filtro", "encontrados"}}
+# }
+
+# Downloads (threads) e callbacks do pool mexem no manifesto ao mesmo tempo
+_TRAVA_MANIFESTO = threading.RLock()
+
+def carregar_manifesto():
+    if os.path.exists(ARQUIVO_MANIFESTO):
+        try:
+            with open(ARQUIVO_MANIFESTO, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (ValueError, OSError) as e:
+            print(f"⚠️ Manifesto ilegível ({e}), ignorando estado anterior.")
+    return {"arquivos": {}, "parciais": {}}
+
+def salvar_manifesto(manifesto):
+    temporario = ARQUIVO_MANIFESTO + ".tmp"
+    with _TRAVA_MANIFESTO:
+        with open(temporario, 'w', encoding='utf-8') as f:
+            json.dump(manifesto, f, indent=2, ensure_ascii=False)
+        os.replace(temporario, ARQUIVO_MANIFESTO)
+
+def sha256_arquivo(caminho, bloco=BLOCO_LEITURA):
+    h = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for pedaco in iter(lambda: f.read(bloco), b''):
+            h.update(pedaco)
+    return h.hexdigest()
+
+def hash_conhecido(caminho, info):
+    # Reaproveita o sha256 do manifesto se o arquivo não mudou (mesmo tamanho e mtime)
+    if info and info.get("sha256"):
+        stat = os.stat(caminho)
+        if info.get("tamanho") == stat.st_size and info.get("mtime") == stat.st_mtime:
+            return info["sha256"]
+    return None
+
+def cabecalhos_remotos(url):
+    """HEAD no arquivo remoto: {"last_modified", "etag", "tamanho"} ou None se não der para consultar."""
     headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+    try:
+        r = requests.head(url, headers=headers, timeout=30, verify=False, allow_redirects=True)
+        if r.status_code != 200:
+            return None
+        return {
+            "last_modified": r.headers.get('last-modified'),
+            "etag": r.headers.get('etag'),
+            "tamanho": int(r.headers.get('content-length', 0)),
+        }
+    except Exception as e:
+        print(f"Aviso: HEAD falhou para {url}: {e}")
+        return None
+
+# --- ZIP REMOTO (HTTP Range, sem gravar o arquivo em disco) ---
+# zipfile só precisa de um arquivo com seek/read: o diretório central fica no fim do zip
+# (uma requisição Range para a cauda) e o membro CSV é lido do início ao fim em sequência.
+# Um único GET aberto (`Range: bytes=pos-`) serve toda a leitura sequencial; só um
+# seek para longe da posição atual abre outro. Download e parse andam juntos.
+
+class RangeNaoSuportado(Exception):
+    """
+    Servidor respondeu sem 206/Content-Range: não dá para ler o zip remoto por partes.
+    Não herda de OSError de propósito: zipfile transformaria em BadZipFile e as
+    tentativas de reconexão de ZipRemoto.readinto repetiriam o mesmo GET.
+    """
+
+class ZipRemoto(io.RawIOBase):
+    """Arquivo remoto somente leitura e com seek, servido por requisições HTTP Range."""
+
+    def __init__(self, url, tamanho=None, tentativas=3):
+        super().__init__()
+        self.url = url
+        self.tentativas = tentativas
+        self.headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+        if tamanho is None:
+            remoto = cabecalhos_remotos(url)
+            if not remoto or not remoto["tamanho"]:
+                raise IOError(f"Não foi possível obter o tamanho de {url}")
+            tamanho = remoto["tamanho"]
+        self.tamanho = tamanho
+        self.posicao = 0
+        self.bytes_lidos = 0  # bytes efetivamente trafegados (cauda + stream)
+        self._resposta = None
+        self._posicao_stream = None
+        self._cauda = None
+        self._inicio_cauda = max(0, tamanho - TAMANHO_CAUDA_REMOTA)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.posicao
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.posicao = offset
+        elif whence == io.SEEK_CUR:
+            self.posicao += offset
+        elif whence == io.SEEK_END:
+            self.posicao = self.tamanho + offset
+        else:
+            raise ValueError(f"whence inválido: {whence}")
+        self.posicao = max(0, self.posicao)
+        return self.posicao
+
+    def _fechar_stream(self):
+        if self._resposta is not None:
+            self._resposta.close()
+        self._resposta = None
+        self._posicao_stream = None
+
+    def _abrir_stream(self):
+        self._fechar_stream()
+        headers = dict(self.headers, Range=f"bytes={self.posicao}-")
+        r = requests.get(self.url, headers=headers, stream=True, timeout=60, verify=False)
+        if r.status_code != 206 and not (r.status_code == 200 and self.posicao == 0):
+            r.close()
+            raise RangeNaoSuportado(f"Servidor não atendeu Range em {self.url} (HTTP {r.status_code}); use o modo com download.")
+        self._resposta = r
+        self._posicao_stream = self.posicao
+
+    def _ler_cauda(self, destino):
+        if self._cauda is None:
+            headers = dict(self.headers, Range=f"bytes={self._inicio_cauda}-{self.tamanho - 1}")
+            # stream=True: um servidor que ignora o Range responde 200 com o arquivo inteiro
+            # (GBs); o corpo só é lido depois de confirmar 206 com a faixa pedida
+            with requests.get(self.url, headers=headers, stream=True, timeout=60, verify=False) as r:
+                r.raise_for_status()
+                faixa = r.headers.get('content-range', '')
+                esperado = f"bytes {self._inicio_cauda}-{self.tamanho - 1}/"
+                if r.status_code != 206 or not faixa.startswith(esperado):
+                    raise RangeNaoSuportado(f"Servidor não atendeu Range em {self.url} "
+                                            f"(HTTP {r.status_code}, Content-Range '{faixa}')")
+                self._cauda = r.content
+            if len(self._cauda) != self.tamanho - self._inicio_cauda:
+                raise IOError(f"Cauda de {self.url} incompleta ({len(self._cauda)} bytes)")
+            self.bytes_lidos += len(self._cauda)
+        inicio = self.posicao - self._inicio_cauda
+        dados = self._cauda[inicio:inicio + len(destino)]
+        destino[:len(dados)] = dados
+        return len(dados)
+
+    def readinto(self, destino):
+        if self.posicao >= self.tamanho or not len(destino):
+            return 0
+        if self.posicao >= self._inicio_cauda and self._posicao_stream != self.posicao:
+            # Diretório central e cabeçalhos do fim: servidos da cauda em cache
+            n = self._ler_cauda(destino)
+            self.posicao += n
+            return n
+
+        for tentativa in range(self.tentativas):
+            try:
+                salto = self.posicao - (self._posicao_stream if self._posicao_stream is not None else -1)
+                if self._resposta is None or not 0 <= salto <= SALTO_MAXIMO_REMOTO:
+                    self._abrir_stream()
+                elif salto:
+                    # Pequeno salto para frente: descarta do stream em vez de abrir outro GET
+                    self._resposta.raw.read(salto)
+                    self._posicao_stream += salto
+                dados = self._resposta.raw.read(len(destino), decode_content=False)
+                if not dados:
+                    raise IOError("conexão encerrada antes do fim do arquivo")
+                break
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+                self._fechar_stream()
+                if tentativa == self.tentativas - 1:
+                    raise
+                print(f"Aviso: leitura remota de {os.path.basename(self.url)} falhou em {self.posicao} ({e}), reconectando...")
+                time.sleep(2 ** tentativa)
+
+        n = len(dados)
+        destino[:n] = dados
+        self.posicao += n
+        self._posicao_stream += n
+        self.bytes_lidos += n
+        return n
+
+    def close(self):
+        self._fechar_stream()
+        super().close()
+
+def _eh_url(origem):
+    return origem.startswith(("http://", "https://"))
+
+@contextmanager
+def abrir_zip(origem, tamanho=None):
+    """
+    zipfile.ZipFile de um caminho local ou, para uma URL, direto do servidor (ZipRemoto).
+    Se o servidor não atender Range, a URL é baixada para DIR_DADOS (download_file)
+    e aberta do disco.
+    """
+    if not _eh_url(origem):
+        with zipfile.ZipFile(origem) as z:
+            yield z
+        return
+    bruto = ZipRemoto(origem, tamanho=tamanho)
+    try:
+        z = zipfile.ZipFile(io.BufferedReader(bruto, buffer_size=BUFFER_REMOTO))
+    except RangeNaoSuportado as e:
+        bruto.close()
+        print(f"⚠️ {e}; baixando o arquivo inteiro.")
+        destino = os.path.join(DIR_DADOS, os.path.basename(origem))
+        if not download_file(origem, destino):
+            raise IOError(f"Falha ao baixar {origem}") from e
+        with zipfile.ZipFile(destino) as z:
+            yield z
+        return
+    except BaseException:
+        bruto.close()
+        raise
+    try:
+        with z:
+            yield z
+    finally:
+        bruto.close()
+
+def identidade_remota(remoto):
+    """No modo --remoto não há sha256 do zip: a versão do arquivo é dada por ETag/Last-Modified + tamanho."""
+    versao = remoto.get("etag") or remoto.get("last_modified") or ""
+    return f"remoto:{versao}:{remoto.get('tamanho', 0)}"
+
+def versoes_remotas(nomes_arquivos, base_url=BASE_URL):
+    """Gera (nome, url, identidade ou None) consultando só os cabeçalhos de cada arquivo."""
+    for nome_arquivo in nomes_arquivos:
+        url = base_url + nome_arquivo
+        remoto = cabecalhos_remotos(url)
+        if not remoto or not remoto["tamanho"]:
+            yield nome_arquivo, url, None
+        else:
+            yield nome_arquivo, url, identidade_remota(remoto)
+
+# --- INSTRUMENTAÇÃO (eventos JSON-lines + resumo da execução) ---
+# Cada execução grava dados_receita/logs/execucao_<id>.jsonl com um evento por linha
+# (download_progresso, download_fim, parse_progresso, parse_fim, etapa_fim, resumo...).
+# No final, resumo_<id>.json e uma linha em historico.jsonl permitem comparar meses.
+# Os processos do pool não escrevem no log: mandam os eventos por uma fila
+# (multiprocessing.Manager) que uma thread do processo principal descarrega.
+
+_LOG = {"arquivo": None, "id": None, "inicio": None, "resumo": None, "fracoes": {}, "total_arquivos": 0,
+        "inicio_parse": None, "reaproveitados": set()}
+_TRAVA_LOG = threading.Lock()
+
+def _fmt_duracao(segundos):
+    if segundos is None:
+        return "?"
+    segundos = int(segundos)
+    h, resto = divmod(segundos, 3600)
+    m, s = divmod(resto, 60)
+    return f"{h}h{m:02d}m" if h else f"{m}m{s:02d}s"
+
+def iniciar_log_execucao(**contexto):
+    preparar_pastas()
+    id_execucao = datetime.now().strftime("%Y%m%d_%H%M%S")
+    _LOG.update({
+        "arquivo": os.path.join(DIR_LOGS, f"execucao_{id_execucao}.jsonl"),
+        "id": id_execucao,
+        "inicio": time.time(),
+        "fracoes": {},
+        "total_arquivos": 0,
+        "inicio_parse": None,
+        "reaproveitados": set(),
+        "resumo": {"execucao": id_execucao, "contexto": contexto, "etapas": {}, "arquivos": {}},
+    })
+    registrar_evento("execucao_inicio", **contexto)
+    return id_execucao
+
+def _atualizar_resumo(evento, dados):
+    resumo = _LOG["resumo"]
+    arquivo = dados.get("arquivo")
+    info = resumo["arquivos"].setdefault(arquivo, {}) if arquivo else None
+    if evento == "download_fim":
+        info.update({"download_bytes": dados["bytes"], "download_s": dados["segundos"], "download_bytes_s": dados["bytes_s"]})
+    elif evento == "parse_fim":
+        info.update({"linhas": dados["linhas"], "encontrados": dados["encontrados"], "parse_s": dados["segundos"], "linhas_s": dados["linhas_s"]})
+        _LOG["fracoes"][arquivo] = 1.0
+    elif evento == "arquivo_reaproveitado":
+        info.update({"reaproveitado": True, "encontrados": dados.get("encontrados", 0)})
+        _LOG["reaproveitados"].add(arquivo)
+    elif evento == "parse_progresso":
+        _LOG["fracoes"][arquivo] = dados.get("fracao", 0)
+    elif evento == "etapa_fim":
+        resumo["etapas"][dados["etapa"]] = dados["segundos"]
+
+def eta_global():
+    """
+    ETA da etapa de parse: fração média dos arquivos (não iniciados contam 0) extrapolada
+    pelo tempo desde o início da etapa. Arquivos reaproveitados não entram na conta
+    (nem na fração, nem no total): não custaram tempo nenhum.
+    """
+    total = _LOG["total_arquivos"] - len(_LOG["reaproveitados"])
+    if total <= 0 or not _LOG["inicio_parse"]:
+        return None
+    fracao = sum(f for arquivo, f in _LOG["fracoes"].items() if arquivo not in _LOG["reaproveitados"]) / total
+    if fracao <= 0:
+        return None
+    decorrido = time.time() - _LOG["inicio_parse"]
+    return decorrido * (1 - fracao) / fracao
+
+def registrar_evento(evento, **dados):
+    """Grava um evento estruturado no log da execução (thread-safe). Sem log iniciado, só agrega em memória."""
+    registro = {"ts": datetime.now().isoformat(timespec="milliseconds"), "evento": evento}
+    registro.update(dados)
+    with _TRAVA_LOG:
+        if _LOG["resumo"] is not None:
+            _atualizar_resumo(evento, dados)
+        if _LOG["arquivo"]:
+            with open(_LOG["arquivo"], 'a', encoding='utf-8') as f:
+                f.write(json.dumps(registro, ensure_ascii=False, default=str) + "\n")
+
+    # Saída humana só para o que ajuda a acompanhar a execução
+    if evento == "download_progresso":
+        pct = f"{100 * dados['bytes'] / dados['total']:.0f}%" if dados.get("total") else "?"
+        print(f"⬇️ {dados['arquivo']}: {pct} | {dados['bytes_s'] / (1024*1024):.1f} MB/s | ETA {_fmt_duracao(dados.get('eta_s'))}")
+    elif evento == "parse_progresso":
+        print(f"⏳ {dados['arquivo']}: {100 * dados['fracao']:.0f}% | {dados['linhas_s']:,.0f} linhas/s | "
+              f"{dados['encontrados']} encontrados | ETA arquivo {_fmt_duracao(dados.get('eta_s'))} | ETA total {_fmt_duracao(eta_global())}")
+
+def emissor_eventos(fila):
+    """Função de emissão para usar dentro dos processos do pool (fila) ou no próprio processo (sem fila)."""
+    if fila is None:
+        return registrar_evento
+    def emitir(evento, **dados):
+        fila.put((evento, dados))
+    return emitir
+
+def _descarregar_fila(fila):
+    # Thread do processo principal: repassa os eventos dos workers até receber None
+    while True:
+        item = fila.get()
+        if item is None:
+            break
+        evento, dados = item
+        registrar_evento(evento, **dados)
+
+@contextmanager
+def fila_de_eventos():
+    """Fila compartilhada com os processos do pool + thread que grava os eventos no log."""
+    import multiprocessing
+    with multiprocessing.Manager() as gerente:
+        fila = gerente.Queue()
+        leitor = threading.Thread(target=_descarregar_fila, args=(fila,), daemon=True)
+        leitor.start()
+        try:
+            yield fila
+        finally:
+            fila.put(None)
+            leitor.join()
+
+@contextmanager
+def medir_etapa(etapa):
+    inicio = time.time()
+    try:
+        yield
+    finally:
+        registrar_evento("etapa_fim", etapa=etapa, segundos=round(time.time() - inicio, 2))
+
+def finalizar_log_execucao(status="ok"):
+    """Fecha a execução: evento `resumo`, resumo_<id>.json e uma linha em historico.jsonl."""
+    if _LOG["resumo"] is None:
+        return None
+    resumo = _LOG["resumo"]
+    arquivos = resumo["arquivos"].values()
+    resumo.update({
+        "status": status,
+        "segundos_total": round(time.time() - _LOG["inicio"], 2),
+        "totais": {
+            "download_bytes": sum(a.get("download_bytes", 0) for a in arquivos),
+            "linhas": sum(a.get("linhas", 0) for a in arquivos),
+            "encontrados": sum(a.get("encontrados", 0) for a in arquivos),
+            "arquivos_reaproveitados": sum(1 for a in arquivos if a.get("reaproveitado")),
+        },
+    })
+    registrar_evento("resumo", **resumo)
+
+    with open(os.path.join(DIR_LOGS, f"resumo_{_LOG['id']}.json"), 'w', encoding='utf-8') as f:
+        json.dump(resumo, f, indent=2, ensure_ascii=False)
+    with open(os.path.join(DIR_LOGS, "historico.jsonl"), 'a', encoding='utf-8') as f:
+        f.write(json.dumps({k: resumo[k] for k in ("execucao", "status", "segundos_total", "etapas", "totais")}, ensure_ascii=False) + "\n")
+
+    print(f"\n📈 Resumo da execução {_LOG['id']} ({status}): {_fmt_duracao(resumo['segundos_total'])} no total")
+    for etapa, segundos in resumo["etapas"].items():
+        print(f"  {etapa}: {_fmt_duracao(segundos)}")
+    t = resumo["totais"]
+    print(f"  {t['download_bytes'] / (1024*1024):.0f} MB baixados | {t['linhas']:,} linhas lidas | {t['encontrados']:,} encontrados")
+    print(f"  Log: {_LOG['arquivo']}")
+    return resumo
+
+def _total_content_range(valor):
+    # "bytes 100-199/2000" ou "bytes */2000" -> 2000
+    try:
+        return int(valor.rsplit('/', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+def verificar_integridade_zip(caminho, tamanho_esperado=0, verificar_crc=True):
+    """
+    Confere se um zip baixado está íntegro antes de ser considerado pronto.
+    - Tamanho em disco igual ao informado pelo servidor (quando conhecido).
+    - CRC de todos os membros (zipfile.testzip descompacta tudo, custa uma leitura completa).
+    Retorna (ok, motivo).
+    """
+    tamanho_local = os.path.getsize(caminho)
+    if tamanho_esperado and tamanho_local != tamanho_esperado:
+        return False, f"tamanho {tamanho_local} diferente do esperado {tamanho_esperado}"
+
+    try:
+        with zipfile.ZipFile(caminho) as z:
+            if verificar_crc:
+                membro_ruim = z.testzip()
+                if membro_ruim:
+                    return False, f"CRC inválido em {membro_ruim}"
+    except zipfile.BadZipFile as e:
+        return False, f"zip corrompido ({e})"
+
+    return True, None
+
+def download_file(url, destiny, tentativas=3, verificar_crc=True):
+    """
+    Baixa `url` para `destiny` com retomada via HTTP Range.
+    O conteúdo é gravado em `destiny + ".part"`; uma falha no meio do arquivo
+    faz a próxima tentativa (ou a próxima execução) continuar do byte onde parou.
+    Só depois de conferir tamanho e CRC o .part é renomeado para o nome final.
+    """
+    headers_base = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+    parcial = destiny + ".part"
+    nome_arquivo = os.path.basename(destiny)
+    inicio_download = time.time()
+    bytes_inicio = os.path.getsize(parcial) if os.path.exists(parcial) else 0
     
-    for tentativa in range(3):
+    for tentativa in range(tentativas):
         try:
-            print(f"Baixando {url} (Tentativa {tentativa+1}/3)...")
+            ja_baixado = os.path.getsize(parcial) if os.path.exists(parcial) else 0
+            headers = dict(headers_base)
+            if ja_baixado > 0:
+                headers['Range'] = f"bytes={ja_baixado}-"
+                print(f"Retomando {url} a partir de {ja_baixado / (1024*1024):.1f} MB (Tentativa {tentativa+1}/{tentativas})...")
+            else:
+                print(f"Baixando {url} (Tentativa {tentativa+1}/{tentativas})...")
+
             # verify=False pois o cert da receita as vezes expira ou da erro em cadeias antigas
             with requests.get(url, stream=True, headers=headers, timeout=60, verify=False) as r:
-                r.raise_for_status()
-                with open(destiny, 'wb') as f:
-                    total_size = int(r.headers.get('content-length', 0))
-                    downloaded = 0
-                    chunk_size = 8192
-                    for chunk in r.iter_content(chunk_size=chunk_size):
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        if total_size > 0 and downloaded % (10*1024*1024) == 0: 
-                             # Print a cada 10MB para não floodar
-                             pass
+                if r.status_code == 416:
+                    # Range além do fim: o .part já tem o arquivo inteiro (ou está maior que o remoto)
+                    total_size = _total_content_range(r.headers.get('content-range'))
+                    if not total_size or ja_baixado != total_size:
+                        os.remove(parcial)
+                        raise IOError("Arquivo parcial inconsistente com o servidor, reiniciando do zero")
+                else:
+                    r.raise_for_status()
+                    if r.status_code == 206:
+                        inicio = int(r.headers.get('content-range', 'bytes 0-').split(' ')[1].split('-')[0])
+                        if inicio != ja_baixado:
+                            os.remove(parcial)
+                            raise IOError(f"Servidor retomou do byte {inicio}, esperado {ja_baixado}")
+                        total_size = _total_content_range(r.headers.get('content-range'))
+                        modo = 'ab'
+                    else:
+                        # Servidor ignorou o Range (200): recomeça o arquivo
+                        total_size = int(r.headers.get('content-length', 0))
+                        ja_baixado = 0
+                        modo = 'wb'
+
+                    with open(parcial, modo) as f:
+                        downloaded = ja_baixado
+                        chunk_size = 1024 * 1024
+                        inicio_tentativa = time.time()
+                        proximo_relato = downloaded + PASSO_PROGRESSO_DOWNLOAD
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                            downloaded += len(chunk)
+                            if downloaded >= proximo_relato:
+                                # Evento a cada 10MB para não floodar
+                                proximo_relato = downloaded + PASSO_PROGRESSO_DOWNLOAD
+                                taxa = (downloaded - ja_baixado) / max(time.time() - inicio_tentativa, 1e-6)
+                                eta = (total_size - downloaded) / taxa if total_size and taxa else None
+                                registrar_evento("download_progresso", arquivo=nome_arquivo, bytes=downloaded,
+                                                 total=total_size, bytes_s=round(taxa), eta_s=eta and round(eta, 1))
+
+            tamanho_local = os.path.getsize(parcial)
+            if total_size and tamanho_local < total_size:
+                raise IOError(f"Download incompleto ({tamanho_local}/{total_size} bytes)")
+
+            ok, motivo = verificar_integridade_zip(parcial, total_size, verificar_crc)
+            if not ok:
+                # Conteúdo corrompido não adianta retomar: apaga e baixa de novo
+                os.remove(parcial)
+                raise IOError(f"Falha na verificação de integridade: {motivo}")
+
+            os.replace(parcial, destiny)
+            segundos = time.time() - inicio_download
+            baixados = os.path.getsize(destiny) - bytes_inicio
+            registrar_evento("download_fim", arquivo=nome_arquivo, bytes=baixados, segundos=round(segundos, 2),
+                             bytes_s=round(baixados / max(segundos, 1e-6)), tentativas=tentativa + 1)
             print(f"Download concluído: {destiny}")
             return True
         except Exception as e:
             print(f"Erro no download: {e}")
             time.sleep(5) # Espera 5s antes de tentar de novo
     
-    print(f"Falha fatal ao baixar {url} após 3 tentativas.")
+    registrar_evento("download_falha", arquivo=nome_arquivo, tentativas=tentativas)
+    print(f"Falha fatal ao baixar {url} após {tentativas} tentativas.")
+    return False
+
+def _remoto_mudou(info_local, remoto):
+    if not remoto or not info_local:
+        # Sem como comparar: mantém o arquivo local
+        return False
+    for campo in ("last_modified", "etag", "tamanho"):
+        if remoto.get(campo) and info_local.get(campo) and remoto[campo] != info_local[campo]:
+            return True
     return False
 
-def encontrar_codigo_municipio():
-    print("Identificando Código TOM de Iguatu...")
+def baixar_em_paralelo(nomes_arquivos, base_url=BASE_URL, pasta=DIR_DADOS, max_paralelo=MAX_DOWNLOADS_PARALELOS, manifesto=None):
+    """
+    Gerenciador de downloads: no máximo `max_paralelo` transferências simultâneas.
+    Gera (nome, caminho) na mesma ordem de `nomes_arquivos` assim que cada um fica pronto,
+    para que o processamento do lote i comece enquanto os seguintes ainda estão baixando.
+    `caminho` é None quando o download falhou.
+
+    Com `manifesto`, um zip local só é reaproveitado se o Last-Modified/ETag/tamanho
+    remoto for o mesmo da execução anterior; caso contrário é baixado de novo.
+    """
+    arquivos_info = manifesto.setdefault("arquivos", {}) if manifesto is not None else {}
+    with ThreadPoolExecutor(max_workers=max_paralelo) as executor:
+        pendentes = []
+        for nome in nomes_arquivos:
+            caminho = os.path.join(pasta, nome)
+            url = f"{base_url}{nome}"
+            remoto = cabecalhos_remotos(url) if manifesto is not None else None
+
+            if os.path.exists(caminho) and _remoto_mudou(arquivos_info.get(nome), remoto):
+                print(f"🔄 {nome} mudou no servidor desde a última execução, baixando de novo.")
+                os.remove(caminho)
+
+            if os.path.exists(caminho):
+                # Nome final só existe depois da verificação de integridade
+                pendentes.append((nome, caminho, None, remoto))
+            else:
+                futuro = executor.submit(download_file, url, caminho)
+                pendentes.append((nome, caminho, futuro, remoto))
+
+        for nome, caminho, futuro, remoto in pendentes:
+            if futuro is not None and not futuro.result():
+                yield nome, None
+                continue
+
+            if manifesto is not None:
+                with _TRAVA_MANIFESTO:
+                    info = arquivos_info.setdefault(nome, {})
+                    if futuro is not None:
+                        # Arquivo novo: hash antigo não vale mais
+                        info.pop("sha256", None)
+                    if remoto:
+                        info.update(remoto)
+            yield nome, caminho
+
+@contextmanager
+def escritor_csv_atomico(caminho, header, lote=LOTE_ESCRITA, retomar_em=None, manter_temporario=False):
+    """
+    Estágio único de escrita da saída.
+    Mantém um só handle (com buffer grande) aberto durante toda a execução,
+    acumula as linhas e grava em lotes. O conteúdo vai para `caminho + ".tmp"`
+    e só substitui o arquivo final (os.replace, atômico) se o bloco terminar sem erro:
+    uma execução que cair no meio nunca deixa um CSV pela metade para o app ler.
+
+    Uso:
+        with escritor_csv_atomico(ARQUIVO_SAIDA, HEADER) as escrever:
+            escrever(parts)
+
+    Para checkpoints: `escrever.sincronizar()` grava o que está pendente, faz fsync e
+    devolve o tamanho do .tmp em bytes. Com `retomar_em` o .tmp de uma execução
+    interrompida é cortado nessa posição e continua dali (sem reescrever o header);
+    `manter_temporario` preserva o .tmp se o bloco falhar.
+    """
+    temporario = caminho + ".tmp"
+    pendentes = []
+    if retomar_em is not None:
+        os.truncate(temporario, retomar_em)
+        f_out = open(temporario, 'a', encoding='utf-8', newline='', buffering=BUFFER_SAIDA)
+    else:
+        f_out = open(temporario, 'w', encoding='utf-8', newline='', buffering=BUFFER_SAIDA)
+    try:
+        writer = csv.writer(f_out, delimiter=';')
+        if retomar_em is None:
+            writer.writerow(header)
+
+        def escrever(linha):
+            pendentes.append(linha)
+            if len(pendentes) >= lote:
+                writer.writerows(pendentes)
+                pendentes.clear()
+
+        def sincronizar():
+            writer.writerows(pendentes)
+            pendentes.clear()
+            f_out.flush()
+            os.fsync(f_out.fileno())
+            return os.fstat(f_out.fileno()).st_size
+
+        escrever.sincronizar = sincronizar
+        yield escrever
+
+        writer.writerows(pendentes)
+        f_out.flush()
+        os.fsync(f_out.fileno())
+        f_out.close()
+        os.replace(temporario, caminho)
+    except BaseException:
+        f_out.close()
+        if not manter_temporario and os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+
+def _normalizar_nome(nome):
+    # "Quixelô" -> "QUIXELO" (a tabela da RFB vem em maiúsculas e, em geral, sem acento)
+    sem_acento = unicodedata.normalize('NFKD', nome).encode('ascii', 'ignore').decode('ascii')
+    return " ".join(sem_acento.upper().split())
+
+def arquivo_saida_municipio(nome):
+    # IGUATU -> dados/iguatu_oficial.csv (mesmo caminho de ARQUIVO_SAIDA para a cidade padrão)
+    slug = _normalizar_nome(nome).lower().replace(" ", "_").replace("'", "")
+    return os.path.join(os.path.dirname(ARQUIVO_SAIDA), f"{slug}_oficial.csv")
+
+def _garantir_municipios_zip(base_url=BASE_URL):
     arquivo_zip = os.path.join(DIR_DADOS, "Municipios.zip")
-    
-    # Baixar Tabela de Municipios
     if not os.path.exists(arquivo_zip):
-        success = download_file(f"{BASE_URL}Municipios.zip", arquivo_zip)
+        success = download_file(f"{base_url}Municipios.zip", arquivo_zip)
         if not success and not os.path.exists(arquivo_zip):
             print("❌ Falha crítica: Não foi possível baixar a tabela de municípios.")
             return None
-    
-    codigo_encontrado = None
-    
+    return arquivo_zip
+
+def ler_municipios_rfb(arquivo_zip):
+    """[(codigo_tom, nome)] da tabela de municípios da RFB (sem UF e sem código IBGE)."""
+    municipios = []
+    with zipfile.ZipFile(arquivo_zip) as z:
+        with z.open(z.namelist()[0]) as f:
+            for line in f:
+                parts = _parse_linha(line)
+                if len(parts) >= 2 and parts[0]:
+                    municipios.append((parts[0], parts[1]))
+    return municipios
+
+def municipios_ibge():
+    """[(codigo_ibge, nome, uf)] da API de localidades do IBGE."""
+    r = requests.get(URL_IBGE_MUNICIPIOS, timeout=60)
+    r.raise_for_status()
+    municipios = []
+    for m in r.json():
+        # Municípios novos podem vir sem microrregião; a região imediata sempre traz a UF
+        micro = m.get("microrregiao") or {}
+        uf = ((micro.get("mesorregiao") or {}).get("UF") or
+              ((m.get("regiao-imediata") or {}).get("regiao-intermediaria") or {}).get("UF") or {})
+        municipios.append((str(m["id"]), m["nome"], uf.get("sigla")))
+    return municipios
+
+def construir_tabela_municipios(base_url=BASE_URL):
+    """
+    Monta a tabela municipios (database.salvar_municipios) uma única vez:
+    TOM e nome vêm do Municipios.zip da RFB, código IBGE e UF da API do IBGE, casados
+    pelo nome normalizado. Nomes que se repetem em mais de um estado (ou que não batem
+    com o IBGE) ficam só com TOM e nome; nesses casos a UF continua sendo conferida
+    no filtro dos estabelecimentos (campo 19).
+    Retorna {"total": n, "com_ibge": n, "ambiguos": n} ou None se não deu para ler a RFB.
+    """
+    import database
+
+    arquivo_zip = _garantir_municipios_zip(base_url)
+    if arquivo_zip is None:
+        return None
     try:
-        with zipfile.ZipFile(arquivo_zip) as z:
-            nome_csv = z.namelist()[0]
-            with z.open(nome_csv) as f:
-                for line in f:
-                    try:
-                        decoded_line = line.decode('latin-1').strip()
-                        parts = decoded_line.split(';')
-                        if len(parts) >= 2:
-                            codigo = parts[0].strip('"')
-                            nome = parts[1].strip('"').upper()
-                            if nome == CIDADE_ALVO:
-                                codigo_encontrado = codigo
-                                print(f"✅ Código Encontrado para {CIDADE_ALVO}: {codigo_encontrado}")
-                                break
-                    except:
-                        pass
+        rfb = ler_municipios_rfb(arquivo_zip)
     except zipfile.BadZipFile:
         print("❌ Erro: Arquivo Municipios.zip corrompido. Apagando para tentar novamente.")
         os.remove(arquivo_zip)
         return None
 
-    return codigo_encontrado
+    ibge_por_nome = {}
+    try:
+        for codigo_ibge, nome, uf in municipios_ibge():
+            ibge_por_nome.setdefault(_normalizar_nome(nome), []).append((codigo_ibge, uf))
+    except Exception as e:
+        print(f"⚠️ API do IBGE indisponível ({e}); tabela gravada só com TOM e nome.")
 
-def processar_estabelecimentos(codigo_municipio):
-    print(f"Iniciando processamento para o código {codigo_municipio}...")
-    
-    # Preparar arquivo de saída
-    HEADER = [
-        "CNPJ_BASICO", "CNPJ_ORDEM", "CNPJ_DV", "MATRIZ_FILIAL", "NOME_FANTASIA", 
-        "SITUACAO_CADASTRAL", "DATA_SITUACAO", "MOTIVO_SITUACAO", 
-        "NM_CIDADE_EXTERIOR", "PAIS", "DATA_INICIO_ATIVIDADE", "CNAE_PRINCIPAL", 
-        "CNAE_SECUNDARIA", "TIPO_LOGRADOURO", "LOGRADOURO", "NUMERO", 
-        "COMPLEMENTO", "BAIRRO", "CEP", "UF", "MUNICIPIO_COD", 
-        "DDD1", "TELEFONE1", "DDD2", "TELEFONE2", "DDD_FAX", "FAX", 
-        "EMAIL", "SITUACAO_ESPECIAL", "DATA_SITUACAO_ESPECIAL"
-    ]
-    
-    # Criar/Limpar arquivo de saída e escrever header
-    with open(ARQUIVO_SAIDA, 'w', encoding='utf-8', newline='') as f_out:
-        writer = csv.writer(f_out, delimiter=';')
-        writer.writerow(HEADER)
+    rfb_por_nome = {}
+    for codigo_tom, nome in rfb:
+        rfb_por_nome.setdefault(_normalizar_nome(nome), []).append(codigo_tom)
+
+    linhas = []
+    ambiguos = 0
+    for codigo_tom, nome in rfb:
+        nome_normalizado = _normalizar_nome(nome)
+        candidatos = ibge_por_nome.get(nome_normalizado, [])
+        codigo_ibge = uf = None
+        if len(candidatos) == 1 and len(rfb_por_nome[nome_normalizado]) == 1:
+            codigo_ibge, uf = candidatos[0]
+        elif candidatos:
+            ambiguos += 1
+        linhas.append({"codigo_tom": codigo_tom, "codigo_ibge": codigo_ibge, "nome": nome,
+                       "nome_normalizado": nome_normalizado, "uf": uf})
+
+    database.salvar_municipios(linhas)
+    stats = {"total": len(linhas), "com_ibge": sum(1 for l in linhas if l["codigo_ibge"]), "ambiguos": ambiguos}
+    print(f"🗺️ Tabela de municípios: {stats['total']} municípios, {stats['com_ibge']} com código IBGE, "
+          f"{stats['ambiguos']} homônimos sem UF definida.")
+    return stats
+
+def encontrar_codigos_municipios(alvos):
+    """
+    Resolve os códigos TOM de vários municípios pela tabela municipios do banco
+    (montada na primeira execução por construir_tabela_municipios).
+    `alvos`: lista de (nome, uf). Homônimos sem UF conhecida entram como candidatos;
+    a UF é conferida no filtro (campo 19).
+    Retorna {codigo_tom: (nome, uf)}.
+    """
+    import database
+
+    print(f"Identificando Códigos TOM de {', '.join(nome for nome, _ in alvos)}...")
+    indice = database.indice_municipios()
+    if not indice["tom"]:
+        if construir_tabela_municipios() is None:
+            return {}
+        indice = database.indice_municipios(recarregar=True)
+
+    codigos = {}
+    for nome, uf in alvos:
+        nome, uf = nome.upper(), (uf.upper() if uf else None)
+        encontrados = [
+            m["codigo_tom"] for m in indice["nome"].get(_normalizar_nome(nome), [])
+            if not uf or not m["uf"] or m["uf"] == uf
+        ]
+        for codigo in encontrados:
+            codigos[codigo] = (nome, uf)
+        if encontrados:
+            print(f"✅ Código(s) Encontrado(s) para {nome}/{uf or '??'}: {', '.join(encontrados)}")
+        else:
+            print(f"⚠️ Município não encontrado na tabela da RFB: {nome}")
+
+    return codigos
+
+def _parse_linha(line_bytes):
+    line = line_bytes.rstrip(b'\r\n').decode('latin-1')
+    return [p.strip('"') for p in line.split(';')]
+
+def _pertence(parts, codigos):
+    # Campo 20 = MUNICIPIO_COD, campo 19 = UF (desfaz homônimos de outros estados)
+    return len(parts) > 20 and parts[20] in codigos and codigos[parts[20]][1] in (None, parts[19])
+
+def filtrar_linhas(f_in, codigos, tamanho_bloco=BLOCO_LEITURA, offset_inicial=0, linhas_iniciais=0, ao_fim_do_bloco=None):
+    """
+    Gera as linhas (já separadas em campos) cujo MUNICIPIO_COD está em `codigos`
+    ({codigo_tom: (nome, uf)}, ver encontrar_codigos_municipios).
+
+    Caminho rápido: menos de 0,1% das linhas interessam, então o CSV é lido em blocos
+    grandes e o token do campo 20 (`";"<codigo>";"`, fechando a UF e abrindo o DDD1)
+    de cada município é procurado direto nos bytes com bytes.find. Só as linhas que
+    contêm algum token são decodificadas e quebradas em campos; a posição 20 e a UF
+    são conferidas depois do parse.
+
+    `ao_fim_do_bloco(offset, linhas)` é chamado depois que todas as linhas de um bloco
+    foram entregues, com o offset (bytes descompactados, sempre em início de linha) e
+    o total de linhas lidas até ali. É o ponto seguro para gravar um checkpoint.
+    Para retomar, o chamador posiciona `f_in` em `offset_inicial` antes da chamada.
+    """
+    tokens = [b'";"' + codigo.encode('latin-1') + b'";"' for codigo in codigos]
+    resto = b''
+    offset = offset_inicial
+    total_linhas = linhas_iniciais
+    while True:
+        bloco = f_in.read(tamanho_bloco)
+        if not bloco:
+            break
+        bloco = resto + bloco
+        corte = bloco.rfind(b'\n') + 1
+        resto = bloco[corte:]
+
+        linhas = set()
+        for token in tokens:
+            pos = bloco.find(token, 0, corte)
+            while pos != -1:
+                inicio = bloco.rfind(b'\n', 0, pos) + 1
+                fim = bloco.find(b'\n', pos)
+                linhas.add((inicio, fim))
+                pos = bloco.find(token, fim, corte)
+
+        # Ordenado para manter a ordem original do arquivo
+        for inicio, fim in sorted(linhas):
+            try:
+                parts = _parse_linha(bloco[inicio:fim])
+                if _pertence(parts, codigos):
+                    yield parts
+            except Exception:
+                pass
+
+        # `offset` = posição de bloco[0]; o próximo bloco começa em `resto`
+        offset += corte
+        total_linhas += bloco.count(b'\n', 0, corte)
+        if ao_fim_do_bloco:
+            ao_fim_do_bloco(offset, total_linhas)
+
+    # Última linha sem quebra de linha no final do arquivo
+    if resto and any(token in resto for token in tokens):
+        parts = _parse_linha(resto)
+        if _pertence(parts, codigos):
+            yield parts
+
+def caminho_checkpoint(caminho_zip):
+    # dados_receita/checkpoints/Estabelecimentos7.json
+    return os.path.join(DIR_CHECKPOINTS, os.path.basename(caminho_zip).replace(".zip", ".json"))
+
+def gravar_checkpoint(caminho, dados):
+    temporario = caminho + ".tmp"
+    with open(temporario, 'w', encoding='utf-8') as f:
+        json.dump(dados, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporario, caminho)
+
+def validar_checkpoint(checkpoint, sha256_zip, chave, caminho_parcial):
+    """
+    Só confia num checkpoint se ele foi gravado para o mesmo conteúdo de zip (sha256),
+    com o mesmo filtro de municípios, e se o parcial .tmp ainda tem os bytes que ele cita.
+    Retorna (ok, motivo).
+    """
+    if checkpoint.get("sha256_zip") != sha256_zip:
+        return False, "zip diferente do checkpoint (sha256 não confere)"
+    if checkpoint.get("chave_filtro") != chave:
+        return False, "filtro de municípios mudou"
+    temporario = caminho_parcial + ".tmp"
+    if not os.path.exists(temporario) or os.path.getsize(temporario) < checkpoint.get("saida_bytes", 0):
+        return False, "saída parcial ausente ou menor que o checkpoint"
+    return True, None
 
+def processar_arquivo_zip(caminho_zip, codigos, caminho_parcial, sha256_zip=None, retomar=False, fila_eventos=None):
+    """
+    Unidade de trabalho de um processo do pool: filtra um EstabelecimentosN.zip
+    e grava os registros de todos os municípios alvo em `caminho_parcial` (escrita atômica).
+    Roda em outro processo, então recebe e devolve apenas tipos simples.
+    O sha256 do zip (quando ainda não conhecido) é calculado aqui, em paralelo, e devolvido
+    para o manifesto.
+
+    Checkpoints: a cada INTERVALO_CHECKPOINT segundos grava em dados_receita/checkpoints
+    o offset descompactado, as linhas lidas e o tamanho já sincronizado do parcial.
+    Com `retomar`, um checkpoint válido (ver validar_checkpoint) faz o arquivo continuar
+    desse ponto em vez da primeira linha.
+
+    Progresso (linhas/s, encontrados, fração e ETA do arquivo) vai para `fila_eventos`
+    a cada INTERVALO_PROGRESSO segundos (ver fila_de_eventos).
+    """
+    inicio = time.time()
+    emitir = emissor_eventos(fila_eventos)
+    if sha256_zip is None:
+        sha256_zip = sha256_arquivo(caminho_zip)
+    chave = _chave_filtro(codigos)
+    nome_arquivo = os.path.basename(caminho_zip)
+    arquivo_checkpoint = caminho_checkpoint(caminho_zip)
+
+    estado = {"offset": 0, "linhas": 0, "saida_bytes": None, "encontrados": 0}
+    if retomar and os.path.exists(arquivo_checkpoint):
+        with open(arquivo_checkpoint, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        ok, motivo = validar_checkpoint(checkpoint, sha256_zip, chave, caminho_parcial)
+        if ok:
+            estado.update({k: checkpoint[k] for k in ("offset", "linhas", "saida_bytes", "encontrados")})
+            print(f"↩️ {nome_arquivo}: retomando da linha {estado['linhas']:,} ({estado['offset'] / (1024*1024):.0f} MB descompactados)")
+        else:
+            print(f"⚠️ {nome_arquivo}: checkpoint descartado ({motivo}), recomeçando do início.")
+
+    ultimo_checkpoint = [time.time()]
+    with escritor_csv_atomico(caminho_parcial, HEADER_ESTABELECIMENTOS,
+                              retomar_em=estado["saida_bytes"], manter_temporario=True) as escrever:
+
+        def checkpoint_se_preciso(offset, linhas):
+            if time.time() - ultimo_checkpoint[0] < INTERVALO_CHECKPOINT:
+                return
+            gravar_checkpoint(arquivo_checkpoint, {
+                "arquivo": nome_arquivo,
+                "sha256_zip": sha256_zip,
+                "chave_filtro": chave,
+                "offset": offset,
+                "linhas": linhas,
+                "saida_bytes": escrever.sincronizar(),
+                "encontrados": estado["encontrados"],
+                "gravado_em": datetime.now().isoformat(timespec="seconds"),
+            })
+            ultimo_checkpoint[0] = time.time()
+
+        ultimo_progresso = [time.time()]
+        inicio_parse = time.time()
+        offset_inicial, linhas_iniciais = estado["offset"], estado["linhas"]
+
+        def ao_fim_do_bloco(offset, linhas):
+            estado["linhas"] = linhas
+            checkpoint_se_preciso(offset, linhas)
+            agora = time.time()
+            if agora - ultimo_progresso[0] < INTERVALO_PROGRESSO:
+                return
+            ultimo_progresso[0] = agora
+            decorrido = max(agora - inicio_parse, 1e-6)
+            taxa_bytes = (offset - offset_inicial) / decorrido
+            emitir("parse_progresso", arquivo=nome_arquivo, offset=offset, total=tamanho_descompactado,
+                   fracao=round(offset / tamanho_descompactado, 4) if tamanho_descompactado else 0,
+                   linhas=linhas, linhas_s=round((linhas - linhas_iniciais) / decorrido), encontrados=estado["encontrados"],
+                   eta_s=round((tamanho_descompactado - offset) / taxa_bytes, 1) if taxa_bytes else None)
+
+        with abrir_zip(caminho_zip) as z:
+            nome_csv_interno = z.namelist()[0]
+            tamanho_descompactado = z.getinfo(nome_csv_interno).file_size
+            with z.open(nome_csv_interno) as f_in:
+                if estado["offset"]:
+                    # ZipExtFile só anda para frente descompactando, mas sem o custo do parse
+                    f_in.seek(estado["offset"])
+                for parts in filtrar_linhas(f_in, codigos, offset_inicial=estado["offset"],
+                                            linhas_iniciais=estado["linhas"], ao_fim_do_bloco=ao_fim_do_bloco):
+                    escrever(parts)
+                    estado["encontrados"] += 1
+
+    # Arquivo concluído e publicado: checkpoint não serve mais
+    if os.path.exists(arquivo_checkpoint):
+        os.remove(arquivo_checkpoint)
+
+    segundos = time.time() - inicio
+    emitir("parse_fim", arquivo=nome_arquivo, linhas=estado["linhas"], encontrados=estado["encontrados"],
+           segundos=round(segundos, 2), linhas_s=round((estado["linhas"] - linhas_iniciais) / max(time.time() - inicio_parse, 1e-6)))
+
+    # Opcional: Remover zip após processar
+    # os.remove(caminho_zip) 
+    return {"encontrados": estado["encontrados"], "segundos": segundos, "sha256": sha256_zip}
+
+def _chave_filtro(codigos):
+    # Identifica o conjunto de municípios que gerou um parcial
+    return ",".join(sorted(f"{codigo}/{uf or ''}" for codigo, (_, uf) in codigos.items()))
+
+def _origens_locais(nomes_arquivos, base_url, manifesto):
+    # (nome, caminho_zip, sha256) conforme cada download termina
+    for nome_arquivo, caminho_zip in baixar_em_paralelo(nomes_arquivos, base_url=base_url, manifesto=manifesto):
+        sha256_zip = hash_conhecido(caminho_zip, manifesto["arquivos"].get(nome_arquivo)) if caminho_zip else None
+        yield nome_arquivo, caminho_zip, sha256_zip
+
+def _filtrar_lotes(codigos, base_url, workers, manifesto, retomar=False, remoto=False):
+    """
+    Distribui os 10 arquivos entre `workers` processos.
+    Os downloads correm em paralelo (threads) e cada zip entra no pool assim que fica pronto.
+    Um zip com o mesmo sha256 e o mesmo filtro da execução anterior não é processado de novo:
+    o parcial já gravado é reaproveitado. O manifesto é salvo a cada arquivo concluído,
+    então um processo que morre no meio não perde os lotes que já terminaram.
+    Com `remoto`, nada é baixado: cada processo lê o zip direto da URL (ZipRemoto) e a
+    versão do arquivo vem de ETag/Last-Modified (identidade_remota) em vez do sha256.
+    Retorna [(nome_arquivo, caminho_parcial ou None)] na ordem dos lotes.
+    """
     # São 10 arquivos de estabelecimentos (0 a 9)
-    for i in range(10):
-        nome_arquivo = f"Estabelecimentos{i}.zip"
-        url = f"{BASE_URL}{nome_arquivo}"
-        caminho_zip = os.path.join(DIR_DADOS, nome_arquivo)
-        
+    nomes_arquivos = [f"Estabelecimentos{i}.zip" for i in range(10)]
+    total = len(nomes_arquivos)
+    chave = _chave_filtro(codigos)
+    concluidos = []
+    _LOG.update({"total_arquivos": total, "inicio_parse": time.time(), "fracoes": {}, "reaproveitados": set()})
+
+    def relatar(nome_arquivo, futuro):
+        concluidos.append(nome_arquivo)
         try:
-            # Baixar
-            if not os.path.exists(caminho_zip):
-                print(f"--- Baixando Lote {i+1}/10 ---")
-                success = download_file(url, caminho_zip)
-                if not success:
-                    print(f"⚠️ Pular arquivo {nome_arquivo} (Falha no download)")
-                    continue
-            
-            print(f"Processando {nome_arquivo}...")
-            
-            with zipfile.ZipFile(caminho_zip) as z:
-                nome_csv_interno = z.namelist()[0]
-                with z.open(nome_csv_interno) as f_in:
-                    for line_bytes in f_in:
-                        try:
-                            line = line_bytes.decode('latin-1')
-                            parts = line.split(';')
-                            parts = [p.strip('"') for p in parts]
-                            
-                            if len(parts) > 20:
-                                municipio_cod = parts[20]
-                                if municipio_cod == codigo_municipio:
-                                    with open(ARQUIVO_SAIDA, 'a', encoding='utf-8', newline='') as f_append:
-                                        writer = csv.writer(f_append, delimiter=';')
-                                        writer.writerow(parts)
-                        except Exception:
-                            continue 
-                            
-            # Opcional: Remover zip após processar
-            # os.remove(caminho_zip) 
-            
+            r = futuro.result()
+            print(f"✅ [{len(concluidos)}/{total}] {nome_arquivo}: {r['encontrados']} registros em {r['segundos']:.1f}s")
+            with _TRAVA_MANIFESTO:
+                if not remoto:
+                    stat = os.stat(os.path.join(DIR_DADOS, nome_arquivo))
+                    manifesto["arquivos"].setdefault(nome_arquivo, {}).update(
+                        {"sha256": r["sha256"], "tamanho": stat.st_size, "mtime": stat.st_mtime})
+                manifesto["parciais"][nome_arquivo] = {"sha256_zip": r["sha256"], "chave_filtro": chave, "encontrados": r["encontrados"]}
+                salvar_manifesto(manifesto)
         except zipfile.BadZipFile:
-            print(f"❌ Zip Corrompido: {nome_arquivo}")
+            print(f"❌ [{len(concluidos)}/{total}] Zip Corrompido: {nome_arquivo}")
         except Exception as e:
-            print(f"Erro ao processar {nome_arquivo}: {e}")
+            print(f"❌ [{len(concluidos)}/{total}] Erro ao processar {nome_arquivo}: {e}")
+
+    resultados = []
+    with fila_de_eventos() as fila, ProcessPoolExecutor(max_workers=workers) as pool:
+        if remoto:
+            origens = versoes_remotas(nomes_arquivos, base_url=base_url)
+        else:
+            origens = _origens_locais(nomes_arquivos, base_url, manifesto)
+        for nome_arquivo, caminho_zip, sha256_zip in origens:
+            if caminho_zip is None or (remoto and sha256_zip is None):
+                print(f"⚠️ Pular arquivo {nome_arquivo} (Falha no download)" if not remoto
+                      else f"⚠️ Pular arquivo {nome_arquivo} (servidor não informou o tamanho)")
+                resultados.append((nome_arquivo, None, None))
+                continue
+
+            caminho_parcial = os.path.join(DIR_PARCIAIS, nome_arquivo.replace(".zip", ".csv"))
+            anterior = manifesto["parciais"].get(nome_arquivo) or {}
+            if (sha256_zip and os.path.exists(caminho_parcial)
+                    and anterior.get("sha256_zip") == sha256_zip and anterior.get("chave_filtro") == chave):
+                concluidos.append(nome_arquivo)
+                print(f"⏭️ [{len(concluidos)}/{total}] {nome_arquivo} sem alterações desde a última execução, reaproveitando {anterior.get('encontrados', 0)} registros.")
+                registrar_evento("arquivo_reaproveitado", arquivo=nome_arquivo, encontrados=anterior.get("encontrados", 0))
+                resultados.append((nome_arquivo, caminho_parcial, None))
+                continue
+
+            print(f"Processando {nome_arquivo}...")
+            futuro = pool.submit(processar_arquivo_zip, caminho_zip, codigos, caminho_parcial, sha256_zip, retomar, fila)
+            futuro.add_done_callback(lambda f, nome=nome_arquivo: relatar(nome, f))
+            resultados.append((nome_arquivo, caminho_parcial, futuro))
+
+    # Pool encerrado: todos os futuros já terminaram
+    parciais = []
+    for nome, caminho, futuro in resultados:
+        if futuro is not None and futuro.exception() is not None:
+            manifesto["parciais"].pop(nome, None)
+            parciais.append((nome, None))
+        else:
+            parciais.append((nome, caminho))
+    return parciais
+
+def carregar_snapshot(caminho):
+    """Extração anterior de um município, indexada por CNPJ completo (básico + ordem + DV)."""
+    snapshot = {}
+    if not os.path.exists(caminho):
+        return None
+    with open(caminho, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f, delimiter=';')
+        header = next(reader, None)
+        for parts in reader:
+            if len(parts) >= len(HEADER_ESTABELECIMENTOS):
+                snapshot[parts[0] + parts[1] + parts[2]] = dict(zip(header, parts))
+    return snapshot
+
+def _registro_delta(tipo, atual, anterior, campos_alterados=()):
+    base = atual or anterior
+    anterior = anterior or {}
+    atual = atual or {}
+    return [
+        tipo, base["CNPJ_BASICO"] + base["CNPJ_ORDEM"] + base["CNPJ_DV"], ",".join(campos_alterados),
+        base.get("NOME_FANTASIA", ""), base.get("BAIRRO", ""), base.get("DATA_INICIO_ATIVIDADE", ""),
+        anterior.get("SITUACAO_CADASTRAL", ""), atual.get("SITUACAO_CADASTRAL", ""),
+        anterior.get("CNAE_PRINCIPAL", ""), atual.get("CNAE_PRINCIPAL", ""),
+        anterior.get("CNAE_SECUNDARIA", ""), atual.get("CNAE_SECUNDARIA", ""),
+    ]
+
+def comparar_com_snapshot(snapshot, parts):
+    """
+    Compara uma linha nova com a extração anterior (consome a entrada do snapshot).
+    Retorna a linha do delta ou None se nada relevante mudou.
+    - NOVO: CNPJ que não existia no mês passado.
+    - BAIXA: situação cadastral passou a 08 (Baixada).
+    - ALTERACAO: mudou situação, CNAE principal ou secundária.
+    """
+    atual = dict(zip(HEADER_ESTABELECIMENTOS, parts))
+    anterior = snapshot.pop(parts[0] + parts[1] + parts[2], None)
+    if anterior is None:
+        return _registro_delta("NOVO", atual, None)
+
+    alterados = [c for c in CAMPOS_DELTA if anterior.get(c, "") != atual.get(c, "")]
+    if not alterados:
+        return None
+    if "SITUACAO_CADASTRAL" in alterados and atual["SITUACAO_CADASTRAL"] == SITUACAO_BAIXADA:
+        return _registro_delta("BAIXA", atual, anterior, alterados)
+    return _registro_delta("ALTERACAO", atual, anterior, alterados)
+
+def processar_estabelecimentos(codigos, base_url=BASE_URL, workers=WORKERS_PADRAO, retomar=False, remoto=False):
+    """
+    Uma única passada pelos Estabelecimentos para todos os municípios de `codigos`
+    ({codigo_tom: (nome, uf)}). Cada município recebe seu próprio arquivo
+    (ver arquivo_saida_municipio); Iguatu continua em ARQUIVO_SAIDA.
+
+    Modo delta: a extração publicada na execução anterior é o snapshot do mês passado.
+    Para cada município é gerado dados/<nome>_delta_AAAAMMDD.csv com os estabelecimentos
+    novos, alterados (situação/CNAE) e baixados; quem sumiu da base sai como REMOVIDO.
+    Se algum lote falhar, a extração vai para dados/<nome>_parcial.csv e a oficial
+    (o snapshot do próximo mês) fica como estava: um lote faltando não pode virar
+    "tudo NOVO" no delta seguinte.
+
+    `retomar` (--resume): arquivos interrompidos continuam do último checkpoint válido.
+    Sem ele, checkpoints antigos são descartados e cada arquivo pendente recomeça do zero.
+
+    `remoto` (--remoto): os zips são lidos direto do servidor via HTTP Range, sem
+    passar pelo disco (ver ZipRemoto).
+    """
+    print(f"Iniciando processamento para os códigos {', '.join(codigos)} com {workers} processo(s)...")
+    preparar_pastas()
+    manifesto = carregar_manifesto()
+    if not retomar:
+        for nome_checkpoint in os.listdir(DIR_CHECKPOINTS):
+            os.remove(os.path.join(DIR_CHECKPOINTS, nome_checkpoint))
+
+    parciais = _filtrar_lotes(codigos, base_url, workers, manifesto, retomar, remoto)
+    # Só dá para afirmar que um CNPJ sumiu (e publicar o novo snapshot) se todos os lotes foram lidos
+    todos_lidos = all(caminho is not None for _, caminho in parciais)
+    if not todos_lidos:
+        faltando = ", ".join(nome for nome, caminho in parciais if caminho is None)
+        print(f"⚠️ Lotes com falha ({faltando}): extração gravada como parcial, a oficial não será substituída.")
+
+    # Junção determinística: sempre na ordem Estabelecimentos0..9, independente de qual terminou antes
+    # Saídas gravadas em .tmp e publicadas só no final (ver escritor_csv_atomico)
+    saidas = {}
+    snapshots = {}
+    deltas = {}
+    data_execucao = datetime.now().strftime("%Y%m%d")
+    with ExitStack() as pilha:
+        escritores = {}
+        for nome, _ in set(codigos.values()):
+            oficial = arquivo_saida_municipio(nome)
+            saidas[nome] = oficial if todos_lidos else oficial.replace("_oficial.csv", "_parcial.csv")
+            snapshots[nome] = carregar_snapshot(oficial)
+            deltas[nome] = []
+            escritores[nome] = pilha.enter_context(escritor_csv_atomico(saidas[nome], HEADER_ESTABELECIMENTOS))
+
+        for nome_arquivo, caminho_parcial in parciais:
+            if caminho_parcial is None:
+                continue
+            with open(caminho_parcial, 'r', encoding='utf-8', newline='') as f_parcial:
+                reader = csv.reader(f_parcial, delimiter=';')
+                next(reader, None)  # header
+                for parts in reader:
+                    nome = codigos[parts[20]][0]
+                    escritores[nome](parts)
+                    if snapshots[nome] is not None:
+                        registro = comparar_com_snapshot(snapshots[nome], parts)
+                        if registro:
+                            deltas[nome].append(registro)
+
+        # Delta publicado junto com as extrações
+        for nome, snapshot in snapshots.items():
+            if snapshot is None:
+                print(f"ℹ️ {nome}: sem extração anterior, delta não gerado nesta execução.")
+                continue
+            if todos_lidos:
+                for anterior in snapshot.values():
+                    deltas[nome].append(_registro_delta("REMOVIDO", None, anterior))
+            caminho_delta = arquivo_saida_municipio(nome).replace("_oficial.csv", f"_delta_{data_execucao}.csv")
+            with escritor_csv_atomico(caminho_delta, HEADER_DELTA) as escrever_delta:
+                for registro in deltas[nome]:
+                    escrever_delta(registro)
+            contagem = {}
+            for registro in deltas[nome]:
+                contagem[registro[0]] = contagem.get(registro[0], 0) + 1
+            resumo = ", ".join(f"{tipo}: {n}" for tipo, n in sorted(contagem.items())) or "sem mudanças"
+            print(f"📊 Delta {nome} ({resumo}): {caminho_delta}")
+
+    salvar_manifesto(manifesto)
+
+    print("Processamento concluído! Arquivos gerados:")
+    for nome, caminho in sorted(saidas.items()):
+        print(f"  {nome}: {caminho}")
+
+# --- SEGUNDO ESTÁGIO: EMPRESAS / SÓCIOS / SIMPLES (SEMI-JOIN) ---
+
+def semi_join_zip(caminho_zip, chaves, tamanho_bloco=BLOCO_LEITURA):
+    """
+    Lê um zip da RFB cuja primeira coluna é CNPJ_BASICO (Empresas, Socios, Simples)
+    e devolve só as linhas das empresas em `chaves` (set de CNPJ_BASICO em texto).
+    O lado pequeno (estabelecimentos já filtrados) fica em memória como hash set;
+    o dump inteiro é só varrido em blocos, então a memória é proporcional ao
+    resultado e não ao arquivo. A chave é conferida nos bytes (`"12345678";`)
+    antes de qualquer decode.
+    Retorna {cnpj_basico: [parts, ...]}.
+    """
+    chaves_bytes = {c.encode('ascii') for c in chaves}
+    encontrados = {}
+    with abrir_zip(caminho_zip) as z:
+        with z.open(z.namelist()[0]) as f_in:
+            resto = b''
+            while True:
+                bloco = f_in.read(tamanho_bloco)
+                if not bloco:
+                    break
+                bloco = resto + bloco
+                corte = bloco.rfind(b'\n') + 1
+                resto = bloco[corte:]
+                for linha in bloco[:corte].split(b'\n'):
+                    if linha[1:9] in chaves_bytes and linha[9:11] == b'";':
+                        parts = _parse_linha(linha)
+                        encontrados.setdefault(parts[0], []).append(parts)
+            if resto[1:9] in chaves_bytes and resto[9:11] == b'";':
+                parts = _parse_linha(resto)
+                encontrados.setdefault(parts[0], []).append(parts)
+    return encontrados
+
+def carregar_tabela_codigos(caminho_zip):
+    # Tabelas auxiliares pequenas (Cnaes, Naturezas): CODIGO;DESCRICAO
+    tabela = {}
+    with abrir_zip(caminho_zip) as z:
+        with z.open(z.namelist()[0]) as f:
+            for line in f:
+                parts = _parse_linha(line)
+                if len(parts) >= 2:
+                    tabela[parts[0]] = parts[1]
+    return tabela
+
+def _data_iso(aaaammdd):
+    # "20230115" -> "2023-01-15" (formato usado por parse_cnpja_record/analisar_leads)
+    if len(aaaammdd) == 8 and aaaammdd.isdigit() and aaaammdd != "00000000":
+        return f"{aaaammdd[:4]}-{aaaammdd[4:6]}-{aaaammdd[6:]}"
+    return ""
+
+def registro_estabelecimento(estab, municipio_nome="", empresa=None, socios=None, simples=None, cnaes=None, naturezas=None):
+    """
+    Converte uma linha de Estabelecimentos (dict HEADER_ESTABELECIMENTOS -> valor)
+    e as linhas casadas de Empresas/Socios/Simples no mesmo formato de
+    search_engine.parse_cnpja_record, para o resto do sistema não distinguir a origem.
+    """
+    cnaes = cnaes or {}
+    naturezas = naturezas or {}
+    empresa = empresa or []
+    simples = simples or []
+
+    razao = empresa[1] if len(empresa) > 1 else ""
+    fantasia = estab.get("NOME_FANTASIA", "")
+
+    cnae_p = estab.get("CNAE_PRINCIPAL", "")
+    cnaes_sec_list = []
+    for a_id in filter(None, estab.get("CNAE_SECUNDARIA", "").split(",")):
+        a_txt = cnaes.get(a_id, "")
+        cnaes_sec_list.append(f"{a_id} - {a_txt}" if a_txt else a_id)
+
+    ddd, tel = estab.get("DDD1", ""), estab.get("TELEFONE1", "")
+    phone_str = f"({ddd}) {tel}" if ddd and tel else ""
 
-    print(f"Processamento concluído! Arquivo gerado em: {ARQUIVO_SAIDA}")
+    # Natureza Jurídica (+ marcação MEI do Simples, usada no Art. 16 de analisar_leads)
+    cod_nat = empresa[2] if len(empresa) > 2 else ""
+    nat_text = naturezas.get(cod_nat, cod_nat)
+    if len(simples) > 4 and simples[4] == "S":
+        nat_text = f"{nat_text} (MEI)" if nat_text else "MEI"
+
+    try:
+        capital_social = float(empresa[4].replace(".", "").replace(",", ".")) if len(empresa) > 4 and empresa[4] else 0
+    except ValueError:
+        capital_social = 0
+
+    return {
+        "cnpj": estab.get("CNPJ_BASICO", "") + estab.get("CNPJ_ORDEM", "") + estab.get("CNPJ_DV", ""),
+        "razao_social": razao or fantasia,
+        "nome_fantasia": fantasia or razao,
+        "data_inicio_atividade": _data_iso(estab.get("DATA_INICIO_ATIVIDADE", "")),
+        "cnae_fiscal_principal": cnae_p,
+        "cnae_fiscal_descricao": cnaes.get(cnae_p, ""),
+        "cnaes_secundarios": cnaes_sec_list,
+        "municipio": municipio_nome,
+        "uf": estab.get("UF", ""),
+        "logradouro": f"{estab.get('TIPO_LOGRADOURO', '')} {estab.get('LOGRADOURO', '')}".strip(),
+        "numero": estab.get("NUMERO", ""),
+        "bairro": estab.get("BAIRRO", ""),
+        "cep": estab.get("CEP", ""),
+        "qsa": ", ".join(s[2] for s in (socios or []) if len(s) > 2 and s[2]),
+        "telefone": phone_str,
+        "natureza_juridica": nat_text,
+        "porte_receita": PORTE_EMPRESA.get(empresa[5] if len(empresa) > 5 else "", "Não Informado"),
+        "capital_social": capital_social,
+        # Extra em relação ao parse_cnpja_record: permite filtrar só as ativas na carga
+        "situacao_cadastral": estab.get("SITUACAO_CADASTRAL", "")
+    }
+
+def arquivo_enriquecido_municipio(nome):
+    # IGUATU -> dados/iguatu_enriquecido.jsonl
+    return arquivo_saida_municipio(nome).replace("_oficial.csv", "_enriquecido.jsonl")
+
+def enriquecer_estabelecimentos(codigos, base_url=BASE_URL, workers=WORKERS_PADRAO, remoto=False):
+    """
+    Segundo estágio do ETL: completa as extrações de processar_estabelecimentos com
+    razão social, capital, natureza jurídica, porte, QSA e opção pelo Simples/MEI,
+    sem nenhuma chamada paga de API.
+    1. Conjunto de CNPJ_BASICO de todas as extrações dos municípios.
+    2. Empresas0..9, Socios0..9 e Simples varridos em paralelo (semi_join_zip).
+    3. Um registro por estabelecimento no formato de parse_cnpja_record, gravado em
+       dados/<nome>_enriquecido.jsonl (um JSON por linha).
+    Com `remoto`, os zips são varridos direto do servidor (ZipRemoto), sem download.
+    """
+    preparar_pastas()
+    manifesto = carregar_manifesto()
+
+    # 1. Lado pequeno do join
+    estabelecimentos = {}
+    for nome in sorted({n for n, _ in codigos.values()}):
+        caminho = arquivo_saida_municipio(nome)
+        if not os.path.exists(caminho):
+            print(f"⚠️ {nome}: extração não encontrada ({caminho}), rode o primeiro estágio antes.")
+            continue
+        with open(caminho, 'r', encoding='utf-8', newline='') as f:
+            estabelecimentos[nome] = list(csv.DictReader(f, delimiter=';'))
+    chaves = {e["CNPJ_BASICO"] for lista in estabelecimentos.values() for e in lista}
+    if not chaves:
+        print("Nenhum estabelecimento para enriquecer.")
+        return
+    print(f"Enriquecendo {sum(len(l) for l in estabelecimentos.values())} estabelecimentos ({len(chaves)} empresas)...")
+
+    # 2. Lado grande, em paralelo
+    grandes = [f"Empresas{i}.zip" for i in range(10)] + [f"Socios{i}.zip" for i in range(10)] + ["Simples.zip"]
+    auxiliares = ["Cnaes.zip", "Naturezas.zip"]
+    empresas, socios, simples = {}, {}, {}
+    tabelas = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futuros = []
+        if remoto:
+            origens = ((nome, base_url + nome) for nome in auxiliares + grandes)
+        else:
+            origens = baixar_em_paralelo(auxiliares + grandes, base_url=base_url, manifesto=manifesto)
+        for nome_arquivo, caminho_zip in origens:
+            if caminho_zip is None:
+                print(f"⚠️ Pular arquivo {nome_arquivo} (Falha no download)")
+                continue
+            if nome_arquivo in auxiliares:
+                tabelas[nome_arquivo] = carregar_tabela_codigos(caminho_zip)
+                continue
+            print(f"Cruzando {nome_arquivo}...")
+            futuros.append((nome_arquivo, pool.submit(semi_join_zip, caminho_zip, chaves)))
+
+        for nome_arquivo, futuro in futuros:
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                print(f"❌ Erro ao cruzar {nome_arquivo}: {e}")
+                continue
+            destino = empresas if nome_arquivo.startswith("Empresas") else socios if nome_arquivo.startswith("Socios") else simples
+            for basico, linhas in resultado.items():
+                destino.setdefault(basico, []).extend(linhas)
+            print(f"✅ {nome_arquivo}: {len(resultado)} empresas casadas")
+    salvar_manifesto(manifesto)
+
+    # 3. Registros completos por município
+    cnaes = tabelas.get("Cnaes.zip", {})
+    naturezas = tabelas.get("Naturezas.zip", {})
+    for nome, lista in estabelecimentos.items():
+        caminho = arquivo_enriquecido_municipio(nome)
+        temporario = caminho + ".tmp"
+        with open(temporario, 'w', encoding='utf-8', buffering=BUFFER_SAIDA) as f_out:
+            for estab in lista:
+                basico = estab["CNPJ_BASICO"]
+                registro = registro_estabelecimento(
+                    estab, municipio_nome=nome,
+                    empresa=(empresas.get(basico) or [None])[0],
+                    socios=socios.get(basico),
+                    simples=(simples.get(basico) or [None])[0],
+                    cnaes=cnaes, naturezas=naturezas)
+                f_out.write(json.dumps(registro, ensure_ascii=False) + "\n")
+        os.replace(temporario, caminho)
+        print(f"📦 {nome}: {len(lista)} registros enriquecidos em {caminho}")
+
+# --- CARGA NA CARTEIRA (tabela empresas) ---
+
+def registros_do_municipio(nome):
+    """
+    Registros de um município no formato parse_cnpja_record, em streaming.
+    Usa dados/<nome>_enriquecido.jsonl quando existe (segundo estágio);
+    senão converte direto a extração bruta (sem razão social/QSA/capital).
+    """
+    enriquecido = arquivo_enriquecido_municipio(nome)
+    if os.path.exists(enriquecido):
+        with open(enriquecido, 'r', encoding='utf-8') as f:
+            for linha in f:
+                if linha.strip():
+                    yield json.loads(linha)
+        return
+
+    with open(arquivo_saida_municipio(nome), 'r', encoding='utf-8', newline='') as f:
+        for estab in csv.DictReader(f, delimiter=';'):
+            yield registro_estabelecimento(estab, municipio_nome=nome)
+
+def _carregar_lote(lote, totais):
+    import business_logic
+    import database
+
+    analisados = business_logic.analisar_leads(lote)
+    for p in analisados:
+        p['Rota'] = business_logic.gerar_link_rota(p, p.get('municipio'), p.get('uf'))
+    stats = database.upsert_empresas_lote(analisados)
+    for chave, valor in stats.items():
+        totais[chave] = totais.get(chave, 0) + valor
+
+def carregar_na_carteira(nomes, tamanho_lote=LOTE_CARGA, incluir_inativos=False):
+    """
+    Carga direta da extração da RFB para a tabela `empresas`.
+    Os registros passam por business_logic.analisar_leads em lotes de `tamanho_lote`
+    e cada lote é gravado em uma transação (database.upsert_empresas_lote: executemany
+    no SQLite, COPY no Postgres), em vez de um upsert_empresa por lead.
+    Por padrão só entram estabelecimentos com situação cadastral ATIVA (02).
+    """
+    import database
+    database.init_db()
+
+    for nome in nomes:
+        inicio = time.time()
+        totais = {"inserted": 0, "updated": 0, "skipped": 0, "error": 0}
+        lote = []
+        lidos = 0
+        try:
+            for registro in registros_do_municipio(nome):
+                lidos += 1
+                if not incluir_inativos and registro.get("situacao_cadastral", SITUACAO_ATIVA) != SITUACAO_ATIVA:
+                    continue
+                lote.append(registro)
+                if len(lote) >= tamanho_lote:
+                    _carregar_lote(lote, totais)
+                    lote = []
+            if lote:
+                _carregar_lote(lote, totais)
+        except FileNotFoundError:
+            print(f"⚠️ {nome}: extração não encontrada, rode o worker sem --somente-carga antes.")
+            continue
+
+        print(f"🗄️ {nome}: {lidos} lidos | Novos: {totais['inserted']} | Atualizados: {totais['updated']} | "
+              f"Ignorados: {totais['skipped']} | Erros: {totais['error']} em {time.time() - inicio:.1f}s")
+
+def _parse_municipios(texto):
+    # "IGUATU/CE,QUIXELÔ/CE,Orós" -> [("IGUATU", "CE"), ("QUIXELÔ", "CE"), ("Orós", None)]
+    alvos = []
+    for item in texto.split(","):
+        if not item.strip():
+            continue
+        nome, _, uf = item.partition("/")
+        alvos.append((nome.strip(), uf.strip() or None))
+    return alvos
 
 if __name__ == "__main__":
-    cod = encontrar_codigo_municipio()
-    if cod:
-        processar_estabelecimentos(cod)
-    else:
-        print(f"Não foi possível encontrar o código para {CIDADE_ALVO}.")
+    parser = argparse.ArgumentParser(description="Extrai os estabelecimentos dos municípios a partir dos dados abertos do CNPJ (RFB).")
+    parser.add_argument("--workers", type=int, default=WORKERS_PADRAO,
+                        help=f"Processos paralelos para o parse dos zips (padrão: {WORKERS_PADRAO})")
+    parser.add_argument("--municipios", default=f"{CIDADE_ALVO}/{UF_ALVO}",
+                        help="Lista NOME/UF separada por vírgula, ex.: IGUATU/CE,QUIXELÔ/CE,ACOPIARA/CE,ORÓS/CE")
+    parser.add_argument("--enriquecer", action="store_true",
+                        help="Depois da extração, cruza Empresas/Socios/Simples e gera dados/<nome>_enriquecido.jsonl")
+    parser.add_argument("--carregar", action="store_true",
+                        help="Ao final, carrega os estabelecimentos ativos na carteira (tabela empresas)")
+    parser.add_argument("--somente-carga", action="store_true",
+                        help="Pula download/extração e só carrega as extrações já existentes na carteira")
+    parser.add_argument("--incluir-inativos", action="store_true",
+                        help="Na carga, inclui estabelecimentos baixados/suspensos/inaptos")
+    parser.add_argument("--atualizar-municipios", action="store_true",
+                        help="Remonta a tabela de municípios (TOM/IBGE) no banco antes de extrair")
+    parser.add_argument("--remoto", action="store_true",
+                        help="Lê os zips direto do servidor (HTTP Range) sem gravá-los em disco")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continua arquivos interrompidos a partir do último checkpoint (validado pelo sha256 do zip)")
+    args = parser.parse_args()
+
+    preparar_pastas()
+    alvos = _parse_municipios(args.municipios)
+    iniciar_log_execucao(municipios=args.municipios, workers=args.workers, resume=args.resume, remoto=args.remoto,
+                         enriquecer=args.enriquecer, carregar=args.carregar or args.somente_carga)
+    status = "erro"
+    try:
+        if args.atualizar_municipios:
+            with medir_etapa("municipios_tabela"):
+                construir_tabela_municipios()
+        if args.somente_carga:
+            with medir_etapa("carga"):
+                carregar_na_carteira([nome.upper() for nome, _ in alvos], incluir_inativos=args.incluir_inativos)
+        else:
+            with medir_etapa("municipios"):
+                codigos = encontrar_codigos_municipios(alvos)
+            if codigos:
+                with medir_etapa("extracao"):
+                    processar_estabelecimentos(codigos, workers=max(1, args.workers), retomar=args.resume, remoto=args.remoto)
+                if args.enriquecer:
+                    with medir_etapa("enriquecimento"):
+                        enriquecer_estabelecimentos(codigos, workers=max(1, args.workers), remoto=args.remoto)
+                if args.carregar:
+                    with medir_etapa("carga"):
+                        carregar_na_carteira(sorted({nome for nome, _ in codigos.values()}), incluir_inativos=args.incluir_inativos)
+            else:
+                print(f"Não foi possível encontrar o código para {args.municipios}.")
+        status = "ok"
+    except KeyboardInterrupt:
+        status = "interrompido"
+        raise
+    finally:
+        finalizar_log_execucao(status)
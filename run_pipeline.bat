@@ -9,7 +9,7 @@ echo Nao feche essa janela.
 echo.
 
 cd /d "C:\Users\breno\.gemini\antigravity\scratch\radar_ambiental_iguatu"
-python receita_worker.py
+python receita_worker.py --enriquecer
 
 echo.
 echo ========================================================
@@ -74,6 +74,23 @@ CREATE TABLE IF NOT EXISTS users (
     full_name TEXT
 );
 
+-- Tabela Municípios (TOM da Receita <-> IBGE)
+CREATE TABLE IF NOT EXISTS municipios (
+    codigo_tom TEXT PRIMARY KEY,
+    codigo_ibge TEXT,
+    nome TEXT,
+    nome_normalizado TEXT,
+    uf TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_municipios_ibge ON municipios (codigo_ibge);
+CREATE INDEX IF NOT EXISTS idx_municipios_nome ON municipios (nome_normalizado, uf);
+
+-- Tabela Créditos de API (consumo mensal do CNPJá)
+CREATE TABLE IF NOT EXISTS creditos_api (
+    mes TEXT PRIMARY KEY,
+    consumidos INTEGER DEFAULT 0
+);
+
 -- Admin Default (Senha: admin)
 INSERT INTO users (username, password_hash, full_name) 
 VALUES ('admin', '8c6976e5b5410415bde908bd4dee15dfb167a9c873fc4bb8a81f6f2ab448a918', 'Administrador')
@@ -1,70 +1,503 @@
+import bisect
+import io
+import json
+import os
 import random
+from email.utils import parsedate_to_datetime
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import ExitStack
 from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import cnae_mapping
 
-def gerar_cnpj_ficticio():
-    def d(n): return [random.randint(0, 9) for _ in range(n)]
+# --- CLIENTE HTTP COMPARTILHADO (CNPJá / BrasilAPI) ---
+# Uma Session com pool de conexões keep-alive: as consultas em sequência (ou em threads)
+# reaproveitam a conexão TCP+TLS em vez de abrir uma nova por CNPJ.
+TIMEOUT_CONEXAO = 5     # segundos para abrir a conexão
+TIMEOUT_LEITURA = 20    # segundos esperando a resposta
+TENTATIVAS_HTTP = 3     # novas tentativas em erro de conexão / 5xx
+BACKOFF_HTTP = 0.5      # 0.5s, 1s, 2s entre tentativas
+MAX_CONEXOES_POR_HOST = 16
+AMOSTRAS_LATENCIA = 500  # últimas N chamadas por endpoint nas estatísticas
+MAX_CONSULTAS_PARALELAS = 4    # consultas de detalhe simultâneas no enriquecimento em lote
+# Token bucket por provedor: (requisições/s, rajada máxima). Vale para todas as chamadas.
+LIMITES_TAXA = {"cnpja": (5, 5), "brasilapi": (3, 3)}
+TENTATIVAS_429 = 4       # novas tentativas quando a API responde 429
+BACKOFF_429 = 2.0        # base do backoff exponencial (com jitter) sem Retry-After
+# Orçamento de créditos do CNPJá (consultas servidas pelo cache não gastam crédito)
+CUSTO_CREDITOS = {"cnpja_office": 1, "cnpja_busca": 1}  # por requisição (uma página na busca)
+ORCAMENTO_CREDITOS_EXECUCAO = 300
+ORCAMENTO_CREDITOS_MES = 5000
+TAMANHO_PAGINA_CNPJA = 100     # registros por página na varredura (/office)
+MAX_PAGINAS_VARREDURA = 10     # orçamento padrão de páginas por varredura
+HEDGE_ATRASO_PADRAO = 1.5       # segundos até disparar o provedor secundário sem histórico de latência
+HEDGE_ATRASO_MINIMO = 0.2
+HEDGE_AMOSTRAS_MINIMAS = 20     # chamadas de um endpoint antes de confiar no p90 dele
+TAXA_ERRO_MAX_PRIMARIO = 0.2    # acima disso o provedor perde a vez de primário
+
+_SESSAO = None
+_TRAVA_SESSAO = threading.Lock()
+_LATENCIAS = {}
+_TRAVA_LATENCIAS = threading.Lock()
+
+def _criar_sessao():
+    retry = Retry(
+        total=TENTATIVAS_HTTP,
+        connect=TENTATIVAS_HTTP,
+        read=TENTATIVAS_HTTP,
+        status=TENTATIVAS_HTTP,
+        backoff_factor=BACKOFF_HTTP,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=MAX_CONEXOES_POR_HOST)
+    sessao = requests.Session()
+    sessao.mount("https://", adapter)
+    sessao.mount("http://", adapter)
+    return sessao
+
+def get_sessao():
+    """Session HTTP compartilhada (criada na primeira chamada, segura para uso entre threads)."""
+    global _SESSAO
+    if _SESSAO is None:
+        with _TRAVA_SESSAO:
+            if _SESSAO is None:
+                _SESSAO = _criar_sessao()
+    return _SESSAO
+
+def configurar_cliente(timeout_conexao=None, timeout_leitura=None, tentativas=None, backoff=None):
+    """Ajusta timeouts/retry do cliente; a Session é recriada na próxima chamada."""
+    global _SESSAO, TIMEOUT_CONEXAO, TIMEOUT_LEITURA, TENTATIVAS_HTTP, BACKOFF_HTTP
+    with _TRAVA_SESSAO:
+        if timeout_conexao is not None:
+            TIMEOUT_CONEXAO = timeout_conexao
+        if timeout_leitura is not None:
+            TIMEOUT_LEITURA = timeout_leitura
+        if tentativas is not None:
+            TENTATIVAS_HTTP = tentativas
+        if backoff is not None:
+            BACKOFF_HTTP = backoff
+        if _SESSAO is not None:
+            _SESSAO.close()
+        _SESSAO = None
+
+class ErroCNPJa(Exception):
+    """Erro da API do CNPJá com mensagem pronta para a interface."""
+
+class OrcamentoEsgotado(ErroCNPJa):
+    """A chamada estouraria o orçamento de créditos da execução ou do mês."""
+
+class BaldeTokens:
+    """
+    Token bucket compartilhado entre threads: `taxa` fichas/s, acumulando até `capacidade`.
+    `pausar` segura todo mundo (usado com o Retry-After de um 429).
+    """
+
+    def __init__(self, taxa, capacidade=None):
+        self.taxa = taxa
+        self.capacidade = capacidade or max(1, taxa)
+        self.tokens = self.capacidade
+        self.atualizado = time.monotonic()
+        self.bloqueado_ate = 0
+        self.trava = threading.Lock()
+
+    def aguardar(self):
+        while True:
+            with self.trava:
+                agora = time.monotonic()
+                if agora < self.bloqueado_ate:
+                    espera = self.bloqueado_ate - agora
+                else:
+                    self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado) * self.taxa)
+                    self.atualizado = agora
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    espera = (1 - self.tokens) / self.taxa
+            time.sleep(espera)
+
+    def pausar(self, segundos):
+        with self.trava:
+            self.bloqueado_ate = max(self.bloqueado_ate, time.monotonic() + segundos)
+
+_LIMITADORES = {provedor: BaldeTokens(*limite) for provedor, limite in LIMITES_TAXA.items()}
+
+def _limitador(endpoint):
+    # "cnpja_office" -> balde do "cnpja"
+    return _LIMITADORES.get(endpoint.split("_")[0])
+
+def _espera_retry_after(response):
+    valor = response.headers.get("Retry-After")
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(valor) - datetime.now(parsedate_to_datetime(valor).tzinfo)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+# --- ORÇAMENTO DE CRÉDITOS (execução e mês, persistido em database.creditos_api) ---
+_CREDITOS = {"execucao": 0, "mes": None, "consumidos_mes": 0}
+_TRAVA_CREDITOS = threading.Lock()
+
+def iniciar_execucao():
+    """Zera o contador de créditos da execução (uma varredura, uma importação...)."""
+    with _TRAVA_CREDITOS:
+        _CREDITOS["execucao"] = 0
+
+def _consumo_mes():
+    # Chamado com _TRAVA_CREDITOS; relê do banco na virada do mês
+    mes = datetime.now().strftime("%Y-%m")
+    if _CREDITOS["mes"] != mes:
+        try:
+            import database
+            _CREDITOS["consumidos_mes"] = database.get_creditos_mes(mes)
+        except Exception as e:
+            print(f"Aviso: não foi possível ler o consumo de créditos ({e}).")
+            _CREDITOS["consumidos_mes"] = 0
+        _CREDITOS["mes"] = mes
+    return _CREDITOS["consumidos_mes"]
+
+def _reservar_creditos(endpoint):
+    custo = CUSTO_CREDITOS.get(endpoint, 0)
+    if not custo:
+        return 0
+    with _TRAVA_CREDITOS:
+        if _CREDITOS["execucao"] + custo > ORCAMENTO_CREDITOS_EXECUCAO:
+            raise OrcamentoEsgotado(f"Orçamento da execução atingido ({ORCAMENTO_CREDITOS_EXECUCAO} créditos).")
+        if _consumo_mes() + custo > ORCAMENTO_CREDITOS_MES:
+            raise OrcamentoEsgotado(f"Orçamento mensal atingido ({ORCAMENTO_CREDITOS_MES} créditos).")
+        _CREDITOS["execucao"] += custo
+        _CREDITOS["consumidos_mes"] += custo
+    return custo
+
+def _confirmar_creditos(custo, cobrado):
+    if not custo:
+        return
+    if not cobrado:
+        with _TRAVA_CREDITOS:
+            _CREDITOS["execucao"] -= custo
+            _CREDITOS["consumidos_mes"] -= custo
+        return
+    try:
+        import database
+        database.registrar_creditos(_CREDITOS["mes"] or datetime.now().strftime("%Y-%m"), custo)
+    except Exception as e:
+        print(f"Aviso: não foi possível registrar créditos ({e}).")
+
+def saldo_creditos():
+    """{"execucao", "mes", "restante_execucao", "restante_mes"} em créditos do CNPJá."""
+    with _TRAVA_CREDITOS:
+        mes = _consumo_mes()
+        return {
+            "execucao": _CREDITOS["execucao"],
+            "mes": mes,
+            "restante_execucao": ORCAMENTO_CREDITOS_EXECUCAO - _CREDITOS["execucao"],
+            "restante_mes": ORCAMENTO_CREDITOS_MES - mes,
+        }
+
+def http_get(endpoint, url, timeout=None, **kwargs):
+    """
+    GET pela Session compartilhada, registrando a latência em `endpoint`
+    (nome lógico, ex.: "cnpja_office"). Retries e backoff de 5xx ficam no HTTPAdapter.
+    Antes de cada tentativa espera uma ficha do balde do provedor; um 429 pausa o
+    balde pelo Retry-After (ou backoff exponencial com jitter) e tenta de novo.
+    Endpoints pagos reservam créditos do orçamento (OrcamentoEsgotado se não couber);
+    só respostas 200 ficam registradas como consumo.
+    Exceções de conexão (após as tentativas) sobem para quem chamou.
+    """
+    custo = _reservar_creditos(endpoint)
+    limitador = _limitador(endpoint)
+    cobrado = False
+    try:
+        for tentativa in range(TENTATIVAS_429 + 1):
+            if limitador:
+                limitador.aguardar()
+            inicio = time.perf_counter()
+            erro = True
+            try:
+                response = get_sessao().get(url, timeout=timeout or (TIMEOUT_CONEXAO, TIMEOUT_LEITURA), **kwargs)
+                erro = response.status_code >= 500
+            finally:
+                _registrar_latencia(endpoint, time.perf_counter() - inicio, erro)
+
+            if response.status_code != 429 or tentativa == TENTATIVAS_429:
+                break
+            espera = _espera_retry_after(response)
+            if espera is None:
+                espera = BACKOFF_429 * (2 ** tentativa)
+            espera *= random.uniform(1.0, 1.5)  # jitter: threads não voltam todas juntas
+            print(f"Aviso: 429 em {endpoint}, nova tentativa em {espera:.1f}s.")
+            if limitador:
+                limitador.pausar(espera)
+            else:
+                time.sleep(espera)
+        cobrado = response.status_code == 200
+        return response
+    finally:
+        _confirmar_creditos(custo, cobrado)
+
+def _registrar_latencia(endpoint, segundos, erro):
+    with _TRAVA_LATENCIAS:
+        stats = _LATENCIAS.setdefault(endpoint, {"amostras": deque(maxlen=AMOSTRAS_LATENCIA), "chamadas": 0, "erros": 0})
+        stats["amostras"].append(segundos)
+        stats["chamadas"] += 1
+        stats["erros"] += int(erro)
+
+def _percentil(ordenadas, p):
+    if not ordenadas:
+        return None
+    return ordenadas[min(len(ordenadas) - 1, int(p * len(ordenadas)))]
+
+def estatisticas_latencia():
+    """{endpoint: {"chamadas", "erros", "media_ms", "p50_ms", "p90_ms", "max_ms"}} das últimas chamadas."""
+    resultado = {}
+    with _TRAVA_LATENCIAS:
+        for endpoint, stats in _LATENCIAS.items():
+            ordenadas = sorted(stats["amostras"])
+            resultado[endpoint] = {
+                "chamadas": stats["chamadas"],
+                "erros": stats["erros"],
+                "media_ms": round(1000 * sum(ordenadas) / len(ordenadas), 1) if ordenadas else None,
+                "p50_ms": round(1000 * _percentil(ordenadas, 0.5), 1) if ordenadas else None,
+                "p90_ms": round(1000 * _percentil(ordenadas, 0.9), 1) if ordenadas else None,
+                "max_ms": round(1000 * ordenadas[-1], 1) if ordenadas else None,
+            }
+    return resultado
+
+# --- CACHE LOCAL DE CONSULTAS POR CNPJ (cache_api.db) ---
+# Resposta bruta (JSON) de cada provedor por CNPJ normalizado, com a hora da busca.
+# - Dentro do TTL: devolve do cache, sem chamada (e sem gastar crédito do CNPJá).
+# - Vencido há menos de CACHE_JANELA_STALE_DIAS: devolve o valor antigo na hora e
+#   atualiza em segundo plano (stale-while-revalidate).
+# - Acima de CACHE_MAX_REGISTROS, os menos acessados recentemente saem (LRU).
+CACHE_DB_PATH = "cache_api.db"
+CACHE_TTL_DIAS = 30
+CACHE_JANELA_STALE_DIAS = 30
+CACHE_MAX_REGISTROS = 20000
+
+_CACHE_CONTADORES = {"hits": 0, "stale": 0, "misses": 0, "creditos_economizados": 0, "revalidacoes": 0}
+_TRAVA_CACHE = threading.Lock()
+_REVALIDANDO = set()
+_POOL_REVALIDACAO = None
+
+def _conexao_cache():
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_cnpj (
+            provedor TEXT,
+            cnpj TEXT,
+            resposta TEXT,
+            buscado_em REAL,
+            acessado_em REAL,
+            PRIMARY KEY (provedor, cnpj)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_cnpj_acesso ON cache_cnpj (acessado_em)")
+    return conn
+
+def _cache_ler(provedor, cnpj):
+    conn = _conexao_cache()
+    try:
+        linha = conn.execute("SELECT resposta, buscado_em FROM cache_cnpj WHERE provedor = ? AND cnpj = ?",
+                             (provedor, cnpj)).fetchone()
+        if linha:
+            conn.execute("UPDATE cache_cnpj SET acessado_em = ? WHERE provedor = ? AND cnpj = ?",
+                         (time.time(), provedor, cnpj))
+            conn.commit()
+    finally:
+        conn.close()
+    if not linha:
+        return None, None
+    return json.loads(linha[0]), time.time() - linha[1]
+
+def _cache_idade(provedor, cnpj):
+    # Só consulta (não conta acesso nem estatística): idade em segundos ou None
+    try:
+        conn = _conexao_cache()
+        try:
+            linha = conn.execute("SELECT buscado_em FROM cache_cnpj WHERE provedor = ? AND cnpj = ?",
+                                 (provedor, cnpj)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return time.time() - linha[0] if linha else None
+
+def _cache_gravar(provedor, cnpj, resposta):
+    agora = time.time()
+    conn = _conexao_cache()
+    try:
+        conn.execute("INSERT OR REPLACE INTO cache_cnpj (provedor, cnpj, resposta, buscado_em, acessado_em) VALUES (?, ?, ?, ?, ?)",
+                     (provedor, cnpj, json.dumps(resposta, ensure_ascii=False), agora, agora))
+        # Limite de tamanho: remove os acessados há mais tempo
+        excesso = conn.execute("SELECT COUNT(*) FROM cache_cnpj").fetchone()[0] - CACHE_MAX_REGISTROS
+        if excesso > 0:
+            conn.execute("""
+                DELETE FROM cache_cnpj WHERE rowid IN (
+                    SELECT rowid FROM cache_cnpj ORDER BY acessado_em LIMIT ?
+                )
+            """, (excesso,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def _contar(chave, n=1):
+    with _TRAVA_CACHE:
+        _CACHE_CONTADORES[chave] += n
+
+def _revalidar(provedor, cnpj, buscar):
+    try:
+        resposta = buscar()
+        if resposta is not None:
+            _cache_gravar(provedor, cnpj, resposta)
+            _contar("revalidacoes")
+    finally:
+        with _TRAVA_CACHE:
+            _REVALIDANDO.discard((provedor, cnpj))
+
+def _agendar_revalidacao(provedor, cnpj, buscar):
+    global _POOL_REVALIDACAO
+    with _TRAVA_CACHE:
+        if (provedor, cnpj) in _REVALIDANDO:
+            return
+        _REVALIDANDO.add((provedor, cnpj))
+        if _POOL_REVALIDACAO is None:
+            _POOL_REVALIDACAO = ThreadPoolExecutor(max_workers=2)
+    _POOL_REVALIDACAO.submit(_revalidar, provedor, cnpj, buscar)
+
+def consultar_com_cache(provedor, cnpj, buscar, usar_cache=True):
+    """
+    Resposta bruta de `provedor` para `cnpj`, passando pelo cache local.
+    `buscar()` faz a chamada real e devolve o JSON (ou None, que não é guardado).
+    """
+    if not usar_cache:
+        return buscar()
+    try:
+        resposta, idade = _cache_ler(provedor, cnpj)
+    except sqlite3.Error as e:
+        print(f"Aviso: cache indisponível ({e}), consultando direto.")
+        return buscar()
+
+    if resposta is not None:
+        if idade <= CACHE_TTL_DIAS * 86400:
+            _contar("hits")
+            if provedor == "cnpja":
+                _contar("creditos_economizados")
+            return resposta
+        if idade <= (CACHE_TTL_DIAS + CACHE_JANELA_STALE_DIAS) * 86400:
+            _contar("stale")
+            if provedor == "cnpja":
+                _contar("creditos_economizados")
+            _agendar_revalidacao(provedor, cnpj, buscar)
+            return resposta
+
+    _contar("misses")
+    resposta = buscar()
+    if resposta is not None:
+        try:
+            _cache_gravar(provedor, cnpj, resposta)
+        except sqlite3.Error as e:
+            print(f"Aviso: não foi possível gravar no cache ({e}).")
+    return resposta
+
+def estatisticas_cache():
+    """Contadores do cache desde que o processo subiu + quantidade de registros guardados."""
+    with _TRAVA_CACHE:
+        stats = dict(_CACHE_CONTADORES)
+    consultas = stats["hits"] + stats["stale"] + stats["misses"]
+    stats["taxa_acerto"] = round((stats["hits"] + stats["stale"]) / consultas, 3) if consultas else None
+    try:
+        conn = _conexao_cache()
+        stats["registros"] = conn.execute("SELECT COUNT(*) FROM cache_cnpj").fetchone()[0]
+        conn.close()
+    except sqlite3.Error:
+        stats["registros"] = None
+    return stats
+
+def gerar_cnpj_ficticio(rnd=random):
+    def d(n): return [rnd.randint(0, 9) for _ in range(n)]
     return "".join(map(str, d(14)))
 
-def gerar_data_abertura_recente():
+def gerar_data_abertura_recente(rnd=random):
     # Gera uma data nos últimos 120 dias (com 30% de chance)
     # ou uma data mais antiga (70% de chance) para testar os filtros corretamente
-    if random.random() < 0.3:
-        dias = random.randint(0, 119)
+    if rnd.random() < 0.3:
+        dias = rnd.randint(0, 119)
     else:
-        dias = random.randint(366, 365*5) # Entre 1 e 5 anos atrás
+        dias = rnd.randint(366, 365*5) # Entre 1 e 5 anos atrás
     
     data = datetime.now() - timedelta(days=dias)
     return data.strftime("%Y-%m-%d")
 
-def buscar_cnpj_brasilapi(cnpj):
+def _buscar_brasilapi_bruto(cnpj_limpo):
+    url = f"https://brasilapi.com.br/api/cnpj/v1/{cnpj_limpo}"
+    response = http_get("brasilapi_cnpj", url, timeout=(TIMEOUT_CONEXAO, 10))
+    if response.status_code == 200:
+        return response.json()
+    return None
+
+def buscar_cnpj_brasilapi(cnpj, usar_cache=True):
     """
-    Busca dados reais de um CNPJ na BrasilAPI.
+    Busca dados reais de um CNPJ na BrasilAPI (passando pelo cache local),
+    normalizados no formato de parse_cnpja_record.
     """
     cnpj_limpo = "".join(filter(str.isdigit, cnpj))
     try:
-        url = f"https://brasilapi.com.br/api/cnpj/v1/{cnpj_limpo}"
-        response = requests.get(url, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            # Normalizar para o formato esperado pelo sistema
-            return {
-                "cnpj": data.get("cnpj"),
-                "razao_social": data.get("razao_social"),
-                "nome_fantasia": data.get("nome_fantasia") or data.get("razao_social"),
-                "data_inicio_atividade": data.get("data_inicio_atividade"),
-                "cnae_fiscal_principal": data.get("cnae_fiscal_principal", {}).get("code"), # BrasilAPI retorna objeto
-                "cnae_fiscal_descricao": data.get("cnae_fiscal_principal", {}).get("text"),
-                "municipio": data.get("municipio"),
-                "uf": data.get("uf"),
-                "logradouro": data.get("logradouro"),
-                "numero": data.get("numero"),
-                "bairro": data.get("bairro")
-            }
-        else:
-            return None
+        data = consultar_com_cache("brasilapi", cnpj_limpo, lambda: _buscar_brasilapi_bruto(cnpj_limpo), usar_cache)
+        return parse_brasilapi_record(data) if data else None
     except Exception as e:
         print(f"Erro na API: {e}")
         return None
 
-def buscar_empresas(cidade_ibge="2305506", cnae_alvo=None, mock_mode=True, cnpj_especifico=None):
+# Cidade padrão do app: resolve mesmo antes de o receita_worker montar a tabela municipios
+MUNICIPIO_PADRAO = {"codigo_tom": "1387", "codigo_ibge": "2305506", "nome": "IGUATU", "uf": "CE"}
+
+def resolver_municipio_ibge(codigo_ibge):
+    """
+    Município pelo código IBGE, via tabela municipios do banco (montada pelo receita_worker).
+    Retorna dict com codigo_tom, codigo_ibge, nome, uf ou None se o código não estiver na tabela
+    (a cidade padrão, MUNICIPIO_PADRAO, é sempre conhecida).
+    """
+    import database
+    municipio = database.municipio_por_ibge(codigo_ibge)
+    if municipio is None and str(codigo_ibge) == MUNICIPIO_PADRAO["codigo_ibge"]:
+        return dict(MUNICIPIO_PADRAO)
+    return municipio
+
+def buscar_empresas(cidade_ibge="2305506", cnae_alvo=None, mock_mode=True, cnpj_especifico=None, seed=None,
+                    api_key=None):
     """
     Busca empresas.
-    - Se cnpj_especifico for fornecido: busca dados REAIS na BrasilAPI (ignora mock_mode).
-    - Se mock_mode=True: gera dados fictícios.
+    - Se cnpj_especifico for fornecido: busca dados REAIS (consultar_cnpj: BrasilAPI e, com
+      `api_key`, CNPJá como segundo provedor) e ignora mock_mode.
+    - Se mock_mode=True: gera dados fictícios (com `seed`, sempre os mesmos; bases grandes
+      ficam com gerar_dados_sinteticos.py).
+    - Senão: consulta a extração local da Receita (buscar_base_local).
     """
     
     resultados = []
 
     # 1. Busca Real por CNPJ Específico (Prioridade)
     if cnpj_especifico:
-        dados_reais = buscar_cnpj_brasilapi(cnpj_especifico)
+        dados_reais, _ = consultar_cnpj(cnpj_especifico, api_key=api_key)
         if dados_reais:
             resultados.append(dados_reais)
         return resultados
     
     # 2. Modo Mock (Demonstração de Lote)
     if mock_mode:
+        rnd = random.Random(seed)
         # Gerar 20 leads fictícios para teste
         # Misturar CNAEs do alvo com aleatórios
         
@@ -78,54 +511,239 @@ def buscar_empresas(cidade_ibge="2305506", cnae_alvo=None, mock_mode=True, cnpj_
         nomes_comercio = ["Mercadinho", "Posto", "Oficina", "Farmácia", "Padaria"]
         nomes_industria = ["Indústria", "Fábrica", "Confecção", "Serraria", "Reciclagem"]
         sobrenomes = ["do João", "Iguatu", "Ceará", "Progresso", "Central", "Norte", "Sul"]
+        municipio = resolver_municipio_ibge(cidade_ibge)
+        if municipio is None:
+            print(f"Município IBGE {cidade_ibge} não encontrado na tabela de municípios.")
+            return resultados
         
         for _ in range(50):
-            tipo = random.choice(["EIRELI", "LTDA", "MEI", "S.A."])
-            setor = random.choice([nomes_comercio, nomes_industria])
-            nome_fantasia = f"{random.choice(setor)} {random.choice(sobrenomes)}"
+            tipo = rnd.choice(["EIRELI", "LTDA", "MEI", "S.A."])
+            setor = rnd.choice([nomes_comercio, nomes_industria])
+            nome_fantasia = f"{rnd.choice(setor)} {rnd.choice(sobrenomes)}"
             razao_social = f"{nome_fantasia.upper()} {tipo}"
             
             # Escolhe um CNAE: 50% chance de ser um dos CNAEs alvo (se houver), 50% aleatório
             cnae_escolhido = "0000-0/00"
-            if cnaes_possiveis and random.random() < 0.6:
-                cnae_escolhido = random.choice(cnaes_possiveis)
+            if cnaes_possiveis and rnd.random() < 0.6:
+                cnae_escolhido = rnd.choice(cnaes_possiveis)
             else:
-                cnae_escolhido = f"{random.randint(1000,9999)}-{random.randint(0,9)}/{random.randint(0,99):02d}"
+                cnae_escolhido = f"{rnd.randint(1000,9999)}-{rnd.randint(0,9)}/{rnd.randint(0,99):02d}"
 
             
             empresa = {
-                "cnpj": gerar_cnpj_ficticio(),
+                "cnpj": gerar_cnpj_ficticio(rnd),
                 "razao_social": razao_social,
                 "nome_fantasia": nome_fantasia,
-                "data_inicio_atividade": gerar_data_abertura_recente(),
+                "data_inicio_atividade": gerar_data_abertura_recente(rnd),
                 "cnae_fiscal_principal": cnae_escolhido,
-                "municipio": "IGUATU",
-                "uf": "CE",
-                "municipio": "IGUATU",
-                "uf": "CE",
-                "bairro": random.choice(["Centro", "Flores", "Brasília", "Alto do Jucá", "Areias", "Veneza"]),
+                "municipio": municipio["nome"],
+                "uf": municipio["uf"],
+                "bairro": rnd.choice(["Centro", "Flores", "Brasília", "Alto do Jucá", "Areias", "Veneza"]),
                 "logradouro": "Rua Exemplo",
-                "numero": str(random.randint(10, 999)),
-                "cnaes_secundarios": [f"{random.randint(1000,9999)}-{random.randint(0,9)}/{random.randint(0,99):02d}" for _ in range(random.randint(0, 3))]
+                "numero": str(rnd.randint(10, 999)),
+                "cnaes_secundarios": [f"{rnd.randint(1000,9999)}-{rnd.randint(0,9)}/{rnd.randint(0,99):02d}" for _ in range(rnd.randint(0, 3))]
             }
             resultados.append(empresa)
             
     else:
-        # Busca sem CNPJ específico e sem Mock não é suportada por APIs gratuitas para "Varredura da Cidade"
-        pass
+        # Varredura da Cidade sem mock: extração local da Receita (sem créditos)
+        cnaes = cnae_alvo if isinstance(cnae_alvo, list) else ([cnae_alvo] if cnae_alvo else None)
+        resultados = buscar_base_local(cidade_ibge, cnaes)[0] or []
 
     return resultados
 
 import re
 
+# --- EXTRAÇÃO DE CNPJs DE TEXTOS E ARQUIVOS ---
+# Formatado (11.222.333/0001-81), parcial ou só os 14 dígitos, sem colar em outros números.
+# re.ASCII: \d só casa 0-9 (dígitos Unicode, ex. arábico-índicos, não viram candidatos).
+REGEX_CNPJ = re.compile(r"(?<!\d)(\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2})(?!\d)", re.ASCII)
+TAMANHO_BLOCO_EXTRACAO = 1024 * 1024   # caracteres lidos por vez de TXT/CSV
+LINHAS_BLOCO_XLSX = 5000               # linhas de planilha por bloco
+TAMANHO_LOTE_CNPJS = 500               # CNPJs válidos por lote entregue
+TAMANHO_MAXIMO_CNPJ = 18              # "11.222.333/0001-81"
+MENOR_CNPJ_NUMERICO = 10 ** 11         # célula numérica com 12+ dígitos: CNPJ sem os zeros à esquerda
+_PESOS_DV1 = (5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+_PESOS_DV2 = (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+
+def validar_cnpjs(cnpjs):
+    """
+    Máscara (lista de bool) dos CNPJs de 14 dígitos com dígitos verificadores corretos,
+    calculada de uma vez para o bloco todo (numpy). Sequências repetidas (000...0) são inválidas.
+    """
+    import numpy as np
+
+    if not cnpjs:
+        return []
+    digitos = (np.frombuffer("".join(cnpjs).encode("ascii"), dtype=np.uint8).reshape(-1, 14) - 48).astype(np.int32)
+    resto1 = (digitos[:, :12] @ np.array(_PESOS_DV1)) % 11
+    dv1 = np.where(resto1 < 2, 0, 11 - resto1)
+    resto2 = (digitos[:, :12] @ np.array(_PESOS_DV2[:12]) + dv1 * _PESOS_DV2[12]) % 11
+    dv2 = np.where(resto2 < 2, 0, 11 - resto2)
+    repetidos = (digitos == digitos[:, :1]).all(axis=1)
+    return ((digitos[:, 12] == dv1) & (digitos[:, 13] == dv2) & ~repetidos).tolist()
+
+def _candidatos_texto(arquivo, tamanho_bloco):
+    # Ocorrências de REGEX_CNPJ em um texto lido em blocos, uma lista por bloco.
+    # Só contam as que começam até TAMANHO_MAXIMO_CNPJ caracteres antes do fim do bloco
+    # (o lookahead ainda enxerga o caractere seguinte); o resto passa para o próximo bloco
+    # com 1 caractere de contexto para o lookbehind. Um CNPJ no limite entre dois blocos
+    # é lido inteiro, e uma vez só, mesmo em texto sem separadores.
+    resto, inicio = "", 0
+    while True:
+        bloco = arquivo.read(tamanho_bloco)
+        texto = resto + bloco
+        fim = len(texto) - TAMANHO_MAXIMO_CNPJ if bloco else len(texto)
+        if fim <= inicio:
+            if not bloco:
+                return
+            resto = texto
+            continue
+        candidatos = []
+        proximo = fim
+        for m in REGEX_CNPJ.finditer(texto, inicio):
+            if m.start() >= fim:
+                break
+            candidatos.append(m.group(1))
+            proximo = max(proximo, m.end())
+        yield candidatos
+        if not bloco:
+            return
+        resto, inicio = texto[proximo - 1:], 1
+
+def _celula_texto(valor):
+    # Planilhas guardam CNPJ como número e perdem os zeros à esquerda. Só completa números
+    # que já têm 12 a 14 dígitos: IDs e telefones curtos completados com zeros passariam no
+    # dígito verificador em ~1% dos casos e virariam consultas pagas.
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    if isinstance(valor, int) and not isinstance(valor, bool):
+        return str(valor).zfill(14) if MENOR_CNPJ_NUMERICO <= valor < 10 ** 14 else str(valor)
+    return "" if valor is None else str(valor)
+
+def _blocos_xlsx(arquivo, linhas_bloco):
+    from openpyxl import load_workbook
+
+    planilhas = load_workbook(arquivo, read_only=True, data_only=True)
+    try:
+        for aba in planilhas.worksheets:
+            linhas = []
+            for linha in aba.iter_rows(values_only=True):
+                linhas.append(";".join(_celula_texto(v) for v in linha))
+                if len(linhas) >= linhas_bloco:
+                    yield "\n".join(linhas)
+                    linhas = []
+            if linhas:
+                yield "\n".join(linhas)
+    finally:
+        planilhas.close()
+
+def extrair_cnpjs_arquivo(origem, nome=None, tamanho_lote=TAMANHO_LOTE_CNPJS, estatisticas=None,
+                          tamanho_bloco=TAMANHO_BLOCO_EXTRACAO):
+    """
+    Lê um TXT/CSV/XLSX aos poucos e gera listas de até `tamanho_lote` CNPJs (14 dígitos)
+    válidos e sem repetição, na ordem em que aparecem.
+    `origem`: caminho ou arquivo binário aberto (ex.: st.file_uploader); o tipo vem da
+    extensão de `nome` (ou do próprio caminho/arquivo). Qualquer coluna serve.
+    `estatisticas` (dict opcional) recebe "encontrados", "invalidos" e "duplicados".
+    """
+    nome = nome or (origem if isinstance(origem, str) else getattr(origem, "name", ""))
+    stats = estatisticas if estatisticas is not None else {}
+    stats.update(encontrados=0, invalidos=0, duplicados=0)
+    vistos = set()
+    lote = []
+
+    with ExitStack() as pilha:
+        if str(nome).lower().endswith((".xlsx", ".xlsm")):
+            # Cada bloco são linhas inteiras da planilha: nenhum CNPJ fica dividido
+            blocos = (REGEX_CNPJ.findall(b) for b in _blocos_xlsx(origem, LINHAS_BLOCO_XLSX))
+        else:
+            binario = pilha.enter_context(open(origem, "rb")) if isinstance(origem, str) else origem
+            texto = io.TextIOWrapper(binario, encoding="utf-8", errors="replace", newline="")
+            if not isinstance(origem, str):
+                pilha.callback(texto.detach)  # o arquivo de quem chamou continua aberto
+            blocos = _candidatos_texto(texto, tamanho_bloco)
+
+        for encontrados in blocos:
+            candidatos = [re.sub(r"[^0-9]", "", m) for m in encontrados]
+            stats["encontrados"] += len(candidatos)
+            for cnpj, valido in zip(candidatos, validar_cnpjs(candidatos)):
+                if not valido:
+                    stats["invalidos"] += 1
+                elif cnpj in vistos:
+                    stats["duplicados"] += 1
+                else:
+                    vistos.add(cnpj)
+                    lote.append(cnpj)
+                    if len(lote) >= tamanho_lote:
+                        yield lote
+                        lote = []
+    if lote:
+        yield lote
+
 def extrair_cnpjs_de_texto(texto):
     """
-    Extrai todos os padrões de CNPJ (formatados ou não) de um texto arbitrário.
+    Extrai os CNPJs válidos (formatados ou não) de um texto arbitrário, sem repetição,
+    normalizados para 14 dígitos.
     """
-    regex_formatado = r"\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}"
-    encontrados = re.findall(regex_formatado, texto)
-    cnpjs_unicos = list(set(encontrados))
-    return cnpjs_unicos
+    return [c for lote in extrair_cnpjs_arquivo(io.BytesIO(texto.encode("utf-8")), nome="texto.txt") for c in lote]
+
+def _qsa_cnpja(item, company):
+    # Schema: company.members[].person.name
+    # Fallback para listas onde members pode estar na raiz (embora schema diga company)
+    members = company.get("members") or []
+    if not members and "members" in item:
+        members = item["members"]
+    nomes = []
+    for m in members:
+        # Tenta person.name; fallback direto se a estrutura mudar
+        name = (m.get("person") or {}).get("name") or m.get("name")
+        if name:
+            nomes.append(name)
+    return ", ".join(nomes)
+
+def _secundarias_cnpja(item):
+    # Schema: sideActivities[].id / text (fallback legado: secondaryActivities) -> [(id, texto)]
+    side_acts = item.get("sideActivities") or item.get("secondaryActivities") or []
+    if not isinstance(side_acts, list):
+        return []
+    return [(str(act.get("id", "")), act.get("text", "")) for act in side_acts if str(act.get("id", ""))]
+
+def _telefone_cnpja(item):
+    phones = item.get("phones") or []
+    if phones and isinstance(phones, list):
+        area, num = phones[0].get("area", ""), phones[0].get("number", "")
+        if area and num:
+            return f"({area}) {num}"
+    return ""
+
+def _natureza_cnpja(company):
+    nature = company.get("nature") or {}
+    return nature.get("text") or str(nature.get("id", ""))
+
+# Mapeamento OfficeDto -> registro, compartilhado por parse_cnpja_record e parse_cnpja_lote:
+# (coluna, extrator(item, company, address, main_act)), na ordem das chaves do registro.
+CAMPOS_CNPJA = (
+    ("cnpj", lambda i, c, a, m: i.get("taxId", "")),
+    ("razao_social", lambda i, c, a, m: c.get("name", i.get("alias", ""))),
+    ("nome_fantasia", lambda i, c, a, m: i.get("alias") or c.get("name", "")),
+    ("data_inicio_atividade", lambda i, c, a, m: i.get("founded", "")),
+    ("cnae_fiscal_principal", lambda i, c, a, m: str(m.get("id", ""))),
+    ("cnae_fiscal_descricao", lambda i, c, a, m: m.get("text", "")),
+    ("cnaes_secundarios", lambda i, c, a, m: [f"{a_id} - {a_txt}" if a_txt else a_id
+                                              for a_id, a_txt in _secundarias_cnpja(i)]),
+    ("municipio", lambda i, c, a, m: a.get("city", "IGUATU")),
+    ("uf", lambda i, c, a, m: a.get("state", "CE")),
+    ("logradouro", lambda i, c, a, m: a.get("street", "")),
+    ("numero", lambda i, c, a, m: a.get("number", "")),
+    ("bairro", lambda i, c, a, m: a.get("district", "")),
+    ("cep", lambda i, c, a, m: a.get("zip", "")),
+    ("qsa", lambda i, c, a, m: _qsa_cnpja(i, c)),
+    ("telefone", lambda i, c, a, m: _telefone_cnpja(i)),
+    ("natureza_juridica", lambda i, c, a, m: _natureza_cnpja(c)),
+    ("porte_receita", lambda i, c, a, m: (c.get("size") or {}).get("text", "Não Informado")),
+    ("capital_social", lambda i, c, a, m: c.get("equity", 0)),
+)
 
 def parse_cnpja_record(item):
     """
@@ -139,172 +757,523 @@ def parse_cnpja_record(item):
     root -> alias (Fantasia)
     root -> sideActivities (Secundárias)
     root -> address (Endereço)
+    Campos e defaults: CAMPOS_CNPJA.
     """
-    # 1. Navegação Segura para Sub-objetos
+    # Navegação Segura para Sub-objetos
     company = item.get("company") or {}
     address = item.get("address") or {}
     main_act = item.get("mainActivity") or {}
-    
-    # 2. Dados Cadastrais Básicos
-    cnpj = item.get("taxId", "")
-    razao = company.get("name", item.get("alias", ""))
-    fantasia = item.get("alias") or company.get("name", "")
-    abertura = item.get("founded", "")
-    
-    # 3. Porte e Capital (Dados da Receita)
-    # Schema: company.size.text
-    size_obj = company.get("size") or {}
-    porte_receita = size_obj.get("text", "Não Informado")
-    
-    # Schema: company.equity
-    capital_social = company.get("equity", 0)
-    
-    # 4. Sócios (QSA)
-    # Schema: company.members[].person.name
-    members = company.get("members") or []
-    # Fallback para listas onde members pode estar na raiz (embora schema diga company)
-    if not members and "members" in item: 
-        members = item["members"]
-        
-    qsa_names = []
-    for m in members:
-        # Tenta person.name
-        person = m.get("person") or {}
-        name = person.get("name")
-        # Fallback direto se a estrutura mudar
-        if not name: name = m.get("name")
-        
-        if name: qsa_names.append(name)
-    
-    qsa_str = ", ".join(qsa_names)
+    return {coluna: extrator(item, company, address, main_act) for coluna, extrator in CAMPOS_CNPJA}
 
-    # 5. Atividades (CNAEs)
-    # Principal
-    cnae_p_code = str(main_act.get("id", ""))
-    cnae_p_text = main_act.get("text", "")
-    
-    # Secundárias
-    # Schema: sideActivities[].id / text
-    # Fallback legado: secondaryActivities
-    side_acts = item.get("sideActivities") or item.get("secondaryActivities") or []
+def parse_brasilapi_record(data):
+    """
+    Resposta da BrasilAPI (/api/cnpj/v1) no mesmo formato de parse_cnpja_record,
+    para o resto do sistema não distinguir o provedor.
+    """
+    cnae_p = data.get("cnae_fiscal")
+    cnae_p_text = data.get("cnae_fiscal_descricao", "")
+    if isinstance(data.get("cnae_fiscal_principal"), dict):  # formato antigo
+        cnae_p = data["cnae_fiscal_principal"].get("code")
+        cnae_p_text = data["cnae_fiscal_principal"].get("text", "")
+
+    # Secundárias: [{codigo, descricao}]; sem secundárias a API manda um item com codigo 0
     cnaes_sec_list = []
-    
-    if isinstance(side_acts, list):
-        for act in side_acts:
-            a_id = str(act.get("id", ""))
-            a_txt = act.get("text", "")
-            if a_id:
-                if a_txt:
-                    cnaes_sec_list.append(f"{a_id} - {a_txt}")
-                else:
-                    cnaes_sec_list.append(a_id)
-                    
-    # 6. Endereço
-    logradouro = address.get("street", "")
-    numero = address.get("number", "")
-    bairro = address.get("district", "")
-    municipio_nome = address.get("city", "IGUATU")
-    uf = address.get("state", "CE")
-    cep = address.get("zip", "")
-    
-    # 7. Contato
-    phones = item.get("phones") or []
-    phone_str = ""
-    if phones and isinstance(phones, list):
-        p0 = phones[0]
-        area = p0.get("area", "")
-        num = p0.get("number", "")
-        if area and num:
-            phone_str = f"({area}) {num}"
-            
-    # Natureza Jurídica
-    nature_obj = company.get("nature") or {}
-    nat_text = nature_obj.get("text") or str(nature_obj.get("id", ""))
+    for act in data.get("cnaes_secundarios") or []:
+        a_id = str(act.get("codigo") or "")
+        a_txt = act.get("descricao", "")
+        if a_id:
+            cnaes_sec_list.append(f"{a_id} - {a_txt}" if a_txt else a_id)
+
+    qsa_str = ", ".join(m["nome_socio"] for m in data.get("qsa") or [] if m.get("nome_socio"))
+
+    # ddd_telefone_1: "8835810000" -> "(88) 35810000"
+    tel = "".join(filter(str.isdigit, data.get("ddd_telefone_1") or ""))
+    phone_str = f"({tel[:2]}) {tel[2:]}" if len(tel) > 2 else ""
 
     return {
-        "cnpj": cnpj,
-        "razao_social": razao,
-        "nome_fantasia": fantasia,
-        "data_inicio_atividade": abertura,
-        "cnae_fiscal_principal": cnae_p_code,
+        "cnpj": data.get("cnpj", ""),
+        "razao_social": data.get("razao_social", ""),
+        "nome_fantasia": data.get("nome_fantasia") or data.get("razao_social", ""),
+        "data_inicio_atividade": data.get("data_inicio_atividade", ""),
+        "cnae_fiscal_principal": str(cnae_p or ""),
         "cnae_fiscal_descricao": cnae_p_text,
         "cnaes_secundarios": cnaes_sec_list,
-        "municipio": municipio_nome,
-        "uf": uf,
-        "logradouro": logradouro,
-        "numero": numero,
-        "bairro": bairro,
-        "cep": cep,
+        "municipio": data.get("municipio", "IGUATU"),
+        "uf": data.get("uf", "CE"),
+        "logradouro": data.get("logradouro", ""),
+        "numero": data.get("numero", ""),
+        "bairro": data.get("bairro", ""),
+        "cep": data.get("cep", ""),
         "qsa": qsa_str,
         "telefone": phone_str,
-        "natureza_juridica": nat_text,
-        "porte_receita": porte_receita,
-        "capital_social": capital_social
+        "natureza_juridica": data.get("natureza_juridica", ""),
+        "porte_receita": data.get("porte") or data.get("descricao_porte") or "Não Informado",
+        "capital_social": data.get("capital_social", 0)
     }
 
-def consultar_detalhes_cnpj(api_key, cnpj):
+COLUNAS_LOTE_CNPJA = [coluna for coluna, _ in CAMPOS_CNPJA if coluna != "cnaes_secundarios"]
+
+def parse_cnpja_lote(items, com_secundarias=False):
     """
-    Busca dados COMPLETOS de uma empresa específica (custo de crédito se não estiver em cache).
-    Endpoint: GET /office/{taxId}
+    Versão colunar de parse_cnpja_record para listas de OfficeDto (páginas da varredura,
+    respostas em cache): uma única passada enchendo uma lista por coluna (mesma tabela
+    CAMPOS_CNPJA), sem o dict intermediário por registro, e os DataFrames montados
+    direto das colunas.
+    Retorna (empresas, atividades):
+    - empresas: uma linha por registro, mesmas chaves de parse_cnpja_record menos
+      cnaes_secundarios (mesmos valores e defaults, colunas object: to_dict("records")
+      devolve exatamente os dicts de parse_cnpja_record); com `com_secundarias`, inclui
+      também cnaes_secundarios (lista "id - texto"), como nas páginas da varredura.
+    - atividades: tabela filha "explodida" das secundárias (cnpj, ordem, cnae, descricao),
+      em vez das strings "id - texto".
     """
+    import pandas as pd
+
+    colunas_saida = [c for c, _ in CAMPOS_CNPJA] if com_secundarias else COLUNAS_LOTE_CNPJA
+    colunas = {c: [] for c in colunas_saida}
+    campos = [(colunas[c].append, extrator) for c, extrator in CAMPOS_CNPJA if c in colunas]
+    at_cnpj, at_ordem, at_cnae, at_desc = [], [], [], []
+    vazio = {}
+
+    for item in items:
+        get = item.get
+        company = get("company") or vazio
+        address = get("address") or vazio
+        main_act = get("mainActivity") or vazio
+        for append, extrator in campos:
+            append(extrator(item, company, address, main_act))
+
+        cnpj = get("taxId", "")
+        for ordem, (a_id, a_txt) in enumerate(_secundarias_cnpja(item)):
+            at_cnpj.append(cnpj)
+            at_ordem.append(ordem)
+            at_cnae.append(a_id)
+            at_desc.append(a_txt)
+
+    empresas = pd.DataFrame(colunas, columns=colunas_saida, dtype=object)
+    atividades = pd.DataFrame({"cnpj": at_cnpj, "ordem": at_ordem, "cnae": at_cnae, "descricao": at_desc})
+    return empresas, atividades
+
+def _buscar_office_cnpja(api_key, cnpj_clean):
     headers = {"Authorization": api_key}
-    cnpj_clean = "".join(filter(str.isdigit, cnpj))
     url = f"https://api.cnpja.com/office/{cnpj_clean}"
     
     # Parâmetro maxAge para evitar cache antigo/vazio conforme dica do usuário
     params = {"maxAge": 15} 
     
+    response = http_get("cnpja_office", url, headers=headers, params=params)
+    if response.status_code == 200:
+        return response.json() # OfficeDto
+    elif response.status_code == 404:
+        return None
+    else:
+        print(f"Erro Details API: {response.status_code} - {response.text}")
+        return None
+
+def consultar_detalhes_cnpj(api_key, cnpj, usar_cache=True):
+    """
+    Busca dados COMPLETOS de uma empresa específica (custo de crédito se não estiver em cache).
+    Endpoint: GET /office/{taxId}
+    Consulta primeiro o cache local (consultar_com_cache); `usar_cache=False` força a API.
+    """
+    cnpj_clean = "".join(filter(str.isdigit, cnpj))
     try:
-        response = requests.get(url, headers=headers, params=params, timeout=20)
-        if response.status_code == 200:
-            data = response.json() # OfficeDto
-            return parse_cnpja_record(data)
-        elif response.status_code == 404:
-            return None
-        else:
-            print(f"Erro Details API: {response.status_code} - {response.text}")
-            return None
+        data = consultar_com_cache("cnpja", cnpj_clean, lambda: _buscar_office_cnpja(api_key, cnpj_clean), usar_cache)
+        return parse_cnpja_record(data) if data else None
     except Exception as e:
         print(f"Erro Conn Details: {e}")
         return None
 
-def buscar_cnpja_comercial(api_key, cnaes_alvo=None, cidade_ibge="2305506"):
-    # ... (código existente de setup) ...
-    resultados = []
+# --- CONSULTA POR CNPJ COM HEDGE ENTRE PROVEDORES ---
+# Manda para o provedor primário; se ele passar do próprio p90 de latência sem responder,
+# dispara o secundário e fica com a primeira resposta válida. Falha/vazio no primário
+# aciona o secundário na hora. O primário é escolhido pelas estatísticas de http_get.
+PROVEDORES_CNPJ = {
+    # provedor: (endpoint em estatisticas_latencia, precisa de api_key)
+    "brasilapi": ("brasilapi_cnpj", False),
+    "cnpja": ("cnpja_office", True),
+}
+_CONTADORES_HEDGE = {"consultas": 0, "hedges": 0, "fallbacks": 0, "sem_resposta": 0}
+_VITORIAS_PROVEDOR = {}
+_TRAVA_HEDGE = threading.Lock()
+_POOL_HEDGE = None
+
+def _pool_hedge():
+    global _POOL_HEDGE
+    with _TRAVA_HEDGE:
+        if _POOL_HEDGE is None:
+            _POOL_HEDGE = ThreadPoolExecutor(max_workers=2 * MAX_CONSULTAS_PARALELAS)
+    return _POOL_HEDGE
+
+def _desempenho_provedor(provedor, stats):
+    s = stats.get(PROVEDORES_CNPJ[provedor][0])
+    if not s or s["chamadas"] < HEDGE_AMOSTRAS_MINIMAS:
+        return 0.0, None
+    return s["erros"] / s["chamadas"], s["p90_ms"] / 1000
+
+def ranking_provedores(api_key=None):
+    """
+    Provedores de consulta por CNPJ na ordem de preferência: primeiro os com taxa de erro
+    até TAXA_ERRO_MAX_PRIMARIO, depois menor p90. Sem histórico, vale a ordem de
+    PROVEDORES_CNPJ (BrasilAPI, gratuita, na frente). O CNPJá só entra com `api_key`.
+    """
+    stats = estatisticas_latencia()
+    disponiveis = [p for p, (_, exige_chave) in PROVEDORES_CNPJ.items() if api_key or not exige_chave]
+
+    def chave(provedor):
+        taxa_erro, p90 = _desempenho_provedor(provedor, stats)
+        return taxa_erro > TAXA_ERRO_MAX_PRIMARIO, p90 if p90 is not None else HEDGE_ATRASO_PADRAO
+
+    return sorted(disponiveis, key=chave)
+
+def _atraso_hedge(provedor):
+    _, p90 = _desempenho_provedor(provedor, estatisticas_latencia())
+    return HEDGE_ATRASO_PADRAO if p90 is None else max(HEDGE_ATRASO_MINIMO, p90)
+
+def _consultar_provedor(provedor, cnpj, api_key, usar_cache):
+    if provedor == "cnpja":
+        return consultar_detalhes_cnpj(api_key, cnpj, usar_cache)
+    return buscar_cnpj_brasilapi(cnpj, usar_cache)
+
+def consultar_cnpj(cnpj, api_key=None, usar_cache=True, hedge=True):
+    """
+    Dados de um CNPJ no formato de parse_cnpja_record, do provedor que responder primeiro.
+    Retorna (registro, provedor) ou (None, None).
+    Provedor com o CNPJ no cache local vai na frente (responde sem chamada). Com `api_key`,
+    um hedge para o CNPJá pode gastar um crédito mesmo que a BrasilAPI acabe vencendo;
+    `hedge=False` só passa para o próximo provedor quando o anterior falha.
+    """
+    cnpj_limpo = "".join(filter(str.isdigit, cnpj))
+    ordem = ranking_provedores(api_key)
+    if usar_cache:
+        limite_cache = (CACHE_TTL_DIAS + CACHE_JANELA_STALE_DIAS) * 86400
+        em_cache = []
+        for p in ordem:
+            try:
+                idade = _cache_idade(p, cnpj_limpo)
+            except sqlite3.Error:
+                idade = None
+            if idade is not None and idade <= limite_cache:
+                em_cache.append(p)
+        ordem = em_cache + [p for p in ordem if p not in em_cache]
+    _contar_hedge("consultas")
+
+    pool = _pool_hedge()
+    restantes = list(ordem)
+    pendentes = set()
+    origem = {}
+    atraso = None
+
+    def disparar():
+        provedor = restantes.pop(0)
+        futuro = pool.submit(_consultar_provedor, provedor, cnpj_limpo, api_key, usar_cache)
+        origem[futuro] = provedor
+        pendentes.add(futuro)
+        return _atraso_hedge(provedor)
+
+    atraso = disparar()
+    while pendentes:
+        feitos, pendentes = wait(pendentes, timeout=atraso if hedge and restantes else None,
+                                 return_when=FIRST_COMPLETED)
+        if not feitos:
+            _contar_hedge("hedges")
+            atraso = disparar()
+            continue
+        for futuro in feitos:
+            registro = futuro.result()
+            if registro and registro.get("cnpj"):
+                with _TRAVA_HEDGE:
+                    _VITORIAS_PROVEDOR[origem[futuro]] = _VITORIAS_PROVEDOR.get(origem[futuro], 0) + 1
+                return registro, origem[futuro]
+        if not pendentes and restantes:
+            _contar_hedge("fallbacks")
+            atraso = disparar()
+
+    _contar_hedge("sem_resposta")
+    return None, None
+
+def _contar_hedge(chave):
+    with _TRAVA_HEDGE:
+        _CONTADORES_HEDGE[chave] += 1
+
+def estatisticas_hedge():
+    """Consultas por CNPJ desde que o processo subiu: hedges disparados, fallbacks e vitórias por provedor."""
+    with _TRAVA_HEDGE:
+        return dict(_CONTADORES_HEDGE, vitorias=dict(_VITORIAS_PROVEDOR))
+
+def _codigo_cnae(cnae):
+    # "4781-4/00", "4781400" ou 4781400 -> 4781400
+    return int("".join(filter(str.isdigit, str(cnae).split(" - ")[0])))
+
+def cnaes_da_lei(mapa_cnaes=None):
+    """Códigos CNAE (int) de todos os grupos da Lei, para filtrar direto na API."""
+    mapa_cnaes = mapa_cnaes or cnae_mapping.LEI_TO_CNAE
+    return sorted({_codigo_cnae(c) for info in mapa_cnaes.values() for c in info['cnaes']})
+
+def varrer_cnpja_paginas(api_key, cidade_ibge="2305506", cnaes_alvo=None, dias=365,
+                         tamanho_pagina=TAMANHO_PAGINA_CNPJA, max_paginas=MAX_PAGINAS_VARREDURA, max_registros=None,
+                         filtrar_cnaes=True, estatisticas=None):
+    """
+    Varredura paginada do /office: segue o token `next` até acabar ou até estourar
+    o orçamento (`max_paginas` / `max_registros`, somados entre as passadas).
+    Com `filtrar_cnaes`, os CNAEs (padrão: todos da Lei, ver cnaes_da_lei) vão como filtro
+    em duas passadas, `mainActivity.id.in` e depois `sideActivities.id.in` (mesma cidade e
+    data), com repetidos descartados pelo taxId: quem está na Lei só pela atividade
+    secundária continua vindo. Empresas que analisar_leads só reconheceria por palavra-chave
+    na descrição (sem CNAE da Lei) não são transferidas; `filtrar_cnaes=False` faz uma
+    passada só, sem filtro de CNAE, como a varredura original (mais páginas, mais créditos).
+    `estatisticas` (dict opcional) recebe "paginas", "registros", "duplicados" e
+    "interrompida" (True se parou pelo orçamento, e não porque as páginas acabaram).
+    Gera um DataFrame por página (parse_cnpja_lote com cnaes_secundarios: mesmas colunas de
+    parse_cnpja_record), pronto para analisar_leads_df. Erros da API sobem como ErroCNPJa.
+    """
     headers = {
         "Authorization": f"{api_key}",
         "Content-Type": "application/json"
     }
     url = "https://api.cnpja.com/office"
-    params = {
-        "address.municipality.in": int(cidade_ibge), 
-        "limit": 20, 
-        "founded.gte": (datetime.now() - timedelta(days=365)).strftime("%Y-%m-%d")
-    }
-    
-    try:
-        response = requests.get(url, headers=headers, params=params, timeout=20)
-        
-        if response.status_code == 200:
+    cnaes = [_codigo_cnae(c) for c in cnaes_alvo] if cnaes_alvo else cnaes_da_lei()
+    filtros = ["mainActivity.id.in", "sideActivities.id.in"] if filtrar_cnaes else [None]
+    stats = estatisticas if estatisticas is not None else {}
+    stats.update(paginas=0, registros=0, duplicados=0, interrompida=False)
+    vistos = set()
+
+    for filtro in filtros:
+        params = {
+            "address.municipality.in": int(cidade_ibge),
+            "limit": tamanho_pagina,
+            "founded.gte": (datetime.now() - timedelta(days=dias)).strftime("%Y-%m-%d")
+        }
+        if filtro:
+            params[filtro] = ",".join(map(str, cnaes))
+
+        while True:
+            if (max_paginas and stats["paginas"] >= max_paginas) or \
+                    (max_registros is not None and stats["registros"] >= max_registros):
+                # Ainda havia página (ou passada) pela frente
+                stats["interrompida"] = True
+                return
+            try:
+                response = http_get("cnpja_busca", url, headers=headers, params=params)
+            except ErroCNPJa:
+                raise
+            except Exception as e:
+                raise ErroCNPJa(f"Erro de Conexão: {str(e)}")
+
+            if response.status_code == 401:
+                raise ErroCNPJa("Erro 401: Chave de API Inválida ou Expirada.")
+            elif response.status_code == 429:
+                raise ErroCNPJa("Erro 429: Créditos esgotados.")
+            elif response.status_code != 200:
+                raise ErroCNPJa(f"Erro {response.status_code}: {response.text}")
+
             data = response.json()
-            lista = data.get('records', [])
-            
-            if not lista:
-                return [], "API retornou sucesso mas lista vazia (Verifique se há empresas novas)."
-
-            for item in lista:
-                emp = parse_cnpja_record(item)
-                resultados.append(emp)
-                
-            return resultados, None
-            
-        elif response.status_code == 401:
-            return None, "Erro 401: Chave de API Inválida ou Expirada."
-        elif response.status_code == 429:
-            return None, "Erro 429: Créditos esgotados."
+            stats["paginas"] += 1
+            registros_pagina = []
+            for item in data.get('records', []):
+                cnpj = item.get("taxId")
+                if cnpj and cnpj in vistos:
+                    stats["duplicados"] += 1
+                    continue
+                vistos.add(cnpj)
+                registros_pagina.append(item)
+            if max_registros is not None and len(registros_pagina) > max_registros - stats["registros"]:
+                registros_pagina = registros_pagina[:max_registros - stats["registros"]]
+                stats["interrompida"] = True
+            stats["registros"] += len(registros_pagina)
+            if registros_pagina:
+                yield parse_cnpja_lote(registros_pagina, com_secundarias=True)[0]
+
+            token = data.get('next')
+            if not token:
+                break
+            # Demais páginas: só o token (ele já carrega os filtros da primeira consulta)
+            params = {"token": token, "limit": tamanho_pagina}
+
+def varrer_cnpja(api_key, cidade_ibge="2305506", cnaes_alvo=None, **kwargs):
+    """Mesma varredura de varrer_cnpja_paginas, registro a registro (dicts de parse_cnpja_record)."""
+    for pagina in varrer_cnpja_paginas(api_key, cidade_ibge, cnaes_alvo, **kwargs):
+        yield from pagina.to_dict("records")
+
+def buscar_cnpja_comercial(api_key, cnaes_alvo=None, cidade_ibge="2305506", max_paginas=MAX_PAGINAS_VARREDURA):
+    """Varredura completa em memória (ver varrer_cnpja_paginas). Retorna (resultados, erro)."""
+    try:
+        resultados = list(varrer_cnpja(api_key, cidade_ibge, cnaes_alvo, max_paginas=max_paginas))
+    except ErroCNPJa as e:
+        return None, str(e)
+    if not resultados:
+        return [], "API retornou sucesso mas lista vazia (Verifique se há empresas novas)."
+    return resultados, None
+
+# --- BASE LOCAL (extração da Receita, sem API e sem créditos) ---
+
+class IndiceLocal:
+    """
+    Registros de um município (receita_worker.registros_do_municipio) em memória,
+    com índices para as mesmas consultas da varredura do CNPJá:
+    CNAE principal e secundário, data de abertura (lista ordenada + bisect),
+    bairro e situação cadastral.
+    """
+
+    def __init__(self, registros):
+        from receita_worker import _normalizar_nome
+
+        self._normalizar = _normalizar_nome
+        self.registros = list(registros)
+        self.por_cnae_principal = {}
+        self.por_cnae_qualquer = {}
+        self.por_bairro = {}
+        self.por_situacao = {}
+        datas = []
+        for i, reg in enumerate(self.registros):
+            codigos_sec = set()
+            for c in reg.get("cnaes_secundarios") or []:
+                try:
+                    codigos_sec.add(_codigo_cnae(c))
+                except ValueError:
+                    pass
+            try:
+                principal = _codigo_cnae(reg.get("cnae_fiscal_principal", ""))
+                self.por_cnae_principal.setdefault(principal, set()).add(i)
+                codigos_sec.add(principal)
+            except ValueError:
+                pass
+            for codigo in codigos_sec:
+                self.por_cnae_qualquer.setdefault(codigo, set()).add(i)
+            self.por_bairro.setdefault(_normalizar_nome(reg.get("bairro") or ""), set()).add(i)
+            self.por_situacao.setdefault(reg.get("situacao_cadastral", ""), set()).add(i)
+            if reg.get("data_inicio_atividade"):
+                datas.append((reg["data_inicio_atividade"], i))
+        datas.sort()
+        self.datas = [d for d, _ in datas]
+        self.indices_por_data = [i for _, i in datas]
+
+    def buscar(self, cnaes=None, incluir_secundarias=False, aberta_desde=None, aberta_ate=None,
+               bairro=None, situacao=None, limite=None):
+        """
+        Registros que atendem a todos os filtros informados, mais recentes primeiro.
+        `cnaes`: códigos em qualquer formato ("4781-4/00", 4781400); datas em "AAAA-MM-DD".
+        """
+        conjuntos = []
+        if cnaes:
+            indice = self.por_cnae_qualquer if incluir_secundarias else self.por_cnae_principal
+            por_cnae = set()
+            for c in cnaes:
+                por_cnae |= indice.get(_codigo_cnae(c), set())
+            conjuntos.append(por_cnae)
+        if bairro:
+            conjuntos.append(self.por_bairro.get(self._normalizar(bairro), set()))
+        if situacao:
+            conjuntos.append(self.por_situacao.get(situacao, set()))
+        if aberta_desde or aberta_ate:
+            inicio = bisect.bisect_left(self.datas, aberta_desde) if aberta_desde else 0
+            fim = bisect.bisect_right(self.datas, aberta_ate) if aberta_ate else len(self.datas)
+            conjuntos.append(set(self.indices_por_data[inicio:fim]))
+
+        if conjuntos:
+            conjuntos.sort(key=len)
+            selecionados = conjuntos[0].intersection(*conjuntos[1:])
         else:
-            return None, f"Erro {response.status_code}: {response.text}"
-            
-    except Exception as e:
-        return None, f"Erro de Conexão: {str(e)}"
+            selecionados = range(len(self.registros))
+
+        resultado = sorted(selecionados, key=lambda i: self.registros[i].get("data_inicio_atividade") or "", reverse=True)
+        if limite:
+            resultado = resultado[:limite]
+        return [dict(self.registros[i]) for i in resultado]
+
+# Um índice por município, recarregado quando a extração muda no disco
+_INDICES_LOCAIS = {}
+_TRAVA_INDICES = threading.Lock()
+
+def indice_local(nome_municipio):
+    """IndiceLocal do município (extração enriquecida ou bruta do receita_worker), ou None se não houver extração."""
+    import receita_worker
+
+    nome = nome_municipio.upper()
+    caminho = receita_worker.arquivo_enriquecido_municipio(nome)
+    if not os.path.exists(caminho):
+        caminho = receita_worker.arquivo_saida_municipio(nome)
+        if not os.path.exists(caminho):
+            return None
+    versao = (caminho, os.path.getmtime(caminho))
+    with _TRAVA_INDICES:
+        atual = _INDICES_LOCAIS.get(nome)
+        if atual is None or atual[0] != versao:
+            atual = (versao, IndiceLocal(receita_worker.registros_do_municipio(nome)))
+            _INDICES_LOCAIS[nome] = atual
+    return atual[1]
+
+def buscar_base_local(cidade_ibge="2305506", cnaes_alvo=None, dias=365, bairro=None, situacao=None,
+                      incluir_secundarias=True, limite=None):
+    """
+    Mesma consulta de buscar_cnpja_comercial (município, CNAEs da Lei, abertas nos
+    últimos `dias`), respondida pela extração local. Retorna (resultados, erro).
+    Como na varredura da CNPJá, casa o CNAE principal ou secundário e, sem `situacao`,
+    traz só estabelecimentos ativos; `situacao=""` desliga o filtro de situação.
+    """
+    import receita_worker
 
+    if situacao is None:
+        situacao = receita_worker.SITUACAO_ATIVA
+    municipio = resolver_municipio_ibge(cidade_ibge)
+    if municipio is None:
+        return None, (f"Município IBGE {cidade_ibge} não encontrado na tabela de municípios. "
+                      "Rode o receita_worker.py para montá-la.")
+    indice = indice_local(municipio["nome"])
+    if indice is None:
+        return None, f"Extração local de {municipio['nome']} não encontrada. Rode o receita_worker.py antes."
+    resultados = indice.buscar(
+        cnaes=cnaes_alvo or cnaes_da_lei(),
+        incluir_secundarias=incluir_secundarias,
+        aberta_desde=(datetime.now() - timedelta(days=dias)).strftime("%Y-%m-%d") if dias else None,
+        bairro=bairro,
+        situacao=situacao,
+        limite=limite,
+    )
+    if not resultados:
+        return [], "Nenhuma empresa da extração local atende aos filtros."
+    return resultados, None
+
+def estimar_creditos_enriquecimento(cnpjs):
+    """
+    Simulação (nenhuma chamada paga): quantos créditos enriquecer_lote gastaria com estes CNPJs.
+    CNPJs já no cache (dentro do TTL ou da janela stale) não custam nada.
+    """
+    unicos = list(dict.fromkeys("".join(filter(str.isdigit, c)) for c in cnpjs))
+    limite_cache = (CACHE_TTL_DIAS + CACHE_JANELA_STALE_DIAS) * 86400
+    idades = (_cache_idade("cnpja", c) for c in unicos)
+    em_cache = sum(1 for idade in idades if idade is not None and idade <= limite_cache)
+    creditos = (len(unicos) - em_cache) * CUSTO_CREDITOS["cnpja_office"]
+    saldo = saldo_creditos()
+    return {
+        "consultas": len(unicos),
+        "em_cache": em_cache,
+        "creditos": creditos,
+        "restante_execucao": saldo["restante_execucao"],
+        "restante_mes": saldo["restante_mes"],
+        "cabe_no_orcamento": creditos <= min(saldo["restante_execucao"], saldo["restante_mes"]),
+    }
+
+def enriquecer_lote(api_key, cnpjs, max_paralelo=MAX_CONSULTAS_PARALELAS, multi_provedor=False):
+    """
+    Consulta os detalhes de vários CNPJs em paralelo (pool de threads limitado;
+    o ritmo fica com o balde de tokens do provedor), reaproveitando as conexões
+    da Session compartilhada.
+    Gera (cnpj, detalhes ou None) na ordem em que as consultas terminam, para
+    quem chama atualizar o progresso a cada resultado.
+    `multi_provedor=True` consulta por consultar_cnpj (BrasilAPI + CNPJá se houver
+    `api_key`) em vez de só o CNPJá.
+    """
+    if multi_provedor:
+        consultar = lambda cnpj: consultar_cnpj(cnpj, api_key=api_key)[0]
+    else:
+        consultar = lambda cnpj: consultar_detalhes_cnpj(api_key, cnpj)
+    with ThreadPoolExecutor(max_workers=max_paralelo) as pool:
+        futuros = {pool.submit(consultar, cnpj): cnpj for cnpj in dict.fromkeys(cnpjs)}
+        for futuro in as_completed(futuros):
+            try:
+                detalhes = futuro.result()
+            except Exception as e:
+                print(f"Erro ao enriquecer {futuros[futuro]}: {e}")
+                detalhes = None
+            yield futuros[futuro], detalhes
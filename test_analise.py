@@ -0,0 +1,64 @@
+"""
+analisar_leads_df dá o mesmo resultado de analisar_leads linha a linha.
+Uso:
+    python -m pytest -q test_analise.py
+"""
+import math
+from datetime import datetime
+
+import pandas as pd
+
+import business_logic
+import gerar_dados_sinteticos
+
+REFERENCIA = datetime(2026, 1, 15)
+
+CAMPOS = business_logic.CAMPOS_RECALCULADOS + business_logic._CAMPOS_UI
+
+# Casos de borda: vazios, chaves faltando, datas ruins, loteamento, funcionários em faixa
+CASOS_BORDA = [
+    {"cnpj": "1", "cnae_fiscal_principal": "1011201", "capital_social": float("nan"),
+     "data_inicio_atividade": "2025-12-01"},
+    {"cnpj": "2", "cnae_fiscal_principal": "1011201", "capital_social": None,
+     "faturamento_estimado": None, "data_inicio_atividade": None},
+    {"cnpj": "3", "cnae_fiscal_principal": "2710400"},
+    {"cnpj": "4", "cnae_fiscal_principal": "1011201", "data_inicio_atividade": "31/12/2024"},
+    {"cnpj": "5", "cnae_fiscal_principal": "1011201", "data_inicio_atividade": ""},
+    {"cnpj": "6", "cnae_fiscal_principal": "4213800", "area_construida": 350_000,
+     "capital_social": 100_000, "data_inicio_atividade": "2024-03-10"},
+    {"cnpj": "7", "cnae_fiscal_principal": "4213-8/00", "area_construida": 50_000,
+     "data_inicio_atividade": "2025-10-01"},
+    {"cnpj": "8", "cnae_fiscal_principal": "1011201", "qtde_funcionarios": "10-50",
+     "data_inicio_atividade": "2025-06-01"},
+    {"cnpj": "9", "cnae_fiscal_principal": "9999999", "cnaes_secundarios": ["4744099", "9511800"],
+     "natureza_juridica": "Empresário (Individual) - MEI", "data_inicio_atividade": "2020-01-01"},
+    {"cnpj": "10", "cnae_fiscal_principal": "", "cnae_fiscal_descricao": "Comércio de veículos usados",
+     "data_inicio_atividade": "2025-12-20"},
+    {"cnpj": "11", "cnae_fiscal_principal": "1011201", "data_inicio_atividade": "2025-02-30",
+     "capital_social": "abc"},
+]
+
+def _normalizar(valor):
+    # NaN e None valem o mesmo (ausente) na comparação
+    if valor is None or (isinstance(valor, float) and math.isnan(valor)):
+        return None
+    return valor
+
+def _comparar(leads):
+    esperado = business_logic.analisar_leads(leads, data_referencia=REFERENCIA)
+    obtido = business_logic.analisar_leads_df(pd.DataFrame(leads), data_referencia=REFERENCIA).to_dict("records")
+    assert len(obtido) == len(esperado)
+    for linha_esperada, linha_obtida in zip(esperado, obtido):
+        for campo in CAMPOS:
+            assert _normalizar(linha_obtida[campo]) == _normalizar(linha_esperada[campo]), (
+                linha_esperada["cnpj"], campo)
+
+def test_paridade_dados_sinteticos():
+    _comparar(list(gerar_dados_sinteticos.gerar_empresas(2_000, seed=42, data_referencia=REFERENCIA)))
+
+def test_paridade_casos_de_borda():
+    _comparar(CASOS_BORDA)
+
+def test_paridade_casos_de_borda_misturados():
+    sinteticos = list(gerar_dados_sinteticos.gerar_empresas(200, seed=7, data_referencia=REFERENCIA))
+    _comparar(sinteticos[:100] + CASOS_BORDA + sinteticos[100:])
@@ -0,0 +1,154 @@
+"""
+Download com retomada do receita_worker contra um servidor HTTP local com suporte a Range.
+Uso:
+    python -m pytest -q test_download.py
+"""
+import io
+import os
+import threading
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import receita_worker
+
+CONTEUDO_CSV = "".join(f'"{i:08d}";"0001";"ESTABELECIMENTO {i}";"1387"\n' for i in range(20_000)).encode("latin-1")
+
+def _zip_em_memoria(dados, compressao=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compressao) as z:
+        z.writestr("K3241.K03200Y0.D00000.ESTABELE", dados)
+    return buffer.getvalue()
+
+class _ServidorRange(BaseHTTPRequestHandler):
+    """Serve `arquivos` ({caminho: bytes}) com HEAD, GET e `Range: bytes=N-` (206/416)."""
+    arquivos = {}
+    ranges = []
+    ignorar_range = False
+
+    def log_message(self, *args):
+        pass
+
+    def _corpo(self):
+        dados = self.arquivos.get(self.path)
+        if dados is None:
+            self.send_error(404)
+        return dados
+
+    def do_HEAD(self):
+        dados = self._corpo()
+        if dados is None:
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+
+    def do_GET(self):
+        dados = self._corpo()
+        if dados is None:
+            return
+        faixa = self.headers.get("Range")
+        self.ranges.append(faixa)
+        if not faixa or self.ignorar_range:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(dados)))
+            self.end_headers()
+            self.wfile.write(dados)
+            return
+        inicio = int(faixa.split("=")[1].split("-")[0])
+        if inicio >= len(dados):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(dados)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {inicio}-{len(dados) - 1}/{len(dados)}")
+        self.send_header("Content-Length", str(len(dados) - inicio))
+        self.end_headers()
+        self.wfile.write(dados[inicio:])
+
+@pytest.fixture
+def servidor(monkeypatch):
+    monkeypatch.setattr(receita_worker.time, "sleep", lambda _: None)  # sem espera entre tentativas
+    _ServidorRange.arquivos = {}
+    _ServidorRange.ranges = []
+    _ServidorRange.ignorar_range = False
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _ServidorRange)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_retoma_do_part(servidor, tmp_path):
+    dados = _zip_em_memoria(CONTEUDO_CSV)
+    _ServidorRange.arquivos["/Estabelecimentos0.zip"] = dados
+    destino = str(tmp_path / "Estabelecimentos0.zip")
+    metade = len(dados) // 2
+    with open(destino + ".part", "wb") as f:
+        f.write(dados[:metade])
+
+    assert receita_worker.download_file(f"{servidor}/Estabelecimentos0.zip", destino)
+
+    assert _ServidorRange.ranges == [f"bytes={metade}-"]
+    with open(destino, "rb") as f:
+        assert f.read() == dados
+    assert not os.path.exists(destino + ".part")
+
+def test_part_completo_responde_416(servidor, tmp_path):
+    dados = _zip_em_memoria(CONTEUDO_CSV)
+    _ServidorRange.arquivos["/Estabelecimentos1.zip"] = dados
+    destino = str(tmp_path / "Estabelecimentos1.zip")
+    with open(destino + ".part", "wb") as f:
+        f.write(dados)
+
+    assert receita_worker.download_file(f"{servidor}/Estabelecimentos1.zip", destino)
+
+    assert _ServidorRange.ranges == [f"bytes={len(dados)}-"]
+    with open(destino, "rb") as f:
+        assert f.read() == dados
+
+def test_crc_invalido_nao_publica(servidor, tmp_path):
+    # Membro sem compressão: troca um byte do conteúdo, estrutura do zip continua válida
+    dados = bytearray(_zip_em_memoria(CONTEUDO_CSV, zipfile.ZIP_STORED))
+    posicao = bytes(dados).index(CONTEUDO_CSV[:64]) + 10
+    dados[posicao] ^= 0xFF
+    _ServidorRange.arquivos["/Estabelecimentos2.zip"] = bytes(dados)
+    destino = str(tmp_path / "Estabelecimentos2.zip")
+
+    assert not receita_worker.download_file(f"{servidor}/Estabelecimentos2.zip", destino, tentativas=2)
+
+    assert _ServidorRange.ranges == [None, None]  # .part apagado: cada tentativa recomeça do zero
+    assert not os.path.exists(destino)
+    assert not os.path.exists(destino + ".part")
+
+def test_zip_remoto_le_por_range(servidor, tmp_path, monkeypatch):
+    # Sem compressão (~1 MB): bem maior que a cauda, então o membro vem pelo stream com Range
+    monkeypatch.setattr(receita_worker, "DIR_DADOS", str(tmp_path))
+    dados = _zip_em_memoria(CONTEUDO_CSV, zipfile.ZIP_STORED)
+    inicio_cauda = len(dados) - receita_worker.TAMANHO_CAUDA_REMOTA
+    assert inicio_cauda > 0
+    _ServidorRange.arquivos["/Estabelecimentos3.zip"] = dados
+
+    with receita_worker.abrir_zip(f"{servidor}/Estabelecimentos3.zip") as z:
+        assert z.read(z.namelist()[0]) == CONTEUDO_CSV
+
+    assert all(faixa for faixa in _ServidorRange.ranges)
+    inicios = [int(faixa.split("=")[1].split("-")[0]) for faixa in _ServidorRange.ranges]
+    assert inicio_cauda in inicios  # diretório central
+    assert any(i < inicio_cauda for i in inicios)  # membro lido pelo stream (_abrir_stream)
+    assert not os.listdir(tmp_path)
+
+def test_zip_remoto_sem_range_baixa_o_arquivo(servidor, tmp_path, monkeypatch):
+    # Servidor que responde 200 com o corpo inteiro: não pode ir para a memória como "cauda"
+    monkeypatch.setattr(receita_worker, "DIR_DADOS", str(tmp_path))
+    _ServidorRange.ignorar_range = True
+    _ServidorRange.arquivos["/Estabelecimentos4.zip"] = _zip_em_memoria(CONTEUDO_CSV)
+
+    with receita_worker.abrir_zip(f"{servidor}/Estabelecimentos4.zip") as z:
+        assert z.read(z.namelist()[0]) == CONTEUDO_CSV
+
+    assert os.listdir(tmp_path) == ["Estabelecimentos4.zip"]